@@ -0,0 +1,272 @@
+"""
+Template-based badge renderer: draws square, story, certificate, poster and banner
+badges as PNG on the CPU with only the standard library (no network, no imaging
+dependencies). Used by the agent as the fast path for /generate-badge-image.
+"""
+import zlib
+import struct
+import colorsys
+import hashlib
+
+RENDERER_VERSION = 1
+
+# format -> (width, height)
+BADGE_FORMATS = {
+    "square": (1024, 1024),
+    "story": (1080, 1920),
+    "certificate": (2048, 1536),
+    "poster": (2048, 1024),
+    "banner": (2048, 512),
+}
+
+# 5x7 bitmap font, one string of 7 rows per glyph ('#' = lit); lowercase is drawn as uppercase
+_GLYPH_ROWS = {
+    "A": (" ### ", "#   #", "#   #", "#####", "#   #", "#   #", "#   #"),
+    "B": ("#### ", "#   #", "#   #", "#### ", "#   #", "#   #", "#### "),
+    "C": (" ### ", "#   #", "#    ", "#    ", "#    ", "#   #", " ### "),
+    "D": ("#### ", "#   #", "#   #", "#   #", "#   #", "#   #", "#### "),
+    "E": ("#####", "#    ", "#    ", "#### ", "#    ", "#    ", "#####"),
+    "F": ("#####", "#    ", "#    ", "#### ", "#    ", "#    ", "#    "),
+    "G": (" ### ", "#   #", "#    ", "# ###", "#   #", "#   #", " ####"),
+    "H": ("#   #", "#   #", "#   #", "#####", "#   #", "#   #", "#   #"),
+    "I": (" ### ", "  #  ", "  #  ", "  #  ", "  #  ", "  #  ", " ### "),
+    "J": ("  ###", "   # ", "   # ", "   # ", "   # ", "#  # ", " ##  "),
+    "K": ("#   #", "#  # ", "# #  ", "##   ", "# #  ", "#  # ", "#   #"),
+    "L": ("#    ", "#    ", "#    ", "#    ", "#    ", "#    ", "#####"),
+    "M": ("#   #", "## ##", "# # #", "# # #", "#   #", "#   #", "#   #"),
+    "N": ("#   #", "#   #", "##  #", "# # #", "#  ##", "#   #", "#   #"),
+    "O": (" ### ", "#   #", "#   #", "#   #", "#   #", "#   #", " ### "),
+    "P": ("#### ", "#   #", "#   #", "#### ", "#    ", "#    ", "#    "),
+    "Q": (" ### ", "#   #", "#   #", "#   #", "# # #", "#  # ", " ## #"),
+    "R": ("#### ", "#   #", "#   #", "#### ", "# #  ", "#  # ", "#   #"),
+    "S": (" ####", "#    ", "#    ", " ### ", "    #", "    #", "#### "),
+    "T": ("#####", "  #  ", "  #  ", "  #  ", "  #  ", "  #  ", "  #  "),
+    "U": ("#   #", "#   #", "#   #", "#   #", "#   #", "#   #", " ### "),
+    "V": ("#   #", "#   #", "#   #", "#   #", "#   #", " # # ", "  #  "),
+    "W": ("#   #", "#   #", "#   #", "# # #", "# # #", "# # #", " # # "),
+    "X": ("#   #", "#   #", " # # ", "  #  ", " # # ", "#   #", "#   #"),
+    "Y": ("#   #", "#   #", " # # ", "  #  ", "  #  ", "  #  ", "  #  "),
+    "Z": ("#####", "    #", "   # ", "  #  ", " #   ", "#    ", "#####"),
+    "0": (" ### ", "#   #", "#  ##", "# # #", "##  #", "#   #", " ### "),
+    "1": ("  #  ", " ##  ", "  #  ", "  #  ", "  #  ", "  #  ", " ### "),
+    "2": (" ### ", "#   #", "    #", "   # ", "  #  ", " #   ", "#####"),
+    "3": ("#####", "   # ", "  #  ", "   # ", "    #", "#   #", " ### "),
+    "4": ("   # ", "  ## ", " # # ", "#  # ", "#####", "   # ", "   # "),
+    "5": ("#####", "#    ", "#### ", "    #", "    #", "#   #", " ### "),
+    "6": ("  ## ", " #   ", "#    ", "#### ", "#   #", "#   #", " ### "),
+    "7": ("#####", "    #", "   # ", "  #  ", " #   ", " #   ", " #   "),
+    "8": (" ### ", "#   #", "#   #", " ### ", "#   #", "#   #", " ### "),
+    "9": (" ### ", "#   #", "#   #", " ####", "    #", "   # ", " ##  "),
+    " ": ("     ",) * 7,
+    "%": ("##   ", "##  #", "   # ", "  #  ", " #   ", "#  ##", "   ##"),
+    "-": ("     ", "     ", "     ", "#####", "     ", "     ", "     "),
+    ".": ("     ", "     ", "     ", "     ", "     ", " ##  ", " ##  "),
+    ",": ("     ", "     ", "     ", "     ", " ##  ", "  #  ", " #   "),
+    ":": ("     ", " ##  ", " ##  ", "     ", " ##  ", " ##  ", "     "),
+    "/": ("     ", "    #", "   # ", "  #  ", " #   ", "#    ", "     "),
+    "+": ("     ", "  #  ", "  #  ", "#####", "  #  ", "  #  ", "     "),
+    "&": (" ##  ", "#  # ", "# #  ", " #   ", "# # #", "#  # ", " ## #"),
+    "'": ("  #  ", "  #  ", " #   ", "     ", "     ", "     ", "     "),
+    "!": ("  #  ", "  #  ", "  #  ", "  #  ", "  #  ", "     ", "  #  "),
+    "?": (" ### ", "#   #", "    #", "   # ", "  #  ", "     ", "  #  "),
+    "(": ("   # ", "  #  ", " #   ", " #   ", " #   ", "  #  ", "   # "),
+    ")": (" #   ", "  #  ", "   # ", "   # ", "   # ", "  #  ", " #   "),
+    "#": (" # # ", " # # ", "#####", " # # ", "#####", " # # ", " # # "),
+    "*": ("     ", "  #  ", "# # #", " ### ", "# # #", "  #  ", "     "),
+}
+GLYPH_WIDTH, GLYPH_HEIGHT, GLYPH_ADVANCE = 5, 7, 6
+
+
+def _row_runs(row: str) -> list:
+    runs, start = [], None
+    for i, pixel in enumerate(row + " "):
+        if pixel == "#" and start is None:
+            start = i
+        elif pixel != "#" and start is not None:
+            runs.append((start, i - start))
+            start = None
+    return runs
+
+
+# glyph -> per row, (start, length) runs of lit pixels
+_GLYPHS = {char: [_row_runs(row) for row in rows] for char, rows in _GLYPH_ROWS.items()}
+
+
+def palette(domain: str) -> dict:
+    """Deterministic colour scheme for a domain."""
+    hue = int(hashlib.sha256(domain.lower().encode()).hexdigest()[:4], 16) / 0xFFFF
+
+    def rgb(h, s, v):
+        return tuple(int(c * 255) for c in colorsys.hsv_to_rgb(h % 1.0, s, v))
+
+    return {
+        "top": rgb(hue, 0.75, 0.35),
+        "bottom": rgb(hue + 0.08, 0.85, 0.12),
+        "accent": rgb(hue + 0.5, 0.55, 1.0),
+        "panel": rgb(hue, 0.45, 0.55),
+        "track": rgb(hue, 0.35, 0.25),
+        "text": (255, 255, 255),
+        "muted": rgb(hue, 0.15, 0.85),
+    }
+
+
+class Canvas:
+    """RGB raster kept as one bytearray per row, so fills are slice assignments."""
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.rows = [bytearray(width * 3) for _ in range(height)]
+
+    def gradient(self, top: tuple, bottom: tuple):
+        span = max(self.height - 1, 1)
+        for y, row in enumerate(self.rows):
+            t = y / span
+            pixel = bytes(int(a + (b - a) * t) for a, b in zip(top, bottom))
+            row[:] = pixel * self.width
+
+    def rect(self, x: int, y: int, w: int, h: int, color: tuple):
+        x0, x1 = max(int(x), 0), min(int(x + w), self.width)
+        if x1 <= x0:
+            return
+        fill = bytes(color) * (x1 - x0)
+        for row in self.rows[max(int(y), 0):min(int(y + h), self.height)]:
+            row[x0 * 3:x1 * 3] = fill
+
+    def frame(self, inset: int, thickness: int, color: tuple):
+        w, h = self.width - 2 * inset, self.height - 2 * inset
+        self.rect(inset, inset, w, thickness, color)
+        self.rect(inset, inset + h - thickness, w, thickness, color)
+        self.rect(inset, inset, thickness, h, color)
+        self.rect(inset + w - thickness, inset, thickness, h, color)
+
+    def disc(self, cx: int, cy: int, radius: int, color: tuple):
+        for dy in range(-radius, radius + 1):
+            half = int((radius * radius - dy * dy) ** 0.5)
+            self.rect(cx - half, cy + dy, 2 * half + 1, 1, color)
+
+    def bar(self, x: int, y: int, w: int, h: int, fraction: float, track: tuple, fill: tuple):
+        self.rect(x, y, w, h, track)
+        self.rect(x, y, int(w * min(max(fraction, 0.0), 1.0)), h, fill)
+
+    @staticmethod
+    def text_width(text: str, scale: int) -> int:
+        return max(len(text) * GLYPH_ADVANCE - 1, 0) * scale
+
+    def fit_scale(self, text: str, max_width: int, max_scale: int) -> int:
+        return max(1, min(max_scale, max_width // max(self.text_width(text, 1), 1)))
+
+    def text(self, x: int, y: int, text: str, scale: int, color: tuple, align: str = "left"):
+        text = text.upper()
+        if align == "center":
+            x -= self.text_width(text, scale) // 2
+        elif align == "right":
+            x -= self.text_width(text, scale)
+        for i, char in enumerate(text):
+            glyph = _GLYPHS.get(char, _GLYPHS["?"])
+            gx = x + i * GLYPH_ADVANCE * scale
+            for gy, runs in enumerate(glyph):
+                for start, length in runs:
+                    self.rect(gx + start * scale, y + gy * scale, length * scale, scale, color)
+
+    def fitted_text(self, cx: int, y: int, text: str, max_width: int, max_scale: int, color: tuple) -> int:
+        """Centered text shrunk to fit; returns the height used."""
+        scale = self.fit_scale(text, max_width, max_scale)
+        self.text(cx, y, text, scale, color, align="center")
+        return GLYPH_HEIGHT * scale
+
+    def to_png(self, level: int = 6) -> bytes:
+        raw = b"".join(b"\x00" + bytes(row) for row in self.rows)
+
+        def chunk(kind: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, level))
+            + chunk(b"IEND", b"")
+        )
+
+
+def _medallion(canvas: Canvas, cx: int, cy: int, radius: int, score: int, colors: dict):
+    canvas.disc(cx, cy, radius, colors["accent"])
+    canvas.disc(cx, cy, int(radius * 0.86), colors["panel"])
+    label = f"{score}%"
+    scale = canvas.fit_scale(label, int(radius * 1.4), radius // 8)
+    canvas.text(cx, cy - GLYPH_HEIGHT * scale // 2, label, scale, colors["text"], align="center")
+
+
+def render_badge(domain: str, score: int, node_count: int, concepts: list, format: str = "square") -> bytes:
+    """Render a badge as PNG bytes; unknown formats fall back to square."""
+    width, height = BADGE_FORMATS.get(format, BADGE_FORMATS["square"])
+    colors = palette(domain)
+    canvas = Canvas(width, height)
+    canvas.gradient(colors["top"], colors["bottom"])
+
+    unit = min(width, height)
+    margin = unit // 20
+    canvas.frame(margin // 2, max(unit // 128, 2), colors["accent"])
+    score = max(0, min(int(score), 100))
+    title = domain or "Web3"
+    concepts = [str(c) for c in (concepts or [])]
+    nodes = f"{node_count} concepts captured"
+    inner = width - 4 * margin
+
+    if format == "certificate":
+        canvas.frame(margin, max(unit // 256, 1), colors["muted"])
+        y = margin * 3
+        y += canvas.fitted_text(width // 2, y, "Certificate of Achievement", inner, unit // 60, colors["muted"]) + margin
+        y += canvas.fitted_text(width // 2, y, title, inner, unit // 30, colors["text"]) + margin
+        y += canvas.fitted_text(width // 2, y, f"Mastery score {score}%", inner, unit // 60, colors["accent"]) + margin
+        canvas.bar(width // 4, y, width // 2, unit // 40, score / 100, colors["track"], colors["accent"])
+        y += unit // 40 + margin
+        if concepts:
+            y += canvas.fitted_text(width // 2, y, " / ".join(concepts[:4]), inner, unit // 90, colors["text"]) + margin // 2
+        canvas.fitted_text(width // 2, y, nodes, inner, unit // 120, colors["muted"])
+    elif format in ("poster", "banner"):
+        radius = int(height * (0.3 if format == "poster" else 0.36))
+        cx = margin * 2 + radius
+        _medallion(canvas, cx, height // 2, radius, score, colors)
+        left = cx + radius + margin
+        block = width - left - margin * 2
+        lines = [(title, unit // 14, colors["text"]), (" / ".join(concepts[:4]), unit // 36, colors["muted"])]
+        if format == "poster":
+            lines.append((nodes, unit // 48, colors["muted"]))
+        heights = [GLYPH_HEIGHT * canvas.fit_scale(text, block, scale) for text, scale, _ in lines if text]
+        bar_height = unit // 24
+        y = (height - sum(heights) - bar_height - margin * len(heights)) // 2
+        for text, scale, color in lines[:1]:
+            scale = canvas.fit_scale(text, block, scale)
+            canvas.text(left, y, text, scale, color)
+            y += GLYPH_HEIGHT * scale + margin // 2
+        canvas.bar(left, y, block, bar_height, score / 100, colors["track"], colors["accent"])
+        y += bar_height + margin // 2
+        for text, scale, color in lines[1:]:
+            if text:
+                scale = canvas.fit_scale(text, block, scale)
+                canvas.text(left, y, text, scale, color)
+                y += GLYPH_HEIGHT * scale + margin // 2
+    else:
+        # square and story: centered medallion with the title above and concepts below,
+        # each element in a fixed vertical band (fractions of the height)
+        story = format == "story"
+
+        def band(fraction: float) -> int:
+            return max(int(height * fraction) // GLYPH_HEIGHT, 1)
+
+        canvas.fitted_text(width // 2, int(height * 0.07), title, inner, band(0.07 if story else 0.11), colors["text"])
+        radius = int(unit * (0.3 if story else 0.2))
+        center = int(height * (0.3 if story else 0.44))
+        _medallion(canvas, width // 2, center, radius, score, colors)
+        y = center + radius + margin
+        y += canvas.fitted_text(width // 2, y, "Mastery", inner, band(0.035 if story else 0.05), colors["accent"]) + margin
+        if story:
+            for concept in concepts[:5]:
+                y += canvas.fitted_text(width // 2, y, concept, inner, band(0.03), colors["text"]) + margin // 2
+        elif concepts:
+            canvas.fitted_text(width // 2, y, " / ".join(concepts[:3]), inner, band(0.035), colors["text"])
+        canvas.fitted_text(width // 2, int(height * 0.9), nodes, inner, band(0.025 if story else 0.03), colors["muted"])
+
+    return canvas.to_png()
@@ -1,7 +1,29 @@
 import os
+import re
+import sys
+import gzip
 import json
-from uuid import uuid4
+import queue
+import atexit
+import base64
+import math
+import random
+import secrets
+import sqlite3
+import tempfile
+import asyncio
+import logging
+import threading
+import itertools
+import subprocess
+import functools
+import contextvars
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
 import time
 
 from uagents import Agent, Context, Protocol, Model
@@ -26,8 +48,156 @@ import requests
 from hyperon import MeTTa
 from dotenv import load_dotenv
 
+from badge_renderer import BADGE_FORMATS, RENDERER_VERSION, render_badge
+
 load_dotenv()
 
+# Optional fast JSON backend for LLM responses
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# ======= STRUCTURED LOGGING =======
+LOG_PATH = os.environ.get("LOG_PATH")  # JSON lines are appended here; stdout when unset
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.5"))  # max seconds a record waits for its batch
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "512"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))  # a full queue drops records instead of blocking
+
+
+def _parse_log_settings(value: str, cast) -> dict:
+    """"metta=WARNING,rest=0.1" -> {"metta": "WARNING", "rest": 0.1}"""
+    settings = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        category, _, setting = item.partition("=")
+        settings[category.strip()] = cast(setting.strip())
+    return settings
+
+
+# Per-category level overrides, e.g. LOG_LEVELS="metta=DEBUG,supabase=WARNING"
+LOG_LEVELS = _parse_log_settings(os.environ.get("LOG_LEVELS", ""), str.upper)
+# Records per second per (category, event); the excess is dropped and counted
+LOG_RATE_LIMITS = _parse_log_settings(os.environ.get("LOG_RATE_LIMITS", "metta=20,supabase=50,rest=200"), int)
+# Fraction of below-warning records kept per category, e.g. LOG_SAMPLE="rest=0.1"
+LOG_SAMPLE = _parse_log_settings(os.environ.get("LOG_SAMPLE", ""), float)
+
+# Id of the REST request (or job) being handled; copied into tasks it spawns
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+
+class StructuredLog:
+    """
+    JSON-lines event log that costs the caller a level check and a queue put.
+    Records go on a bounded queue (a full queue drops them, it never blocks), and a
+    daemon thread serializes and writes them in batches of up to LOG_BATCH_SIZE,
+    at least every LOG_FLUSH_INTERVAL seconds. Levels are set per category. Chatty
+    categories are sampled and rate-limited per event. The next record that gets
+    through says how many were suppressed.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.level = self._level(LOG_LEVEL)
+        self.levels = {category: self._level(level) for category, level in LOG_LEVELS.items()}
+        self.stats = {"written": 0, "dropped": 0, "suppressed": 0, "sampled_out": 0, "batches": 0}
+        self._windows = {}  # (category, event) -> [window start, emitted, suppressed]
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._drain, name="log-writer", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _level(name: str) -> int:
+        level = logging.getLevelName(name)
+        return level if isinstance(level, int) else logging.INFO
+
+    def enabled(self, category: str, level: int) -> bool:
+        return level >= self.levels.get(category, self.level)
+
+    def log(self, level: int, category: str, event: str, **fields):
+        if not self.enabled(category, level):
+            return
+        sample = LOG_SAMPLE.get(category)
+        if sample is not None and level < logging.WARNING and random.random() >= sample:
+            self.stats["sampled_out"] += 1
+            return
+
+        suppressed = 0
+        limit = LOG_RATE_LIMITS.get(category)
+        if limit:
+            now = time.monotonic()
+            window = self._windows.get((category, event))
+            if window is None or now - window[0] >= 1.0:
+                suppressed = window[2] if window else 0
+                window = self._windows[(category, event)] = [now, 0, 0]
+            if window[1] >= limit:
+                window[2] += 1
+                self.stats["suppressed"] += 1
+                return
+            window[1] += 1
+
+        record = {"ts": time.time(), "level": logging.getLevelName(level), "cat": category, "event": event}
+        request_id = request_id_var.get()
+        if request_id:
+            record["request_id"] = request_id
+        if suppressed:
+            record["suppressed"] = suppressed
+        record.update(fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def debug(self, category: str, event: str, **fields):
+        self.log(logging.DEBUG, category, event, **fields)
+
+    def info(self, category: str, event: str, **fields):
+        self.log(logging.INFO, category, event, **fields)
+
+    def warning(self, category: str, event: str, **fields):
+        self.log(logging.WARNING, category, event, **fields)
+
+    def error(self, category: str, event: str, **fields):
+        self.log(logging.ERROR, category, event, **fields)
+
+    def _drain(self):
+        out = open(self.path, "a", encoding="utf-8") if self.path else sys.stdout
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while batch[-1] is not None and len(batch) < LOG_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            records = batch[:-1] if closing else batch
+            if records:
+                out.write("".join(json.dumps(r, default=str, ensure_ascii=False) + "\n" for r in records))
+                out.flush()
+                self.stats["written"] += len(records)
+                self.stats["batches"] += 1
+            if closing:
+                return
+
+    def close(self, timeout: float = 2.0):
+        """Write out everything queued so far (called on shutdown and at exit)."""
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+
+log = StructuredLog(LOG_PATH)
+atexit.register(log.close)
+
+
 # Supabase imports
 try:
     from supabase import create_client, Client
@@ -54,6 +224,29 @@ if SUPABASE_AVAILABLE and SUPABASE_URL and SUPABASE_KEY:
 else:
     print("⚠️  Supabase not configured (optional)")
 
+# ======= DEPLOYMENT MODE =======
+# standalone: one process (default)
+# coordinator: mailbox + chat protocol, front proxy on AGENT_PORT, supervises workers
+#              (also used with 0 workers when ADMISSION_CONTROL=1)
+# worker: serves the REST endpoints on its own port behind the coordinator
+AGENT_PORT = int(os.environ.get("AGENT_PORT", "8010"))
+AGENT_WORKERS = int(os.environ.get("AGENT_WORKERS", "0"))
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1" if AGENT_WORKERS > 0 else "0") == "1"
+AGENT_ROLE = os.environ.get("AGENT_ROLE") or (
+    "coordinator" if AGENT_WORKERS > 0 or ADMISSION_CONTROL else "standalone"
+)
+AGENT_WORKER_INDEX = int(os.environ.get("AGENT_WORKER_INDEX", "0"))
+
+WORKER_PORTS = [AGENT_PORT + 1 + i for i in range(AGENT_WORKERS)]
+COORDINATOR_PORT = AGENT_PORT + AGENT_WORKERS + 1
+
+# Shared knowledge-graph ingest log; every process replays it into its own MeTTa replica
+KG_LOG_PATH = os.environ.get("KG_LOG_PATH") or (
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "kg_ingest_log.db")
+    if AGENT_WORKERS > 0 else None
+)
+KG_SYNC_INTERVAL = float(os.environ.get("KG_SYNC_INTERVAL", "0.5"))
+
 # ======= REST API MODELS =======
 class SentenceRequest(Model):
     sentence: str
@@ -104,6 +297,46 @@ class QuizGenerationResponse(Model):
     cluster: str
     difficulty: int
     timestamp: int
+    source: str = "pool"  # pool (pre-generated), glossary or fallback
+
+class JobQueueMetricsResponse(Model):
+    depth: int
+    running: int
+    dead: int
+    oldest_age_seconds: float
+    completed: int
+    retried: int
+    failed: int
+    workers: int
+    timestamp: int
+    purged: int = 0  # dead jobs dropped by retention
+
+class KgMetricsResponse(Model):
+    atoms: int
+    concepts: int
+    relations: int
+    pinned: int
+    tombstones: int
+    max_atoms: int
+    atom_budget: int
+    low_watermark: int
+    rss_mb: float  # -1 where unavailable
+    memory_high_mb: float
+    ttl_seconds: float
+    runs: int
+    expired: int
+    evicted: int
+    compacted: int
+    last_run: float
+    writer: dict  # {batches, ops, added, removed, failed, queued}
+    last_trigger: str = ""
+
+class LlmMetricsResponse(Model):
+    structured_output: dict  # {model: {shape: {total, repaired, invalid, failed, failure_rate}}}
+    explanation_cache: dict  # {local, composed, llm, learned, glossary_hits, learned_hits, terms, entries}
+    quiz_pools: dict  # {served, pool_hits, glossary, fallback, generated, duplicates, refills, pools, ready, refilling}
+    routing: dict  # {enabled, decisions: {task: n}, routes: {"task:model:variant": {calls, mean_latency_ms, budget_saved, ...}}}
+    timestamp: int
 
 class BadgeImageRequest(Model):
     domain: str
@@ -111,16 +344,450 @@ class BadgeImageRequest(Model):
     node_count: int
     concepts: list = []  # User's captured concepts
     format: str = "square"  # square, story, certificate, poster, banner
+    ai_upgrade: bool = False  # also generate an AI image in the background
+    inline: bool = False  # also return the PNG base64 encoded in image_data
 
 class BadgeImageResponse(Model):
-    image_data: str  # base64 encoded
+    image_data: str  # base64 encoded PNG when the request set `inline` or no BADGE_PUBLIC_URL is set, else ""
     prompt_used: str
     generation_time: float
     timestamp: int
+    source: str = "local"  # local (template renderer) or ai
+    upgrade_pending: bool = False  # an AI image is being generated; repeat the request to get it
+    image_id: str = ""  # sha256 of the PNG
+    image_url: str = ""  # GET on the streaming port returns the PNG; "" without BADGE_PUBLIC_URL
+    size: int = 0  # PNG size in bytes
+
+class GraphChangesRequest(Model):
+    user_id: str
+    since: int = 0  # `version` from the previous response; 0 for a full sync
+    limit: int = 1000  # max changes per response
+
+class GraphChangesResponse(Model):
+    version: int  # send back as `since` on the next sync
+    nodes: list  # changed or new node rows
+    edges: list
+    insights: list
+    deleted: dict  # {nodes: [id], edges: [id], insights: [id]}
+    has_more: bool = False  # more changes after `version`; sync again right away
+    reset: bool = False  # full sync: replace local state instead of merging
+    error: str = ""
+
+# ======= TERM CANONICALIZATION =======
+GLOSSARY_PATH = os.environ.get(
+    "GLOSSARY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extension", "public", "glossary.json")
+)
+
+# Common abbreviations/spellings that should collapse onto one node
+TERM_ALIASES = {
+    "L2": "Layer 2",
+    "Layer Two": "Layer 2",
+    "L1": "Layer 1",
+    "AA": "Account Abstraction",
+    "ETH": "Ethereum",
+    "Automated Market Maker": "AMM",
+    "Decentralized Exchange": "DEX",
+    "Externally Owned Account": "EOA",
+    "Zero Knowledge Proof": "ZK Proof",
+}
+
+# "Decentralized Finance - a blockchain-based ..." -> alias "Decentralized Finance"
+_GLOSSARY_EXPANSION_RE = re.compile(r"^([A-Z][A-Za-z0-9]*(?:[ -][A-Z][A-Za-z0-9]*)+) - ")
+
+
+class TermDictionary:
+    """
+    Interned term table shared by the MeTTa graph, the indexes, caches and exports.
+    Surface forms are folded (case, punctuation, spacing, plurals) to a key; each key
+    maps to a compact integer id, and each id to one interned MeTTa symbol.
+    """
+
+    def __init__(self):
+        self._ids = {}      # folded key (or alias key) -> id
+        self._symbols = []  # id -> symbol
+
+    @staticmethod
+    def fold(term: str) -> str:
+        """"ERC-4337", "erc 4337" and "ERC4337" all fold to "erc4337"."""
+        key = re.sub(r"[^a-z0-9]+", "", str(term).lower())
+        if len(key) > 4 and key.endswith("ies"):
+            key = key[:-3] + "y"
+        elif len(key) > 3 and key.endswith("s") and not key.endswith(("ss", "us", "is")):
+            key = key[:-1]
+        return key
+
+    @staticmethod
+    def to_symbol(term: str) -> str:
+        symbol = re.sub(r"[^a-z0-9]+", "_", str(term).lower()).strip("_")
+        return sys.intern(symbol or "unknown")
+
+    def intern(self, term: str) -> int:
+        key = self.fold(term)
+        term_id = self._ids.get(key)
+        if term_id is None:
+            term_id = len(self._symbols)
+            self._symbols.append(self.to_symbol(term))
+            self._ids[key] = term_id
+        return term_id
+
+    def lookup(self, term: str):
+        """Id for a term if it has been seen, without interning it."""
+        return self._ids.get(self.fold(term))
+
+    def add_alias(self, alias: str, canonical: str) -> int:
+        term_id = self.intern(canonical)
+        self._ids.setdefault(self.fold(alias), term_id)
+        return term_id
+
+    def symbol(self, term_id: int) -> str:
+        return self._symbols[term_id]
+
+    def canonical(self, term: str) -> str:
+        return self._symbols[self.intern(term)]
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+term_dict = TermDictionary()
+
+
+def read_glossary(path: str = GLOSSARY_PATH) -> list:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Glossary not loaded ({e}), using built-in aliases only")
+        return []
+
+
+def glossary_definitions(entry: dict) -> dict:
+    """Context -> definition for an entry in either glossary shape (definitions map or single definition)."""
+    definitions = entry.get("definitions") or {}
+    if entry.get("definition"):
+        definitions = {**definitions, "General": entry["definition"]}
+    return definitions
+
+
+def load_glossary_synonyms(glossary: list) -> int:
+    """Seed the term dictionary with glossary terms, their aliases and spelled-out acronyms."""
+    for entry in glossary:
+        term = entry.get("term")
+        if not term:
+            continue
+        term_dict.intern(term)
+        for alias in entry.get("aliases", []):
+            term_dict.add_alias(alias, term)
+
+        for definition in glossary_definitions(entry).values():
+            m = _GLOSSARY_EXPANSION_RE.match(definition or "")
+            if m:
+                term_dict.add_alias(m.group(1), term)
+
+    for alias, canonical in TERM_ALIASES.items():
+        term_dict.add_alias(alias, canonical)
+
+    return len(term_dict)
+
+
+glossary_entries = read_glossary()
+load_glossary_synonyms(glossary_entries)
 
 # ======= METTA KNOWLEDGE GRAPH =======
 metta = MeTTa()
 
+
+class IndexedSymbol(str):
+    """String result from the index that prints like a MeTTa symbol (no quotes)."""
+
+    def __repr__(self):
+        return str(self)
+
+
+class KnowledgeGraphIndex:
+    """
+    Secondary indexes over the (concept ...) and (relation ...) atoms in the space.
+    Every write committed by kg_writer is mirrored here so the hot match patterns
+    can be answered without running the interpreter.
+    Rows are tuples of term_dict ids; `version` is bumped on every change and used
+    to invalidate cached query results.
+    concept_log/relation_log are append-only row lists (position = seq) that exports
+    page through; removed rows leave a None tombstone until compact_logs() rewrites
+    the logs, and `epoch` changes whenever they are rebuilt.
+    `recency` holds every row ordered from least to most recently added or matched,
+    with the time of that touch; retention expires and evicts from its front.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.epoch = 0
+        self.pinned = set()
+        self._clear()
+
+    def _clear(self):
+        # primary dicts map row -> seq; secondary dicts are insertion-ordered sets
+        self.concepts = {}
+        self.concept_log = []
+        self.concepts_by_term = defaultdict(dict)
+        self.concepts_by_context = defaultdict(dict)
+        self.relations = {}
+        self.relation_log = []
+        self.relations_by_predicate = defaultdict(dict)
+        self.relations_by_subject = defaultdict(dict)
+        self.relations_by_object = defaultdict(dict)
+        self.recency = {}
+        self.tombstones = 0
+        # Set when the index was rebuilt from the space, which may hold duplicate atoms
+        self.needs_dedupe = False
+
+    def reset(self):
+        self._clear()
+        self.version += 1
+        self.epoch += 1
+
+    def has_concept(self, term: int, context: int) -> bool:
+        return (term, context) in self.concepts
+
+    def has_relation(self, pred: int, subj: int, obj: int) -> bool:
+        return (pred, subj, obj) in self.relations
+
+    def size(self) -> int:
+        return len(self.concepts) + len(self.relations)
+
+    def touch(self, row: tuple, now: float = None):
+        """Mark a row as recently used (moves it to the back of `recency`)."""
+        if row in self.recency:
+            del self.recency[row]
+            self.recency[row] = now or time.time()
+
+    def pin_current(self):
+        """Exempt every row present now (the seed knowledge) from expiry and eviction."""
+        self.pinned.update(self.concepts, self.relations)
+
+    def add_concept(self, term: int, context: int):
+        key = (term, context)
+        self.concepts[key] = len(self.concept_log)
+        self.concept_log.append(key)
+        self.concepts_by_term[term][key] = None
+        self.concepts_by_context[context][key] = None
+        self.recency[key] = time.time()
+        self.version += 1
+
+    def add_relation(self, pred: int, subj: int, obj: int):
+        key = (pred, subj, obj)
+        self.relations[key] = len(self.relation_log)
+        self.relation_log.append(key)
+        self.relations_by_predicate[pred][key] = None
+        self.relations_by_subject[subj][key] = None
+        self.relations_by_object[obj][key] = None
+        self.recency[key] = time.time()
+        self.version += 1
+
+    @staticmethod
+    def _discard(index: dict, value: int, key: tuple):
+        rows = index.get(value)
+        if rows is not None:
+            rows.pop(key, None)
+            if not rows:
+                del index[value]
+
+    def remove(self, row: tuple):
+        """Drop a concept or relation row, leaving a tombstone in its log."""
+        if len(row) == 2:
+            seq = self.concepts.pop(row, None)
+            if seq is None:
+                return
+            self.concept_log[seq] = None
+            self._discard(self.concepts_by_term, row[0], row)
+            self._discard(self.concepts_by_context, row[1], row)
+        else:
+            seq = self.relations.pop(row, None)
+            if seq is None:
+                return
+            self.relation_log[seq] = None
+            self._discard(self.relations_by_predicate, row[0], row)
+            self._discard(self.relations_by_subject, row[1], row)
+            self._discard(self.relations_by_object, row[2], row)
+        self.recency.pop(row, None)
+        self.tombstones += 1
+        self.version += 1
+
+    def stale_rows(self, before: float) -> list:
+        """Unpinned rows not added or matched since `before`."""
+        stale = []
+        for row, touched in self.recency.items():
+            if touched >= before:
+                break
+            if row not in self.pinned:
+                stale.append(row)
+        return stale
+
+    def lru_rows(self, count: int) -> list:
+        """The `count` least recently used unpinned rows."""
+        return list(itertools.islice((row for row in self.recency if row not in self.pinned), count))
+
+    def compact_logs(self):
+        """Rewrite the export logs without tombstones (invalidates export cursors)."""
+        self.concept_log = [row for row in self.concept_log if row is not None]
+        self.relation_log = [row for row in self.relation_log if row is not None]
+        for seq, row in enumerate(self.concept_log):
+            self.concepts[row] = seq
+        for seq, row in enumerate(self.relation_log):
+            self.relations[row] = seq
+        self.tombstones = 0
+        self.epoch += 1
+
+    def match(self, kind: str, bound: list) -> list:
+        """
+        Return all (concept term ctx) / (relation pred subj obj) rows matching `bound`,
+        where each position is either a term id or None for a variable.
+        """
+        if kind == "concept":
+            term, context = bound
+            if term is not None and context is not None:
+                candidates = [(term, context)] if (term, context) in self.concepts else []
+            elif term is not None:
+                candidates = self.concepts_by_term.get(term, {})
+            elif context is not None:
+                candidates = self.concepts_by_context.get(context, {})
+            else:
+                candidates = self.concepts
+        else:
+            indexes = [
+                self.relations_by_predicate.get(bound[0], {}) if bound[0] is not None else None,
+                self.relations_by_subject.get(bound[1], {}) if bound[1] is not None else None,
+                self.relations_by_object.get(bound[2], {}) if bound[2] is not None else None,
+            ]
+            indexes = [index for index in indexes if index is not None]
+            candidates = min(indexes, key=len) if indexes else self.relations
+
+        return [
+            row for row in candidates
+            if all(value is None or value == row[i] for i, value in enumerate(bound))
+        ]
+
+
+kg_index = KnowledgeGraphIndex()
+
+# Memoized query results: normalized query -> (graph version, result)
+QUERY_CACHE_SIZE = 256
+_query_cache: OrderedDict = OrderedDict()
+
+# (match &self (concept|relation <args>) <$var | ($var ...)>)
+_FAST_MATCH_RE = re.compile(
+    r"^!\(match &self \((concept|relation) ([^()]+)\) (\$[^\s()]+|\((?:\$[^\s()]+ ?)+\))\)$"
+)
+_MUTATING_QUERY_RE = re.compile(r"\b(add-atom|remove-atom|bind!)\b")
+
+
+# Full scans of the space, one per atom kind
+_KG_SCAN_QUERIES = (
+    ("concept", "!(match &self (concept $x $ctx) ($x $ctx))"),
+    ("relation", "!(match &self (relation $p $s $o) ($p $s $o))"),
+)
+
+
+def rebuild_kg_index(scans: list = None):
+    """
+    Rebuild the secondary indexes from the MeTTa space (after seeding or raw writes).
+    `scans` holds (kind, result) for each of _KG_SCAN_QUERIES; without it the space is
+    scanned directly, which is only safe before the writer starts.
+    """
+    if scans is None:
+        scans = [(kind, metta.run(query)) for kind, query in _KG_SCAN_QUERIES]
+    kg_index.reset()
+    kg_index.needs_dedupe = True
+    for kind, results in scans:
+        for result in results:
+            for atom in result:
+                parts = [term_dict.intern(p) for p in str(atom).strip("()").split()]
+                # Raw writes can leave duplicate atoms in the space; index each row once
+                if kind == "concept" and len(parts) == 2 and not kg_index.has_concept(*parts):
+                    kg_index.add_concept(*parts)
+                elif kind == "relation" and len(parts) == 3 and not kg_index.has_relation(*parts):
+                    kg_index.add_relation(*parts)
+
+
+def normalize_metta_query(query: str) -> str:
+    """Canonical form of a query used as the cache key and for fast-path matching."""
+    query = re.sub(r"\s+", " ", query.strip())
+    query = re.sub(r"\(\s", "(", query)
+    query = re.sub(r"\s\)", ")", query)
+    if not query.startswith("!"):
+        query = f"!{query}"
+    return re.sub(r"^!\s+", "!", query)
+
+
+def answer_from_index(query: str):
+    """
+    Answer a normalized single-pattern concept/relation match from the index.
+    Returns None when the query is not one of the supported shapes.
+    """
+    m = _FAST_MATCH_RE.match(query)
+    if not m:
+        return None
+
+    kind, args, template = m.groups()
+    args = args.split()
+    if len(args) != (2 if kind == "concept" else 3):
+        return None
+
+    variables = [a for a in args if a.startswith("$")]
+    if len(set(variables)) != len(variables):
+        return None
+    template_vars = template.strip("()").split()
+    if any(v not in variables for v in template_vars):
+        return None
+
+    bound = [None if a.startswith("$") else term_dict.lookup(a) for a in args]
+    if any(b is None and not a.startswith("$") for a, b in zip(args, bound)):
+        # A literal that was never interned cannot match anything
+        return [[]]
+    positions = [args.index(v) for v in template_vars]
+    results = []
+    # Only lookups that name a term count as use; full scans would refresh every row
+    touch = any(b is not None for b in bound)
+    now = time.time()
+    for row in kg_index.match(kind, bound):
+        if touch:
+            kg_index.touch(row, now)
+        values = [term_dict.symbol(row[i]) for i in positions]
+        if template.startswith("("):
+            results.append(IndexedSymbol(f"({' '.join(values)})"))
+        else:
+            results.append(IndexedSymbol(values[0]))
+    return [results]
+
+
+async def cached_metta_query(query: str):
+    """
+    Run a MeTTa query, memoized per normalized query and graph version.
+    Common match patterns are served from the secondary indexes on the event loop;
+    anything else runs on the MeTTa thread, and raw writes go through kg_writer.
+    """
+    normalized = normalize_metta_query(query)
+
+    version = kg_index.version
+    cached = _query_cache.get(normalized)
+    if cached and cached[0] == version:
+        _query_cache.move_to_end(normalized)
+        return cached[1]
+
+    result = answer_from_index(normalized)
+    if result is None:
+        if _MUTATING_QUERY_RE.search(normalized):
+            # Raw writes bypass the index; the writer resyncs it, and the result is not cached
+            return await kg_writer.submit("query", normalized)
+        # The space is at least as new as `version` here (the index lags the space, never leads it)
+        result = await run_metta(normalized)
+
+    _query_cache[normalized] = (version, result)
+    if len(_query_cache) > QUERY_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+    return result
+
+
 # Seed initial Web3 knowledge
 initial_kg = """
     (concept erc4337 account_abstraction)
@@ -129,47 +796,1143 @@ initial_kg = """
     (relation involved erc4337 relayer)
 """
 metta.run(initial_kg)
+rebuild_kg_index()
+kg_index.pin_current()
 
-# ======= HELPER FUNCTIONS =======
 
-def validate_and_parse_json(response_text: str, default_value: dict) -> dict:
+# ======= GRAPH ACCESS LAYER =======
+KG_WRITE_BATCH = int(os.environ.get("KG_WRITE_BATCH", "256"))  # queued writes committed per interpreter call
+
+# hyperon's MeTTa is not thread-safe, so all interpreter work runs on this one thread:
+# off the event loop, and serialized with the writer's commits
+metta_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metta")
+
+
+async def run_metta(program: str):
+    return await asyncio.get_running_loop().run_in_executor(metta_executor, metta.run, program)
+
+
+def kg_row_atom(row: tuple) -> str:
+    kind = "concept" if len(row) == 2 else "relation"
+    return f"({kind} {' '.join(term_dict.symbol(i) for i in row)})"
+
+
+def analysis_rows(analysis: dict) -> list:
+    """The concept and relation rows an extraction result writes (terms canonicalized)."""
+    context_id = term_dict.intern(analysis.get("context", "General"))
+    rows = [(term_dict.intern(term), context_id) for term in analysis.get("terms", [])]
+    rows += [
+        (term_dict.intern(rel[1]), term_dict.intern(rel[0]), term_dict.intern(rel[2]))
+        for rel in analysis.get("relations", []) if len(rel) >= 3
+    ]
+    return rows
+
+
+class KnowledgeGraphWriter:
     """
-    Validate and parse JSON response from ASI:One.
-    Returns default_value if parsing fails.
+    Single writer for the MeTTa space. Writes are queued as operations:
+    ("analysis", extraction dict) and ("remove", [row]) are batched, while
+    ("query", raw program) and ("dedupe", None) run on their own.
+    One task drains the queue and commits each batch as a single interpreter
+    program on the MeTTa thread. Only then does it apply the batch to kg_index,
+    in one event-loop step. Readers on the loop therefore always see a committed
+    version, never a half-applied batch, and the index never runs ahead of the space.
     """
-    try:
-        # Try direct JSON parse first
-        return json.loads(response_text)
-    except json.JSONDecodeError:
-        # Try to extract JSON from markdown code blocks
-        json_start = response_text.find("{")
-        json_end = response_text.rfind("}") + 1
-        if json_start != -1 and json_end > json_start:
+
+    def __init__(self, batch_size: int = KG_WRITE_BATCH):
+        self.batch_size = batch_size
+        self._pending = deque()  # (kind, payload, future)
+        self._inflight = []
+        self._wakeup = None
+        self._task = None
+        self._loop = None
+        self.stats = {"batches": 0, "ops": 0, "added": 0, "removed": 0, "failed": 0}
+
+    def submit(self, kind: str, payload) -> asyncio.Future:
+        """Queue a write; the future resolves once it is committed (starts the writer lazily)."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run(), name="kg-writer")
+        future = loop.create_future()
+        self._pending.append((kind, payload, future))
+        self._wakeup.set()
+        return future
+
+    async def flush(self):
+        """Wait until everything queued so far is committed."""
+        futures = [op[2] for op in self._pending] + self._inflight
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    async def stop(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = [self._pending.popleft()]
+            if batch[0][0] in ("analysis", "remove"):
+                while self._pending and len(batch) < self.batch_size \
+                        and self._pending[0][0] in ("analysis", "remove"):
+                    batch.append(self._pending.popleft())
+            self._inflight = [op[2] for op in batch]
             try:
-                return json.loads(response_text[json_start:json_end])
-            except json.JSONDecodeError:
-                pass
-        return default_value
+                if len(batch) == 1 and batch[0][0] not in ("analysis", "remove"):
+                    kind, payload, future = batch[0]
+                    try:
+                        self._resolve(future, await self._exclusive(kind, payload))
+                    except Exception as e:
+                        self.stats["failed"] += 1
+                        self._fail(future, e)
+                else:
+                    await self._commit(batch)
+            finally:
+                self._inflight = []
+            self.stats["batches"] += 1
+            self.stats["ops"] += len(batch)
 
-def extract_concepts_llm(text: str):
-    """Use ASI:One asi1-mini to extract Web3 concepts with structured output."""
+    @staticmethod
+    def _resolve(future: asyncio.Future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def _fail(future: asyncio.Future, error: Exception):
+        if not future.done():
+            future.set_exception(error)
+
+    async def _commit(self, batch: list):
+        lines, changes, results = [], [], []
+        staged = {}  # row -> present after this batch
+
+        def present(row: tuple) -> bool:
+            if row in staged:
+                return staged[row]
+            return row in (kg_index.concepts if len(row) == 2 else kg_index.relations)
+
+        for kind, payload, _ in batch:
+            if kind == "analysis":
+                added = []
+                for row in analysis_rows(payload):
+                    if present(row):
+                        kg_index.touch(row)
+                        continue
+                    staged[row] = True
+                    lines.append(kg_row_atom(row))
+                    changes.append(row)
+                    added.append(lines[-1])
+                results.append(added)
+            else:
+                removed = 0
+                for row in payload:
+                    if not present(row):
+                        continue
+                    staged[row] = False
+                    lines.append(f"!(remove-atom &self {kg_row_atom(row)})")
+                    changes.append(row)
+                    removed += 1
+                results.append(removed)
+
+        try:
+            if lines:
+                await run_metta("\n".join(lines))
+        except Exception as e:
+            if len(batch) > 1:
+                # Commit one by one so a single bad write does not take the batch down
+                for op in batch:
+                    await self._commit([op])
+                return
+            self.stats["failed"] += 1
+            self._fail(batch[0][2], e)
+            return
+
+        for row, line in zip(changes, lines):
+            if line.startswith("!"):
+                kg_index.remove(row)
+                self.stats["removed"] += 1
+            else:
+                (kg_index.add_concept if len(row) == 2 else kg_index.add_relation)(*row)
+                self.stats["added"] += 1
+        for (_, _, future), result in zip(batch, results):
+            self._resolve(future, result)
+
+    async def _exclusive(self, kind: str, payload):
+        if kind == "query":
+            result = await run_metta(payload)
+            # Raw writes bypass the index, so resync it from the space
+            rebuild_kg_index([(k, await run_metta(query)) for k, query in _KG_SCAN_QUERIES])
+            return result
+
+        # "dedupe": collapse duplicate atoms that raw writes left in the space
+        duplicates = []
+        for k, query in _KG_SCAN_QUERIES:
+            seen = set()
+            for result in await run_metta(query):
+                for atom in result:
+                    atom = str(atom)
+                    if atom in seen:
+                        duplicates.append(f"!(remove-atom &self ({k} {atom.strip('()')}))")
+                    seen.add(atom)
+        if duplicates:
+            # remove-atom drops one copy per call, so this leaves exactly one of each
+            await run_metta("\n".join(duplicates))
+        return len(duplicates)
+
+    def metrics(self) -> dict:
+        return {**self.stats, "queued": len(self._pending) + len(self._inflight)}
+
+
+kg_writer = KnowledgeGraphWriter()
+
+
+# ======= KNOWLEDGE GRAPH RETENTION =======
+KG_ATOM_TTL = float(os.environ.get("KG_ATOM_TTL", "0"))  # seconds since last add/match; 0 keeps atoms forever
+KG_MAX_ATOMS = int(os.environ.get("KG_MAX_ATOMS", "200000"))  # high-water mark for concepts + relations
+KG_LOW_WATERMARK = float(os.environ.get("KG_LOW_WATERMARK", "0.8"))  # evict down to this fraction of the cap
+KG_MEMORY_HIGH_MB = float(os.environ.get("KG_MEMORY_HIGH_MB", "0"))  # process RSS high-water mark; 0 disables
+KG_ORPHAN_MIN_AGE = float(os.environ.get("KG_ORPHAN_MIN_AGE", "3600"))
+KG_RETENTION_INTERVAL = float(os.environ.get("KG_RETENTION_INTERVAL", "60"))
+
+retention_stats = {"runs": 0, "expired": 0, "evicted": 0, "compacted": 0, "last_run": 0.0, "last_trigger": ""}
+# Atom cap learned from memory pressure: RSS rarely shrinks after eviction, so once the
+# memory watermark fires the space is held at the size it was evicted down to
+_memory_atom_cap = None
+_retention_lock = asyncio.Lock()
+
+
+def process_rss_mb():
+    """Resident set size of this process in MB, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def kg_atom_budget() -> int:
+    return KG_MAX_ATOMS if _memory_atom_cap is None else min(KG_MAX_ATOMS, _memory_atom_cap)
+
+
+async def remove_kg_rows(rows: list) -> int:
+    """
+    Remove rows from the MeTTa space and the index (one writer commit). When the graph
+    is replicated the removal goes through kg_log, so every replica drops the same rows.
+    """
+    if not rows:
+        return 0
+    if kg_log is None:
+        return await kg_writer.submit("remove", rows)
+    kg_log.append_removal(rows)
+    await kg_log.apply_pending()
+    return len(rows)
+
+
+async def compact_kg(now: float) -> int:
+    """
+    Drop low-value relations (self-loops, and relations whose subject and object no
+    longer name any concept once they are KG_ORPHAN_MIN_AGE old) and, after a rebuild,
+    collapse duplicate atoms that raw writes left in the space. Returns atoms removed.
+    """
+    low_value = []
+    for row in kg_index.relations:
+        if row in kg_index.pinned:
+            continue
+        if row[1] == row[2]:
+            low_value.append(row)
+        elif row[1] not in kg_index.concepts_by_term and row[2] not in kg_index.concepts_by_term \
+                and kg_index.recency[row] < now - KG_ORPHAN_MIN_AGE:
+            low_value.append(row)
+    removed = await remove_kg_rows(low_value)
+    return removed + await dedupe_kg()
+
+
+async def dedupe_kg() -> int:
+    """After a rebuild, collapse duplicate atoms raw writes left in this process's space."""
+    if not kg_index.needs_dedupe:
+        return 0
+    kg_index.needs_dedupe = False
+    return await kg_writer.submit("dedupe", None)
+
+
+async def run_kg_retention(trigger: str = "interval") -> dict:
+    """
+    Expire atoms past KG_ATOM_TTL, compact, and evict least recently used atoms when
+    the space or process memory is over its high-water mark. Returns what was removed.
+    Worker replicas only do local housekeeping: the coordinator decides what to remove
+    and its removals reach them through kg_log.
+    """
+    global _memory_atom_cap
+    # Interval and high-watermark runs must not pick the same rows to evict
+    async with _retention_lock:
+        now = time.time()
+        if AGENT_ROLE == "worker":
+            compacted = await dedupe_kg()
+            if kg_index.tombstones > kg_index.size():
+                kg_index.compact_logs()
+            retention_stats["runs"] += 1
+            retention_stats["compacted"] += compacted
+            retention_stats["last_run"] = now
+            retention_stats["last_trigger"] = trigger
+            return {"expired": 0, "compacted": compacted, "evicted": 0}
+
+        expired = await remove_kg_rows(kg_index.stale_rows(now - KG_ATOM_TTL)) if KG_ATOM_TTL > 0 else 0
+        compacted = await compact_kg(now)
+
+        rss = process_rss_mb()
+        size = kg_index.size()
+        over_memory = KG_MEMORY_HIGH_MB > 0 and rss is not None and rss > KG_MEMORY_HIGH_MB
+        if not over_memory:
+            _memory_atom_cap = None
+        evicted = 0
+        if size > kg_atom_budget() or (over_memory and _memory_atom_cap is None):
+            target = int(min(size, kg_atom_budget()) * KG_LOW_WATERMARK)
+            evicted = await remove_kg_rows(kg_index.lru_rows(size - target))
+            if over_memory:
+                _memory_atom_cap = target
+
+        if kg_index.tombstones > kg_index.size():
+            kg_index.compact_logs()
+        if KG_ATOM_TTL > 0 and kg_log is not None:
+            kg_log.prune(now - KG_ATOM_TTL)
+
+        retention_stats["runs"] += 1
+        retention_stats["expired"] += expired
+        retention_stats["evicted"] += evicted
+        retention_stats["compacted"] += compacted
+        retention_stats["last_run"] = now
+        retention_stats["last_trigger"] = trigger
+        return {"expired": expired, "compacted": compacted, "evicted": evicted}
+
+
+def kg_retention_metrics() -> dict:
+    rss = process_rss_mb()
+    return {
+        "atoms": kg_index.size(),
+        "concepts": len(kg_index.concepts),
+        "relations": len(kg_index.relations),
+        "pinned": len(kg_index.pinned),
+        "tombstones": kg_index.tombstones,
+        "max_atoms": KG_MAX_ATOMS,
+        "atom_budget": kg_atom_budget(),
+        "low_watermark": int(kg_atom_budget() * KG_LOW_WATERMARK),
+        "rss_mb": round(rss, 1) if rss is not None else -1.0,
+        "memory_high_mb": KG_MEMORY_HIGH_MB,
+        "ttl_seconds": KG_ATOM_TTL,
+        "writer": kg_writer.metrics(),
+        **retention_stats,
+    }
+
+# ======= STRUCTURED OUTPUT =======
+# Max closing candidates tried when repairing a truncated response
+JSON_REPAIR_MAX_CANDIDATES = 24
+
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+
+def _repair_truncated_json(text: str):
+    """
+    Scan from the first `{`, tracking strings and open brackets. Returns the first
+    complete top-level object, or for truncated output the longest prefix that
+    parses once its open brackets are closed. None if nothing can be recovered.
+    """
+    start = text.find("{")
+    if start == -1:
+        return None
+
+    stack, cuts = [], []
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            if not stack:
+                try:
+                    return _json_loads(text[start:i + 1])
+                except ValueError:
+                    return None
+            cuts.append((i + 1, tuple(stack)))
+        elif ch == ",":
+            cuts.append((i, tuple(stack)))
+
+    candidates = [] if in_string else [(len(text), tuple(stack))]
+    candidates += cuts[::-1]
+    for end, open_brackets in candidates[:JSON_REPAIR_MAX_CANDIDATES]:
+        candidate = text[start:end].rstrip().rstrip(",")
+        try:
+            return _json_loads(candidate + "".join(reversed(open_brackets)))
+        except ValueError:
+            continue
+    return None
+
+
+def parse_llm_json(text: str):
+    """
+    Parse a JSON object from an LLM response.
+    Returns (value, repaired) where value is None if nothing could be recovered.
+    """
+    text = _CODE_FENCE_RE.sub("", (text or "").strip())
+    try:
+        return _json_loads(text), False
+    except ValueError:
+        pass
+    return _repair_truncated_json(text), True
+
+
+class Field:
+    """One field of a response shape. kind: str, float, str_list, triple_list or object_list."""
+
+    def __init__(self, kind: str, default=None, required: bool = False, limit: int = None,
+                 schema: "ResponseSchema" = None):
+        self.kind = kind
+        self.default = default
+        self.required = required
+        self.limit = limit
+        self.schema = schema
+
+
+class ResponseSchema:
+    """
+    Precompiled validator for one LLM response shape. Values are coerced where
+    possible, invalid list items are dropped and missing fields take defaults.
+    `normalize` can rewrite or reject (return None) a validated object.
+    """
+
+    def __init__(self, name: str, fields: dict, normalize=None):
+        self.name = name
+        self.fields = fields
+        self.normalize = normalize
+        self._coercers = {key: getattr(self, f"_coerce_{field.kind}") for key, field in fields.items()}
+
+    def defaults(self) -> dict:
+        return {key: list(f.default) if isinstance(f.default, list) else f.default for key, f in self.fields.items()}
+
+    @staticmethod
+    def _coerce_str(value, field):
+        if isinstance(value, str):
+            return value.strip()
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        return None
+
+    @staticmethod
+    def _coerce_float(value, field):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _coerce_str_list(value, field):
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list):
+            return None
+        items = [v.strip() if isinstance(v, str) else str(v) for v in value
+                 if isinstance(v, (str, int, float)) and not isinstance(v, bool)]
+        return [v for v in items if v][:field.limit]
+
+    @staticmethod
+    def _coerce_triple_list(value, field):
+        if not isinstance(value, list):
+            return None
+        triples = []
+        for item in value:
+            if isinstance(item, dict):
+                item = [item.get("subject"), item.get("predicate"), item.get("object")]
+            if isinstance(item, list) and len(item) >= 3 and all(isinstance(v, str) and v.strip() for v in item[:3]):
+                triples.append([v.strip() for v in item[:3]])
+        return triples[:field.limit]
+
+    @staticmethod
+    def _coerce_object_list(value, field):
+        if not isinstance(value, list):
+            return None
+        items = []
+        for item in value:
+            validated, valid = field.schema.validate(item)
+            if valid:
+                items.append(validated)
+        return items[:field.limit]
+
+    def validate(self, data):
+        """Returns (validated dict, valid) where valid is False if a required field was unusable."""
+        if not isinstance(data, dict):
+            return self.defaults(), False
+
+        result, valid = {}, True
+        for key, field in self.fields.items():
+            value = self._coercers[key](data[key], field) if key in data else None
+            if value is None or (field.required and value in ("", [])):
+                valid = valid and not field.required
+                value = list(field.default) if isinstance(field.default, list) else field.default
+            result[key] = value
+
+        if valid and self.normalize:
+            normalized = self.normalize(result)
+            if normalized is None:
+                return self.defaults(), False
+            result = normalized
+        return result, valid
+
+
+def _normalize_gap(gap: dict):
+    gap["confidence"] = min(max(gap["confidence"], 0.0), 1.0)
+    return gap
+
+
+def _normalize_quiz_question(question: dict):
+    options = question["options"]
+    if len(options) < 2:
+        return None
+    correct = question["correct"].strip().lower()
+    # A bare letter is always a letter, even when an option's text is also "a"
+    if len(correct) == 1 and correct in "abcd":
+        pass
+    elif correct in options or question["correct"] in options:
+        index = options.index(question["correct"] if question["correct"] in options else correct)
+        correct = "abcd"[index] if index < 4 else ""
+    elif correct.isdigit():
+        # Models number options from 1; a "0" can only mean the first option
+        index = max(int(correct) - 1, 0)
+        correct = "abcd"[index] if index < min(len(options), 4) else ""
+    elif correct[:1] in "abcd" and correct[1:2] in (")", ".", ":", " "):
+        correct = correct[:1]
+    else:
+        correct = ""
+    if not correct or "abcd".index(correct) >= len(options):
+        return None
+    question["correct"] = correct
+    return question
+
+
+EXTRACTION_SCHEMA = ResponseSchema("extraction", {
+    "terms": Field("str_list", default=[], required=True, limit=8),
+    "context": Field("str", default="General"),
+    "relations": Field("triple_list", default=[]),
+})
+
+GRAPH_ANALYSIS_SCHEMA = ResponseSchema("graph_analysis", {
+    "summary": Field("str", default="", required=True),
+    "insights": Field("str_list", default=[], limit=5),
+    "suggestions": Field("str_list", default=[], limit=3),
+})
+
+GAP_SCHEMA = ResponseSchema("gap", {
+    "cluster": Field("str", default="Unknown", required=True),
+    "missing_concepts": Field("str_list", default=[]),
+    "confidence": Field("float", default=0.0),
+}, normalize=_normalize_gap)
+
+GAPS_SCHEMA = ResponseSchema("gaps", {
+    "gaps": Field("object_list", default=[], required=True, schema=GAP_SCHEMA),
+    "suggestions": Field("str_list", default=[]),
+})
+
+QUIZ_QUESTION_SCHEMA = ResponseSchema("quiz_question", {
+    "question": Field("str", default="", required=True),
+    "options": Field("str_list", default=[], required=True, limit=4),
+    "correct": Field("str", default="", required=True),
+    "explanation": Field("str", default=""),
+}, normalize=_normalize_quiz_question)
+
+QUIZ_SCHEMA = ResponseSchema("quiz", {
+    "questions": Field("object_list", default=[], required=True, schema=QUIZ_QUESTION_SCHEMA),
+})
+
+# (model, shape) -> counters
+structured_output_stats = defaultdict(lambda: {"total": 0, "repaired": 0, "invalid": 0, "failed": 0})
+
+
+def decode_structured(content: str, schema: ResponseSchema, model: str) -> dict:
+    """
+    Parse and validate an LLM response against `schema`, repairing truncated JSON.
+    Always returns a dict with every schema field present.
+    """
+    stats = structured_output_stats[(model, schema.name)]
+    stats["total"] += 1
+
+    parsed, repaired = parse_llm_json(content)
+    if parsed is None:
+        stats["failed"] += 1
+        log.warning("llm", "unparseable_response", model=model, shape=schema.name)
+        return schema.defaults()
+    if repaired:
+        stats["repaired"] += 1
+
+    result, valid = schema.validate(parsed)
+    if not valid:
+        stats["invalid"] += 1
+    return result
+
+
+def structured_output_metrics() -> dict:
+    """Per-model, per-shape decode counters with failure rates."""
+    metrics = {}
+    for (model, shape), stats in structured_output_stats.items():
+        total = stats["total"] or 1
+        metrics.setdefault(model, {})[shape] = {
+            **stats,
+            "failure_rate": round((stats["failed"] + stats["invalid"]) / total, 4),
+        }
+    return metrics
+
+
+# ======= TRAFFIC RECORDING =======
+# Opt-in: set TRAFFIC_RECORD_PATH to log REST calls (anonymized) with the upstream responses they
+# triggered; replay_traffic.py replays the log offline to compare the performance of two builds.
+TRAFFIC_RECORD_PATH = os.environ.get("TRAFFIC_RECORD_PATH")
+if TRAFFIC_RECORD_PATH and AGENT_ROLE == "worker":
+    # One file per worker (traffic.ndjson.gz -> traffic.worker0.ndjson.gz); the replay merges them
+    _dir, _name = os.path.split(TRAFFIC_RECORD_PATH)
+    _stem, _dot, _ext = _name.partition(".")
+    TRAFFIC_RECORD_PATH = os.path.join(_dir, f"{_stem}.worker{AGENT_WORKER_INDEX}{_dot}{_ext}")
+TRAFFIC_RECORD_SAMPLE = float(os.environ.get("TRAFFIC_RECORD_SAMPLE", "1.0"))
+# Salt for the user id hashes. Unset, each recording gets a random one, so known ids
+# cannot be hashed to find them; it is exported so spawned workers use the same salt
+TRAFFIC_RECORD_SALT = os.environ.get("TRAFFIC_RECORD_SALT") or secrets.token_hex(16)
+if TRAFFIC_RECORD_PATH:
+    os.environ["TRAFFIC_RECORD_SALT"] = TRAFFIC_RECORD_SALT
+# Replace the letters and digits of free-text fields with "x" (length and spacing are kept)
+TRAFFIC_RECORD_REDACT_TEXT = os.environ.get("TRAFFIC_RECORD_REDACT_TEXT", "0") == "1"
+TRAFFIC_RECORD_TEXT_FIELDS = ("sentence", "user_context", "history_context")
+TRAFFIC_RECORD_FLUSH_EVERY = int(os.environ.get("TRAFFIC_RECORD_FLUSH_EVERY", "64"))
+
+# The recorded call a request handler is working on; upstream calls attach themselves to it
+_traffic_call = contextvars.ContextVar("traffic_call", default=None)
+
+# Set by replay_traffic.py: serves upstream responses from a recording instead of the network
+traffic_replay = None
+
+
+class TrafficRecorder:
+    """Buffered gzip NDJSON log, one line per REST call with its upstream responses inline."""
+
+    def __init__(self, path: str, sample: float = 1.0, salt: str = "", redact_text: bool = False):
+        self.path = path
+        self.sample = sample
+        self.salt = salt
+        self.redact_text = redact_text
+        self.recorded = 0
+        self._buffer = []
+
+    def anonymize(self, payload: dict) -> dict:
+        """
+        Hash user ids and reduce page URLs to their origin. Sentences are kept for replay
+        unless `redact_text` is set.
+        """
+        payload = dict(payload)
+        if payload.get("user_id"):
+            digest = hashlib.sha256(f"{self.salt}{payload['user_id']}".encode()).hexdigest()
+            payload["user_id"] = f"u_{digest[:16]}"
+        if payload.get("url"):
+            parts = urlsplit(payload["url"])
+            payload["url"] = f"{parts.scheme}://{parts.netloc}/" if parts.netloc else ""
+        if self.redact_text:
+            for field in TRAFFIC_RECORD_TEXT_FIELDS:
+                if isinstance(payload.get(field), str):
+                    payload[field] = re.sub(r"\w", "x", payload[field])
+        return payload
+
+    def begin(self, endpoint: str, payload: dict):
+        if self.sample < 1.0 and random.random() >= self.sample:
+            return None
+        return {
+            "id": uuid4().hex[:16],
+            "endpoint": endpoint,
+            "ts": round(time.time(), 6),
+            "payload": self.anonymize(payload),
+            "upstream": [],
+        }
+
+    def finish(self, call: dict, latency: float, error: str = None):
+        call["latency"] = round(latency, 6)
+        if error:
+            call["error"] = error
+        self._buffer.append(json.dumps(call, separators=(",", ":"), default=str))
+        self.recorded += 1
+        if len(self._buffer) >= TRAFFIC_RECORD_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        # Each flush appends a gzip member; gzip readers treat the file as one stream
+        with gzip.open(self.path, "at", encoding="utf-8") as fh:
+            fh.write("\n".join(lines) + "\n")
+
+
+traffic_recorder = (
+    TrafficRecorder(TRAFFIC_RECORD_PATH, TRAFFIC_RECORD_SAMPLE, TRAFFIC_RECORD_SALT, TRAFFIC_RECORD_REDACT_TEXT)
+    if TRAFFIC_RECORD_PATH else None
+)
+
+
+def _model_payload(model) -> dict:
+    dump = getattr(model, "model_dump", None) or model.dict
+    return dump()
+
+
+def record_traffic(endpoint: str, handler):
+    """Wrap a REST handler so each call (and its upstream traffic) lands in the recording."""
+    if traffic_recorder is None:
+        return handler
+
+    @functools.wraps(handler)
+    async def recorded(ctx, *args):
+        call = traffic_recorder.begin(endpoint, _model_payload(args[0]) if args else {})
+        if call is None:
+            return await handler(ctx, *args)
+        token = _traffic_call.set(call)
+        start = time.perf_counter()
+        try:
+            response = await handler(ctx, *args)
+        except Exception as e:
+            traffic_recorder.finish(call, time.perf_counter() - start, error=str(e))
+            raise
+        finally:
+            _traffic_call.reset(token)
+        traffic_recorder.finish(call, time.perf_counter() - start, error=getattr(response, "error", None))
+        return response
+
+    return recorded
+
+
+def _record_upstream(entry: dict, start: float):
+    call = _traffic_call.get()
+    if call is not None:
+        entry["latency"] = round(time.perf_counter() - start, 6)
+        call["upstream"].append(entry)
+
+
+def upstream_key(payload: dict) -> str:
+    """Stable hash of an upstream request body, used to match replayed calls to recorded ones."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def asi_one_post(url: str, payload: dict, timeout: int) -> dict:
+    """POST to an ASI:One API and return the decoded JSON body."""
+    if traffic_replay is not None:
+        return traffic_replay.upstream(url, payload)
+    start = time.perf_counter()
+    entry = {
+        "url": urlsplit(url).path,
+        "key": upstream_key(payload),
+        "model": payload.get("model"),
+        "max_tokens": payload.get("max_tokens"),
+    }
     try:
         response = requests.post(
-            ASI_ONE_API_URL,
+            url,
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {ASI_ONE_API_KEY}"
             },
-            json={
-                "model": "asi1-mini",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a Web3 concept extraction assistant. Be concise and structured. Respond ONLY with valid JSON."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"""Extract Web3 concepts from: {text}
+            json=payload,
+            timeout=timeout
+        )
+        response.raise_for_status()
+        result = response.json()
+    except Exception as e:
+        entry["error"] = str(e)
+        _record_upstream(entry, start)
+        raise
+    entry["response"] = result
+    _record_upstream(entry, start)
+    return result
+
+
+def fetch_url_chunks(url: str, timeout: int, chunk_size: int = 64 * 1024):
+    """Download a generated asset as a stream of chunks; recordings keep only its size."""
+    if traffic_replay is not None:
+        yield traffic_replay.download(url)
+        return
+    start = time.perf_counter()
+    size = 0
+    with requests.get(url, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            size += len(chunk)
+            yield chunk
+    _record_upstream({"url": "download", "bytes": size}, start)
+
+
+# ======= EXPLANATION CACHE =======
+# Shared by all worker processes (unlike the per-worker spools)
+EXPLANATION_CACHE_PATH = os.environ.get("EXPLANATION_CACHE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "explanation_cache.db"
+)
+# Fraction of a sentence's content words (or of the extracted terms) that must be known
+# concepts before the cached explanations are used instead of the LLM
+EXPLAIN_CACHE_COVERAGE = float(os.environ.get("EXPLAIN_CACHE_COVERAGE", "0.5"))
+EXPLAIN_CACHE_MAX_TERMS = 3
+EXPLAIN_MISS_TTL = 60.0  # seconds a term missing from the shared table is not looked up again
+EXPLAIN_SCAN_MAX_WORDS = 4
+
+# Glossary categories -> extraction contexts, for analyses built without the LLM
+GLOSSARY_CATEGORY_CONTEXTS = {"Infrastructure": "Blockchain", "Development": "SmartContract", "General": "Web3"}
+
+_WORD_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9'-]*")
+_STOPWORDS = frozenset("""
+    a an the and or but if of to in on at by for with from as is are was were be been being it its this that
+    these those which who whom what when where how why can could will would should may might must do does did
+    has have had not no so than then there their they them we you your our us i he she his her also into about
+    more most such via using use used uses each any all both other over under between within without while
+""".split())
+
+
+class ExplanationCache:
+    """
+    Term-level explanations keyed by (canonical term, context), in tiers: glossary
+    definitions/examples loaded at startup, then short definitions learned from a
+    dedicated LLM prompt (kept in memory and in a SQLite file shared by every process).
+    Sentence-specific LLM answers are never stored, since they would not fit other sentences.
+    Sentences dominated by known concepts are answered from here without the LLM.
+    """
+
+    def __init__(self, path: str, glossary: list):
+        self.path = path
+        self._entries = {}      # term symbol -> {context symbol: (label, text, source)}
+        self._categories = {}   # term symbol -> extraction context
+        self._missing = {}      # term symbol -> monotonic time it was last missing from the table
+        self.stats = {"local": 0, "composed": 0, "llm": 0, "learned": 0, "glossary_hits": 0, "learned_hits": 0}
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS definitions (
+                term TEXT NOT NULL,
+                context TEXT NOT NULL,
+                label TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (term, context)
+            )
+        """)
+        for term, context, label, text, _ in self._db.execute("SELECT * FROM definitions"):
+            self._entries.setdefault(term, {})[context] = (label, text, "learned")
+        self._seed(glossary)
+
+    def _seed(self, glossary: list):
+        for entry in glossary:
+            label = entry.get("term")
+            if not label:
+                continue
+            term = term_dict.canonical(label)
+            examples = entry.get("examples") or {}
+            if entry.get("usage"):
+                examples = {**examples, "General": entry["usage"]}
+            for context, definition in glossary_definitions(entry).items():
+                if not definition:
+                    continue
+                example = examples.get(context)
+                text = f"{definition} For example: {example}" if example else definition
+                self._entries.setdefault(term, {})[TermDictionary.to_symbol(context)] = (label, text, "glossary")
+            category = entry.get("category", "General")
+            self._categories[term] = GLOSSARY_CATEGORY_CONTEXTS.get(category, category)
+
+    def _load(self, term: str):
+        """Pick up definitions other processes learned since startup (misses are remembered briefly)."""
+        missed_at = self._missing.get(term)
+        if missed_at is not None and time.monotonic() - missed_at < EXPLAIN_MISS_TTL:
+            return None
+        rows = self._db.execute(
+            "SELECT context, label, text FROM definitions WHERE term = ?", (term,)
+        ).fetchall()
+        if not rows:
+            if len(self._missing) >= 100_000:
+                self._missing.clear()
+            self._missing[term] = time.monotonic()
+            return None
+        self._missing.pop(term, None)
+        for context, label, text in rows:
+            self._entries.setdefault(term, {}).setdefault(context, (label, text, "learned"))
+        return self._entries.get(term)
+
+    def get(self, term: str, context: str = "General"):
+        """(label, text, source) for a term, preferring its context, then General, then any."""
+        symbol = term_dict.canonical(term)
+        contexts = self._entries.get(symbol) or self._load(symbol)
+        if not contexts:
+            return None
+        return contexts.get(TermDictionary.to_symbol(context)) or contexts.get("general") \
+            or next(iter(contexts.values()))
+
+    def scan(self, sentence: str) -> tuple:
+        """
+        Find known concepts in a sentence (longest phrase first).
+        Returns (terms in order of appearance, fraction of content words they cover).
+        """
+        words = _WORD_RE.findall(sentence)
+        content = [w.lower() not in _STOPWORDS for w in words]
+        terms, covered, i = [], 0, 0
+        while i < len(words):
+            for n in range(min(EXPLAIN_SCAN_MAX_WORDS, len(words) - i), 0, -1):
+                term_id = term_dict.lookup(" ".join(words[i:i + n]))
+                if term_id is not None and term_dict.symbol(term_id) in self._entries:
+                    if term_id not in terms:
+                        terms.append(term_id)
+                    covered += sum(content[i:i + n])
+                    i += n
+                    break
+            else:
+                i += 1
+        total = sum(content)
+        return [term_dict.symbol(t) for t in terms], (covered / total if total else 0.0)
+
+    def compose(self, terms: list, context: str = "General"):
+        """Explanation assembled from cached entries, or None if too few terms are known."""
+        if not terms:
+            return None
+        entries = [self.get(term, context) for term in terms]
+        known = [entry for entry in entries if entry]
+        if entries[0] is None or len(known) < EXPLAIN_CACHE_COVERAGE * len(entries):
+            return None
+        known = known[:EXPLAIN_CACHE_MAX_TERMS]
+        for _, _, source in known:
+            self.stats[f"{source}_hits"] += 1
+        if len(known) == 1:
+            return known[0][1]
+        return " ".join(f"{label}: {text}" for label, text, _ in known)
+
+    def explain_locally(self, sentence: str):
+        """
+        (analysis, explanation) for a sentence dominated by known concepts, built
+        without the LLM; None when the LLM is needed.
+        """
+        terms, coverage = self.scan(sentence)
+        if not terms or coverage < EXPLAIN_CACHE_COVERAGE:
+            return None
+        context = self._categories.get(terms[0], "General")
+        explanation = self.compose(terms, context)
+        if explanation is None:
+            return None
+        self.stats["local"] += 1
+        labels = [self.get(term, context)[0] for term in terms]
+        return {"terms": labels, "context": context, "relations": []}, explanation
+
+    def learn(self, term: str, context: str, label: str, text: str):
+        """Remember a term definition (from define_term_with_asi) for a term that has none yet (glossary entries win)."""
+        symbol = term_dict.canonical(term)
+        context = TermDictionary.to_symbol(context or "General")
+        contexts = self._entries.setdefault(symbol, {})
+        if context in contexts:
+            return
+        contexts[context] = (label, text, "learned")
+        self._missing.pop(symbol, None)
+        self._db.execute(
+            "INSERT OR IGNORE INTO definitions (term, context, label, text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (symbol, context, label, text, time.time())
+        )
+        self.stats["learned"] += 1
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "terms": len(self._entries),
+            "entries": sum(len(contexts) for contexts in self._entries.values()),
+        }
+
+
+explanation_cache = ExplanationCache(EXPLANATION_CACHE_PATH, glossary_entries)
+
+
+# ======= MODEL ROUTING =======
+# Picks the model, max_tokens and prompt variant for each ASI:One call from the input size,
+# how much of it the glossary already covers, and the endpoint's latency budget.
+MODEL_ROUTING = os.environ.get("MODEL_ROUTING", "1") != "0"  # 0 = the fixed pre-routing settings
+ROUTE_FAST_MODEL = os.environ.get("ROUTE_FAST_MODEL", "asi1-mini")
+ROUTE_GRAPH_MODEL = os.environ.get("ROUTE_GRAPH_MODEL", "asi1-graph")
+ROUTE_SHORT_WORDS = int(os.environ.get("ROUTE_SHORT_WORDS", "12"))  # inputs up to this long get compact prompts
+ROUTE_COVERAGE = float(os.environ.get("ROUTE_COVERAGE", "0.3"))  # glossary coverage that also allows them
+ROUTE_SMALL_GRAPH = int(os.environ.get("ROUTE_SMALL_GRAPH", "6000"))  # graph exports under this many chars use the fast model
+ROUTE_SMALL_GAPS = int(os.environ.get("ROUTE_SMALL_GAPS", "3"))  # gap summaries with this many weak clusters or fewer too
+ROUTE_PROBE_EVERY = 20  # while a route is downgraded for latency, every Nth call still tries it
+ROUTE_EWMA_ALPHA = 0.2
+
+# Latency budget (seconds) per task; a preferred route slower than this is downgraded.
+# /explain-sentence makes an extract and an explain call in sequence.
+ROUTE_SLA = {
+    "extract": 2.5,
+    "explain": 2.5,
+    "gaps": 10.0,
+    "graph": 25.0,
+    "define": 10.0,
+}
+
+# What every call used before routing: (model, max_tokens), the baseline for the savings counters
+ROUTE_BASELINE = {
+    "extract": (ROUTE_FAST_MODEL, 400),
+    "explain": (ROUTE_FAST_MODEL, 250),
+    "gaps": (ROUTE_GRAPH_MODEL, 500),
+    "graph": (ROUTE_GRAPH_MODEL, 500),
+    "define": (ROUTE_FAST_MODEL, 100),
+}
+
+
+class ModelRouter:
+    """
+    Chooses a route ({task, model, variant, max_tokens}) per call and keeps per-route
+    counters: latency, token usage, truncations, and tokens/prompt characters saved
+    against the fixed baseline. A route whose recent latency exceeds its task's SLA is
+    swapped for the cheaper one; a route whose answers get cut off earns a larger budget.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}  # "task:model:variant" -> counters
+        self._boost = defaultdict(lambda: 1.0)  # max_tokens multiplier per route, raised on truncation
+        self._decisions = defaultdict(int)
+
+    @staticmethod
+    def _key(route: dict) -> str:
+        return f"{route['task']}:{route['model']}:{route['variant']}"
+
+    def _stats(self, key: str) -> dict:
+        stats = self._routes.get(key)
+        if stats is None:
+            stats = self._routes[key] = {
+                "calls": 0, "errors": 0, "truncated": 0, "downgraded": 0,
+                "latency_total": 0.0, "latency_ewma": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0,
+                "budget_tokens": 0, "budget_saved": 0, "prompt_chars_saved": 0,
+            }
+        return stats
+
+    def _candidates(self, task: str, size: int, coverage: float) -> list:
+        """Routes for a task in order of preference; the last one is the cheapest."""
+        baseline_model, baseline_tokens = ROUTE_BASELINE[task]
+        if not MODEL_ROUTING:
+            return [{"task": task, "model": baseline_model, "variant": "full", "max_tokens": baseline_tokens}]
+        fast, graph = ROUTE_FAST_MODEL, ROUTE_GRAPH_MODEL
+        if task == "extract":
+            # size = words; JSON output grows with the number of terms worth extracting
+            full = {"model": fast, "variant": "full", "max_tokens": min(baseline_tokens, 220 + 6 * size)}
+            compact = {"model": fast, "variant": "compact", "max_tokens": 180}
+            short = size <= ROUTE_SHORT_WORDS or coverage >= ROUTE_COVERAGE
+            routes = [compact] if short else [full, compact]
+        elif task == "explain":
+            full = {"model": fast, "variant": "full", "max_tokens": baseline_tokens}
+            compact = {"model": fast, "variant": "compact", "max_tokens": 160}
+            routes = [compact] if size <= ROUTE_SHORT_WORDS else [full, compact]
+        elif task == "gaps":
+            # size = weak clusters; each gap in the answer costs ~90 tokens
+            tokens = min(baseline_tokens, 160 + 90 * max(size, 1))
+            preferred = {"model": fast if size <= ROUTE_SMALL_GAPS else graph, "variant": "full", "max_tokens": tokens}
+            routes = [preferred, {"model": fast, "variant": "full", "max_tokens": tokens}]
+        elif task == "define":
+            routes = [{"model": fast, "variant": "compact", "max_tokens": baseline_tokens}]
+        else:
+            # graph: size = characters of graph export; the answer shape is fixed, so the
+            # full prompt keeps the baseline budget and only the model changes
+            small = size <= ROUTE_SMALL_GRAPH
+            routes = [
+                {"model": fast if small else graph, "variant": "full", "max_tokens": baseline_tokens},
+                {"model": fast, "variant": "full", "max_tokens": baseline_tokens},
+            ]
+        return [{"task": task, **route} for route in routes]
+
+    def route(self, task: str, size: int = 0, coverage: float = 0.0) -> dict:
+        """Pick the route for one call."""
+        candidates = self._candidates(task, size, coverage)
+        route = candidates[0]
+        with self._lock:
+            self._decisions[task] += 1
+            preferred = self._routes.get(self._key(route))
+            slow = preferred and preferred["latency_ewma"] > ROUTE_SLA[task]
+            if slow and len(candidates) > 1 and self._decisions[task] % ROUTE_PROBE_EVERY:
+                preferred["downgraded"] += 1
+                route = candidates[-1]
+            boost = self._boost[self._key(route)]
+        if boost > 1.0:
+            route["max_tokens"] = int(route["max_tokens"] * boost)
+        return route
+
+    def post(self, route: dict, messages: list, timeout: int, baseline_prompt: str = None, **params) -> dict:
+        """
+        Send one chat completion along a route and record how it went. `baseline_prompt`
+        is the user prompt the full variant would have sent, for the savings counter.
+        """
+        key = self._key(route)
+        payload = {"model": route["model"], "messages": messages, "max_tokens": route["max_tokens"], **params}
+        start = time.perf_counter()
+        try:
+            result = asi_one_post(ASI_ONE_API_URL, payload=payload, timeout=timeout)
+        except Exception:
+            # Timeouts count towards the latency average, or a hanging route would never be downgraded
+            latency = time.perf_counter() - start
+            with self._lock:
+                stats = self._stats(key)
+                stats["errors"] += 1
+                stats["latency_ewma"] = ROUTE_EWMA_ALPHA * latency + (1 - ROUTE_EWMA_ALPHA) * stats["latency_ewma"]
+            raise
+        latency = time.perf_counter() - start
+        usage = result.get("usage") or {}
+        choices = result.get("choices") or [{}]
+        truncated = choices[0].get("finish_reason") == "length"
+        with self._lock:
+            stats = self._stats(key)
+            stats["calls"] += 1
+            stats["latency_total"] += latency
+            stats["latency_ewma"] = latency if stats["calls"] == 1 else \
+                ROUTE_EWMA_ALPHA * latency + (1 - ROUTE_EWMA_ALPHA) * stats["latency_ewma"]
+            stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            stats["completion_tokens"] += usage.get("completion_tokens") or 0
+            stats["budget_tokens"] += route["max_tokens"]
+            stats["budget_saved"] += ROUTE_BASELINE[route["task"]][1] - route["max_tokens"]
+            if baseline_prompt is not None:
+                stats["prompt_chars_saved"] += len(baseline_prompt) - len(messages[-1]["content"])
+            if truncated:
+                stats["truncated"] += 1
+                self._boost[key] = min(self._boost[key] * 1.5, 2.5)
+            elif self._boost[key] > 1.0:
+                self._boost[key] = max(1.0, self._boost[key] * 0.95)
+        if truncated:
+            log.warning("llm", "route_truncated", route=key, max_tokens=route["max_tokens"])
+        return result
+
+    def metrics(self) -> dict:
+        with self._lock:
+            routes = {}
+            for key, stats in self._routes.items():
+                calls = stats["calls"]
+                routes[key] = {
+                    **{k: v for k, v in stats.items() if k not in ("latency_total", "latency_ewma")},
+                    "mean_latency_ms": round(stats["latency_total"] / calls * 1000, 1) if calls else 0.0,
+                    "ewma_latency_ms": round(stats["latency_ewma"] * 1000, 1),
+                    "boost": round(self._boost[key], 2),
+                }
+            return {"enabled": MODEL_ROUTING, "decisions": dict(self._decisions), "routes": routes}
+
+
+model_router = ModelRouter()
+
+
+# ======= HELPER FUNCTIONS =======
+
+EXTRACTION_PROMPT = """Extract Web3 concepts from: {text}
 
 CRITICAL: Identify the PRIMARY context first! Contexts:
 - "DeFi": decentralized finance, DEX, yield farming, lending, liquidity, AMM, Uniswap, Compound, Aave
@@ -188,98 +1951,173 @@ Respond with ONLY this JSON structure (no markdown, no explanation):
 }}
 
 Extract up to 8 terms. Identify MINIMUM 2-3 relations."""
-                    }
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.7,
-                "max_tokens": 400
-            },
-            timeout=30
-        )
+
+# Short or glossary-heavy inputs: fewer instructions, fewer terms, smaller answer
+EXTRACTION_PROMPT_COMPACT = """Extract Web3 concepts from: {text}
+{hint}Context: one of DeFi, DAO, SmartContract, NFT, Blockchain, Web3, General.
+JSON only: {{"terms": ["term"], "context": "DeFi", "relations": [["subject", "predicate", "object"]]}}
+Up to 5 terms, 1-3 relations."""
+
+
+def extract_concepts_llm(text: str):
+    """Use ASI:One to extract Web3 concepts with structured output (model and prompt picked by model_router)."""
+    try:
+        known, coverage = explanation_cache.scan(text)
+        route = model_router.route("extract", len(_WORD_RE.findall(text)), coverage)
+        prompt = EXTRACTION_PROMPT.format(text=text)
+        baseline = prompt
+        if route["variant"] == "compact":
+            labels = [explanation_cache.get(term)[0] for term in known[:5]]
+            hint = f"Known terms: {', '.join(labels)}\n" if labels else ""
+            prompt = EXTRACTION_PROMPT_COMPACT.format(text=text, hint=hint)
         
-        response.raise_for_status()
-        result = response.json()
+        result = model_router.post(
+            route,
+            [
+                {
+                    "role": "system",
+                    "content": "You are a Web3 concept extraction assistant. Be concise and structured. Respond ONLY with valid JSON."
+                },
+                {"role": "user", "content": prompt}
+            ],
+            timeout=30,
+            baseline_prompt=baseline,
+            response_format={"type": "json_object"},
+            temperature=0.3 if MODEL_ROUTING else 0.7
+        )
         content = result['choices'][0]['message']['content']
         
-        return validate_and_parse_json(content, {
-            "terms": [], 
-            "context": "General", 
-            "relations": []
-        })
+        return decode_structured(content, EXTRACTION_SCHEMA, model=route["model"])
     except Exception as e:
-        print(f"[ASI:One Error]: {e}")
+        log.error("llm", "extraction_failed", error=str(e))
         return {"terms": [], "context": "General", "relations": []}
 
 
-def asi_one_explain(text: str, known_concepts: list = None) -> str:
-    """Use ASI:One asi1-mini for detailed explanations."""
+def asi_one_explain(text: str, known_concepts: list = None, context: str = "General") -> str:
+    """
+    Use ASI:One for detailed explanations (shorter for short selections). Cached term explanations are used
+    instead when enough of the concepts are known. Answers are about this sentence, so they
+    are not cached; see define_term_with_asi.
+    """
+    cached = explanation_cache.compose(known_concepts or [], context)
+    if cached is not None:
+        explanation_cache.stats["composed"] += 1
+        return cached
     try:
+        route = model_router.route("explain", len(_WORD_RE.findall(text)))
+        length = "2-3 sentences, max 90 words" if route["variant"] == "compact" else "3-4 sentences, max 150 words"
         if known_concepts and len(known_concepts) > 0:
-            prompt = f"User knows: {', '.join(known_concepts[:3])}. Provide a clear, detailed explanation of this Web3 concept (3-4 sentences, max 150 words): {text}"
+            prompt = f"User knows: {', '.join(known_concepts[:3])}. Provide a clear, detailed explanation of this Web3 concept ({length}): {text}"
         else:
-            prompt = f"Provide a clear, beginner-friendly explanation of this Web3 concept (3-4 sentences, max 150 words): {text}"
+            prompt = f"Provide a clear, beginner-friendly explanation of this Web3 concept ({length}): {text}"
         
-        response = requests.post(
-            ASI_ONE_API_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {ASI_ONE_API_KEY}"
-            },
-            json={
-                "model": "asi1-mini",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a helpful Web3 educator. Provide clear, detailed explanations that help users understand blockchain concepts. Be informative and educational."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 250
-            },
-            timeout=30
+        result = model_router.post(
+            route,
+            [
+                {
+                    "role": "system",
+                    "content": "You are a helpful Web3 educator. Provide clear, detailed explanations that help users understand blockchain concepts. Be informative and educational."
+                },
+                {"role": "user", "content": prompt}
+            ],
+            timeout=30,
+            temperature=0.7
         )
-        
-        response.raise_for_status()
-        result = response.json()
         explanation = result['choices'][0]['message']['content'].strip()
+        explanation_cache.stats["llm"] += 1
         
         return explanation
     except Exception as e:
-        print(f"[ASI:One Explain Error]: {e}")
+        log.error("llm", "explain_failed", error=str(e))
         return f"Unable to generate explanation: {str(e)}"
 
 
+def define_term_with_asi(term: str, context: str = "General") -> str:
+    """
+    Short, sentence-independent definition of a term for the explanation cache,
+    so it reads correctly wherever the term shows up again.
+    """
+    route = model_router.route("define")
+    result = model_router.post(
+        route,
+        [
+            {
+                "role": "system",
+                "content": "You are a Web3 glossary editor. Write precise, self-contained definitions."
+            },
+            {
+                "role": "user",
+                "content": f"Define the Web3 term \"{term}\" as used in {context}, in 1-2 sentences (max 45 words). "
+                           "Do not refer to any example sentence."
+            }
+        ],
+        timeout=30,
+        temperature=0.3
+    )
+    return result['choices'][0]['message']['content'].strip()
+
+
+def parse_export_cursor(cursor: str = None) -> tuple:
+    """
+    Cursors look like "<epoch>.<c|r>.<seq>". Returns (phase, seq);
+    raises ValueError if the cursor is malformed or from an older index epoch.
+    """
+    if not cursor:
+        return "c", 0
+    epoch, phase, seq = cursor.split(".")
+    if int(epoch) != kg_index.epoch:
+        raise ValueError("cursor expired, restart the export")
+    if phase not in ("c", "r"):
+        raise ValueError(f"invalid cursor phase: {phase}")
+    return phase, int(seq)
+
+
+def iter_graph_records(cursor: str = None, context: str = None):
+    """
+    Lazily yield (next_cursor, record) for every concept then every relation,
+    starting after `cursor`. With `context`, only concepts in that context and
+    relations touching one of them are yielded. Safe to interleave with writes.
+    """
+    phase, position = parse_export_cursor(cursor)
+    context_id = None
+    if context:
+        context_id = term_dict.lookup(context)
+        if context_id is None:
+            return
+    symbol = term_dict.symbol
+    epoch = kg_index.epoch
+
+    if phase == "c":
+        entries = kg_index.concept_log
+        while position < len(entries):
+            row = entries[position]
+            position += 1
+            if row is None or (context_id is not None and row[1] != context_id):
+                continue
+            yield f"{epoch}.c.{position}", {"type": "concept", "term": symbol(row[0]), "context": symbol(row[1])}
+        position = 0
+
+    entries = kg_index.relation_log
+    while position < len(entries):
+        row = entries[position]
+        position += 1
+        if row is None:
+            continue
+        if context_id is not None and (row[1], context_id) not in kg_index.concepts \
+                and (row[2], context_id) not in kg_index.concepts:
+            continue
+        yield f"{epoch}.r.{position}", {
+            "type": "relation", "predicate": symbol(row[0]), "subject": symbol(row[1]), "object": symbol(row[2])
+        }
+
+
 def export_metta_graph() -> str:
-    """Export MeTTa knowledge graph as JSON string."""
+    """Export MeTTa knowledge graph as a compact JSON string (used in LLM prompts)."""
     try:
-        # Query all concepts
-        concept_query = "!(match &self (concept $x $ctx) ($x $ctx))"
-        concept_results = metta.run(concept_query)
-        
-        # Query all relations
-        relation_query = "!(match &self (relation $pred $subj $obj) ($pred $subj $obj))"
-        relation_results = metta.run(relation_query)
-        
-        # Parse results into structured format
-        concepts = []
-        if concept_results:
-            for result in concept_results:
-                if isinstance(result, list) and len(result) >= 2:
-                    concepts.append({
-                        "term": str(result[0]),
-                        "context": str(result[1])
-                    })
-        
-        relations = []
-        if relation_results:
-            for result in relation_results:
-                if isinstance(result, list) and len(result) >= 3:
-                    relations.append({
-                        "predicate": str(result[0]),
-                        "subject": str(result[1]),
-                        "object": str(result[2])
-                    })
+        concepts, relations = [], []
+        for _, record in iter_graph_records():
+            kind = record.pop("type")
+            (concepts if kind == "concept" else relations).append(record)
         
         graph_data = {
             "concepts": concepts,
@@ -291,14 +2129,14 @@ def export_metta_graph() -> str:
             }
         }
         
-        return json.dumps(graph_data, indent=2)
+        return json.dumps(graph_data, separators=(",", ":"))
     except Exception as e:
-        print(f"[MeTTa Export Error]: {e}")
+        log.error("metta", "export_failed", error=str(e))
         return json.dumps({"concepts": [], "relations": [], "metadata": {"error": str(e)}})
 
 
 def asi_one_graph_reasoning(graph_data: str, query_type: str = "overview") -> dict:
-    """Use ASI:One asi1-graph for structured graph analysis."""
+    """Use ASI:One for structured graph analysis (asi1-graph for large graphs)."""
     try:
         prompts = {
             "overview": f"""Analyze this Web3 knowledge graph.
@@ -349,47 +2187,33 @@ Respond with ONLY this JSON:
         }
         
         prompt = prompts.get(query_type, prompts["overview"])
+        route = model_router.route("graph", len(graph_data))
         
-        response = requests.post(
-            ASI_ONE_API_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {ASI_ONE_API_KEY}"
-            },
-            json={
-                "model": "asi1-graph",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a knowledge graph analyst. Provide structured, concise analysis. Always respond with valid JSON only."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.7,
-                "max_tokens": 500
-            },
-            timeout=60
+        result = model_router.post(
+            route,
+            [
+                {
+                    "role": "system",
+                    "content": "You are a knowledge graph analyst. Provide structured, concise analysis. Always respond with valid JSON only."
+                },
+                {"role": "user", "content": prompt}
+            ],
+            timeout=60,
+            response_format={"type": "json_object"},
+            temperature=0.7
         )
-        
-        response.raise_for_status()
-        result = response.json()
         content = result['choices'][0]['message']['content']
         
-        parsed = validate_and_parse_json(content, {
-            "summary": "",
-            "insights": [],
-            "suggestions": []
-        })
+        parsed = decode_structured(content, GRAPH_ANALYSIS_SCHEMA, model=route["model"])
         
         # Ensure we have the analysis field for backward compatibility
         return {
-            "analysis": parsed.get("summary", ""),
-            "insights": parsed.get("insights", [])[:5],
-            "suggestions": parsed.get("suggestions", [])[:3]
+            "analysis": parsed["summary"],
+            "insights": parsed["insights"],
+            "suggestions": parsed["suggestions"]
         }
     except Exception as e:
-        print(f"[ASI:One Graph Reasoning Error]: {e}")
+        log.error("llm", "graph_reasoning_failed", error=str(e))
         return {
             "analysis": f"Error analyzing graph: {str(e)}",
             "insights": [],
@@ -397,70 +2221,51 @@ Respond with ONLY this JSON:
         }
 
 
-def add_to_metta_kg(analysis: dict):
+async def add_to_metta_kg(analysis: dict) -> list:
     """
     Take LLM output and auto-add concepts/relations to MeTTa knowledge graph.
+    Returns the atoms that were new (terms are canonicalized through term_dict).
     """
-    terms = analysis.get("terms", [])
-    context = analysis.get("context", "General")
-    relations = analysis.get("relations", [])
-    
-    # Add concepts to MeTTa
-    for term in terms:
-        term_clean = term.lower().replace(" ", "_")
-        atom = f"(concept {term_clean} {context.lower().replace(' ', '_')})"
-        try:
-            metta.run(atom)
-            print(f"[MeTTa] Added: {atom}")
-        except Exception as e:
-            print(f"[MeTTa Error] Could not add {atom}: {e}")
-    
-    # Add relations to MeTTa
-    for rel in relations:
-        if len(rel) >= 3:
-            subj = rel[0].lower().replace(" ", "_")
-            pred = rel[1].lower().replace(" ", "_")
-            obj = rel[2].lower().replace(" ", "_")
-            atom = f"(relation {pred} {subj} {obj})"
-            try:
-                metta.run(atom)
-                print(f"[MeTTa] Added: {atom}")
-            except Exception as e:
-                print(f"[MeTTa Error] Could not add {atom}: {e}")
+    added = await kg_writer.submit("analysis", analysis)
+    if log.enabled("metta", logging.DEBUG):
+        for atom in added:
+            log.debug("metta", "atom_added", atom=atom)
+    return added
 
 
-def metta_reasoning(query: str):
+async def metta_reasoning(query: str):
     """Query MeTTa knowledge graph with pattern matching."""
     try:
-        if not query.startswith('!'):
-            query = f"!{query}"
-        result = metta.run(query)
-        return result if result else "No results found in knowledge graph."
+        result = await cached_metta_query(query)
+        return result if result and any(result) else "No results found in knowledge graph."
     except Exception as e:
         return f"MeTTa error: {e}"
 
 
-def get_unexplored_concepts():
+async def get_unexplored_concepts():
     """
     Query MeTTa for all concepts in the graph.
     (You can extend this to track user-specific explored vs. unexplored.)
     """
     try:
         query = "!(match &self (concept $x $ctx) $x)"
-        result = metta.run(query)
+        result = await cached_metta_query(query)
         return result
     except Exception as e:
         return f"Error: {e}"
 
 
-async def store_to_supabase(sentence: str, url: str, user_id: str, analysis: dict):
-    """Store captured sentence in Supabase database."""
+async def store_to_supabase(sentence: str, url: str, user_id: str, analysis: dict, row_id: str = None):
+    """
+    Store captured sentence in Supabase database.
+    Pass a stable `row_id` to make retries idempotent (the row is upserted).
+    """
     if not supabase_client or not user_id:
         return False
     
     try:
         data = {
-            "id": str(uuid4()),
+            "id": row_id or str(uuid4()),
             "user_id": user_id,
             "sentence": sentence,
             "terms": analysis.get("terms", []),
@@ -476,75 +2281,282 @@ async def store_to_supabase(sentence: str, url: str, user_id: str, analysis: dic
             }
         }
         
-        result = supabase_client.table("captured_sentences").insert(data).execute()
-        print(f"✅ Stored to Supabase: {sentence[:50]}...")
+        await asyncio.to_thread(
+            lambda: supabase_client.table("captured_sentences").upsert(data).execute()
+        )
+        log.info("supabase", "sentence_stored", row_id=data["id"], sentence=sentence[:50])
         return True
     except Exception as e:
-        print(f"❌ Supabase storage error: {e}")
+        log.error("supabase", "sentence_store_failed", error=str(e))
         return False
 
 
-async def fetch_user_graph_from_supabase(user_id: str) -> dict:
-    """Fetch user's knowledge graph from Supabase."""
-    if not supabase_client or not user_id:
-        return {"nodes": [], "edges": []}
-    
-    try:
-        # Fetch nodes
-        nodes_result = supabase_client.table("graph_nodes").select("*").eq("user_id", user_id).execute()
-        nodes = nodes_result.data if nodes_result.data else []
-        
-        # Fetch edges
-        edges_result = supabase_client.table("graph_edges").select("*").eq("user_id", user_id).execute()
-        edges = edges_result.data if edges_result.data else []
-        
-        return {"nodes": nodes, "edges": edges}
-    except Exception as e:
-        print(f"❌ Error fetching user graph: {e}")
-        return {"nodes": [], "edges": []}
+# ======= GRAPH CHANGE FEED =======
+# entity in graph_changes -> (table, response field, columns sent to clients)
+GRAPH_CHANGE_ENTITIES = {
+    "node": ("graph_nodes", "nodes", "id, type, label, terms, context, framework, timestamp, confidence, quiz_completed"),
+    "edge": ("graph_edges", "edges", "id, source_id, target_id, weight, type"),
+    "insight": ("insights", "insights", "id, insight_type, content, metadata, is_read, is_dismissed, created_at"),
+}
+GRAPH_CHANGES_MAX_LIMIT = 5000
+GRAPH_FETCH_CHUNK = 200  # ids per `in` filter, keeps request URLs short
+
+
+def fetch_graph_changes(user_id: str, since: int, limit: int) -> dict:
+    """
+    Nodes, edges and insights changed after version `since`, from the per-user counters
+    and change log of migration 005. Deleted rows come back as ids under `deleted`.
+    With since=0, or a cursor older than pruned tombstones, this is a full sync.
+    """
+    counter = supabase_client.table("graph_versions")\
+        .select("version, pruned_version")\
+        .eq("user_id", user_id)\
+        .limit(1)\
+        .execute().data
+    version, pruned_version = (counter[0]["version"], counter[0]["pruned_version"]) if counter else (0, 0)
+
+    delta = {"version": version, "has_more": False, "reset": False,
+             "deleted": {key: [] for _, key, _ in GRAPH_CHANGE_ENTITIES.values()}}
+    for _, key, _ in GRAPH_CHANGE_ENTITIES.values():
+        delta[key] = []
+    # A cursor past the counter (database restored) or behind pruned tombstones cannot be
+    # brought up to date incrementally
+    if since > version or 0 < since < pruned_version:
+        delta["reset"] = True
+        since = 0
+    if since == version:
+        return delta
+
+    # Bounded by the counter read above; changes commit in version order, so nothing
+    # at or below it can still appear later. Versions are unique per user (the trigger
+    # bumps the counter and the backfill numbers existing rows), so a page can resume
+    # after its last version
+    changes = supabase_client.table("graph_changes")\
+        .select("entity, entity_id, version, deleted")\
+        .eq("user_id", user_id)\
+        .gt("version", since)\
+        .lte("version", version)\
+        .order("version")\
+        .limit(limit)\
+        .execute().data or []
+    if len(changes) == limit:
+        delta["has_more"] = True
+        delta["version"] = changes[-1]["version"]
+
+    upserted = defaultdict(list)
+    for change in changes:
+        _, key, _ = GRAPH_CHANGE_ENTITIES[change["entity"]]
+        if not change["deleted"]:
+            upserted[change["entity"]].append(change["entity_id"])
+        elif since:
+            # A full sync starts from nothing, so it needs no tombstones
+            delta["deleted"][key].append(change["entity_id"])
+
+    for entity, ids in upserted.items():
+        table, key, columns = GRAPH_CHANGE_ENTITIES[entity]
+        for i in range(0, len(ids), GRAPH_FETCH_CHUNK):
+            # Rows deleted since the change was read are skipped; their tombstone comes next sync
+            rows = supabase_client.table(table)\
+                .select(columns)\
+                .eq("user_id", user_id)\
+                .in_("id", ids[i:i + GRAPH_FETCH_CHUNK])\
+                .execute().data
+            delta[key].extend(rows or [])
+    return delta
+
+
+# ======= CLUSTER AGGREGATES =======
+CLUSTER_AGGREGATES_PATH = os.environ.get("CLUSTER_AGGREGATES_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    f"cluster_aggregates.worker{AGENT_WORKER_INDEX}.db" if AGENT_ROLE == "worker" else "cluster_aggregates.db"
+)
+# Full recount interval, catches edge weight updates that a created_at delta cannot see
+CLUSTER_REBUILD_INTERVAL = float(os.environ.get("CLUSTER_REBUILD_INTERVAL", "3600"))
+SUPABASE_PAGE_SIZE = 1000
+
+
+def _fetch_rows_since(table: str, columns: str, user_id: str, after: str = None) -> list:
+    """
+    Page through a user's rows in `table` created at or after `after` (all rows if None).
+    Pages are keyed on (created_at, id): the extension writes batches sharing one
+    timestamp, which offset paging would skip or repeat at page boundaries.
+    """
+    rows, last = [], None
+    while True:
+        query = supabase_client.table(table).select(columns).eq("user_id", user_id)
+        if last is not None:
+            created_at, row_id = last["created_at"], last["id"]
+            query = query.or_(f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt."{row_id}")')
+        elif after:
+            query = query.gte("created_at", after)
+        page = query.order("created_at").order("id").limit(SUPABASE_PAGE_SIZE).execute().data or []
+        rows.extend(page)
+        if len(page) < SUPABASE_PAGE_SIZE:
+            return rows
+        last = page[-1]
+
+
+class ClusterAggregates:
+    """
+    Running per-user, per-context aggregates (edge weight sum, edge count, node count,
+    last update) kept in memory and persisted to SQLite. After one full count per
+    user, refresh() only fetches nodes/edges created since the last watermark, so
+    gap detection reads O(clusters) state instead of the whole graph. Refreshes of
+    one user are serialized, so concurrent calls cannot apply the same delta twice.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._clusters = defaultdict(dict)  # user_id -> context -> aggregate
+        self._sync = {}                     # user_id -> watermarks
+        self._locks = defaultdict(asyncio.Lock)  # user_id -> held across read, apply and persist
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS cluster_aggregates (
+                user_id TEXT NOT NULL,
+                context TEXT NOT NULL,
+                weight_sum REAL NOT NULL,
+                edge_count INTEGER NOT NULL,
+                node_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, context)
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS cluster_sync (
+                user_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL
+            )
+        """)
+        for user_id, context, weight_sum, edge_count, node_count, updated_at in self._db.execute(
+            "SELECT * FROM cluster_aggregates"
+        ):
+            self._clusters[user_id][context] = {
+                "weight_sum": weight_sum, "edge_count": edge_count,
+                "node_count": node_count, "updated_at": updated_at,
+            }
+        for user_id, state in self._db.execute("SELECT * FROM cluster_sync"):
+            self._sync[user_id] = json.loads(state)
+
+    def clusters(self, user_id: str) -> dict:
+        return self._clusters.get(user_id, {})
+
+    def _aggregate(self, user_id: str, context: str) -> dict:
+        return self._clusters[user_id].setdefault(context or "General", {
+            "weight_sum": 0.0, "edge_count": 0, "node_count": 0, "updated_at": 0.0,
+        })
 
+    @staticmethod
+    def _advance(state: dict, key: str, rows: list):
+        """Move a created_at watermark forward, remembering ids at the boundary timestamp."""
+        seen = set(state.get(f"{key}_ids", []))
+        fresh = [row for row in rows if row.get("id") not in seen or row.get("created_at") != state.get(key)]
+        if rows:
+            last = rows[-1].get("created_at")
+            state[f"{key}_ids"] = [row.get("id") for row in rows if row.get("created_at") == last]
+            state[key] = last
+        return fresh
 
-async def detect_weak_clusters(graph: dict) -> list:
-    """Analyze graph to find weak clusters (low edge weights)."""
+    async def refresh(self, user_id: str) -> dict:
+        """Bring a user's aggregates up to date and return {context: aggregate}."""
+        if not supabase_client or not user_id:
+            return self.clusters(user_id)
+
+        async with self._locks[user_id]:
+            return await self._refresh(user_id)
+
+    async def _refresh(self, user_id: str) -> dict:
+        state = self._sync.get(user_id)
+        rebuild = state is None or time.time() - state["rebuilt_at"] > CLUSTER_REBUILD_INTERVAL
+        if rebuild:
+            state = {"rebuilt_at": time.time()}
+
+        nodes, edges = await asyncio.gather(
+            asyncio.to_thread(_fetch_rows_since, "graph_nodes", "id, context, created_at", user_id, state.get("nodes_after")),
+            asyncio.to_thread(
+                _fetch_rows_since, "graph_edges",
+                "id, weight, created_at, source:graph_nodes!graph_edges_source_id_fkey(context)",
+                user_id, state.get("edges_after")
+            ),
+        )
+
+        if rebuild:
+            self._clusters.pop(user_id, None)
+        now = time.time()
+        touched = set()
+        for node in self._advance(state, "nodes_after", nodes):
+            aggregate = self._aggregate(user_id, node.get("context"))
+            aggregate["node_count"] += 1
+            aggregate["updated_at"] = now
+            touched.add(node.get("context") or "General")
+        for edge in self._advance(state, "edges_after", edges):
+            source = edge.get("source") or {}
+            if not source:
+                continue
+            aggregate = self._aggregate(user_id, source.get("context"))
+            aggregate["weight_sum"] += float(edge.get("weight") or 0)
+            aggregate["edge_count"] += 1
+            aggregate["updated_at"] = now
+            touched.add(source.get("context") or "General")
+
+        self._sync[user_id] = state
+        self._persist(user_id, touched, rebuilt=rebuild)
+        return self.clusters(user_id)
+
+    def _persist(self, user_id: str, contexts: set, rebuilt: bool = False):
+        clusters = self.clusters(user_id)
+        with self._db:
+            if rebuilt:
+                self._db.execute("DELETE FROM cluster_aggregates WHERE user_id = ?", (user_id,))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO cluster_aggregates VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (user_id, ctx, agg["weight_sum"], agg["edge_count"], agg["node_count"], agg["updated_at"])
+                    for ctx, agg in clusters.items() if rebuilt or ctx in contexts
+                ]
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO cluster_sync VALUES (?, ?)",
+                (user_id, json.dumps(self._sync[user_id]))
+            )
+
+
+cluster_aggregates = ClusterAggregates(CLUSTER_AGGREGATES_PATH)
+
+
+async def detect_weak_clusters(clusters: dict) -> list:
+    """Find weak clusters (avg edge weight < 0.5) from per-context aggregates."""
     weak_clusters = []
-    edges = graph.get("edges", [])
-    nodes = graph.get("nodes", [])
-    
-    # Group edges by context/cluster
-    cluster_edges = {}
-    for edge in edges:
-        # Find source node context
-        source_node = next((n for n in nodes if n.get("id") == edge.get("source_id")), None)
-        if source_node:
-            context = source_node.get("context", "General")
-            if context not in cluster_edges:
-                cluster_edges[context] = []
-            cluster_edges[context].append(edge)
-    
-    # Find clusters with weak connections (avg weight < 0.5)
-    for cluster, edges_list in cluster_edges.items():
-        if not edges_list:
+    for cluster, aggregate in clusters.items():
+        if not aggregate["edge_count"]:
             continue
         
-        avg_weight = sum(float(e.get("weight", 0)) for e in edges_list) / len(edges_list)
+        avg_weight = aggregate["weight_sum"] / aggregate["edge_count"]
         if avg_weight < 0.5:
             weak_clusters.append({
                 "cluster": cluster,
                 "avg_weight": avg_weight,
-                "edge_count": len(edges_list)
+                "edge_count": aggregate["edge_count"],
+                "node_count": aggregate["node_count"]
             })
     
     return weak_clusters
 
 
-async def store_insight_to_supabase(user_id: str, insight_type: str, content: str, metadata: dict):
-    """Store insight to Supabase insights table."""
+async def store_insight_to_supabase(user_id: str, insight_type: str, content: str, metadata: dict,
+                                    row_id: str = None, dedupe_key: str = None):
+    """
+    Store insight to Supabase insights table.
+    With a `dedupe_key` the write is an upsert that leaves an existing identical insight
+    (and its read/dismissed state) untouched.
+    """
     if not supabase_client or not user_id:
         return False
     
     try:
         data = {
-            "id": str(uuid4()),
+            "id": row_id or str(uuid4()),
             "user_id": user_id,
             "insight_type": insight_type,
             "content": content,
@@ -554,11 +2566,21 @@ async def store_insight_to_supabase(user_id: str, insight_type: str, content: st
             "created_at": datetime.utcnow().isoformat()
         }
         
-        result = supabase_client.table("insights").insert(data).execute()
-        print(f"✅ Insight stored: {insight_type} for user {user_id[:8]}...")
+        if dedupe_key:
+            data["dedupe_key"] = dedupe_key
+            await asyncio.to_thread(
+                lambda: supabase_client.table("insights")
+                .upsert(data, on_conflict="user_id,dedupe_key", ignore_duplicates=True)
+                .execute()
+            )
+        else:
+            await asyncio.to_thread(
+                lambda: supabase_client.table("insights").upsert(data).execute()
+            )
+        log.info("supabase", "insight_stored", insight_type=insight_type, user=user_id[:8])
         return True
     except Exception as e:
-        print(f"❌ Error storing insight: {e}")
+        log.error("supabase", "insight_store_failed", error=str(e))
         return False
 
 
@@ -568,20 +2590,22 @@ async def fetch_sentences_for_cluster(user_id: str, cluster: str) -> list:
         return []
     
     try:
-        result = supabase_client.table("captured_sentences")\
-            .select("*")\
-            .eq("user_id", user_id)\
-            .eq("context", cluster)\
-            .limit(10)\
+        result = await asyncio.to_thread(
+            lambda: supabase_client.table("captured_sentences")
+            .select("*")
+            .eq("user_id", user_id)
+            .eq("context", cluster)
+            .limit(10)
             .execute()
+        )
         
         return result.data if result.data else []
     except Exception as e:
-        print(f"❌ Error fetching sentences for cluster: {e}")
+        log.error("supabase", "cluster_sentences_failed", cluster=cluster, error=str(e))
         return []
 
 
-def generate_quiz_with_asi(cluster: str, sentences: list, difficulty: int) -> list:
+def generate_quiz_with_asi(cluster: str, sentences: list, difficulty: int, count: int = 3) -> list:
     """Generate quiz questions using ASI:One based on cluster and sentences."""
     try:
         # Prepare context from sentences
@@ -590,7 +2614,7 @@ def generate_quiz_with_asi(cluster: str, sentences: list, difficulty: int) -> li
         difficulty_map = {1: "beginner", 2: "intermediate", 3: "advanced"}
         difficulty_level = difficulty_map.get(difficulty, "intermediate")
         
-        prompt = f"""Generate 3 multiple-choice quiz questions about {cluster} concepts at {difficulty_level} level.
+        prompt = f"""Generate {count} multiple-choice quiz questions about {cluster} concepts at {difficulty_level} level.
 
 Context sentences:
 {sentences_text}
@@ -609,13 +2633,9 @@ Respond with ONLY this JSON structure (no markdown, no explanation):
 
 Make questions relevant to {cluster} and appropriate for {difficulty_level} learners."""
         
-        response = requests.post(
+        result = asi_one_post(
             ASI_ONE_API_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {ASI_ONE_API_KEY}"
-            },
-            json={
+            payload={
                 "model": "asi1-mini",
                 "messages": [
                     {
@@ -626,26 +2646,790 @@ Make questions relevant to {cluster} and appropriate for {difficulty_level} lear
                 ],
                 "response_format": {"type": "json_object"},
                 "temperature": 0.8,
-                "max_tokens": 800
+                "max_tokens": max(800, 270 * count)
             },
             timeout=30
         )
-        
-        response.raise_for_status()
-        result = response.json()
         content = result['choices'][0]['message']['content']
         
-        parsed = validate_and_parse_json(content, {"questions": []})
-        return parsed.get("questions", [])
+        parsed = decode_structured(content, QUIZ_SCHEMA, model="asi1-mini")
+        return parsed["questions"]
     except Exception as e:
-        print(f"[ASI:One Quiz Generation Error]: {e}")
+        log.error("llm", "quiz_generation_failed", cluster=cluster, error=str(e))
         return []
 
 
+# ======= KNOWLEDGE GRAPH REPLICATION =======
+class KnowledgeGraphLog:
+    """
+    Append-only ingest log (SQLite) that is the single knowledge-graph authority
+    when several processes serve the agent. Writers append extraction results;
+    every process applies new entries in sequence order to its local MeTTa space,
+    so all replicas converge on the same canonicalized graph.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.applied_seq = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS kg_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                analysis TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+
+    def append(self, analysis: dict) -> int:
+        cursor = self._db.execute(
+            "INSERT INTO kg_log (analysis, created_at) VALUES (?, ?)",
+            (json.dumps(analysis), time.time())
+        )
+        return cursor.lastrowid
+
+    def append_removal(self, rows: list) -> int:
+        """Log rows dropped by retention, as symbols (term ids differ between processes)."""
+        return self.append({"remove": [[term_dict.symbol(i) for i in row] for row in rows]})
+
+    @staticmethod
+    async def _apply(entry: dict):
+        if "remove" not in entry:
+            return await add_to_metta_kg(entry)
+        # Interned rather than looked up: on replay the entries adding these rows are
+        # still queued in the writer, which commits them first
+        rows = [tuple(term_dict.intern(symbol) for symbol in row) for row in entry["remove"]]
+        return await kg_writer.submit("remove", rows)
+
+    async def apply_pending(self, limit: int = 1000) -> int:
+        """Apply entries newer than `applied_seq` to the local space. Returns entries applied."""
+        rows = self._db.execute(
+            "SELECT seq, analysis FROM kg_log WHERE seq > ? ORDER BY seq LIMIT ?",
+            (self.applied_seq, limit)
+        ).fetchall()
+        if not rows:
+            return 0
+        # Claimed before awaiting, so a concurrent call does not apply the same entries;
+        # the writer commits them in sequence order
+        self.applied_seq = rows[-1][0]
+        results = await asyncio.gather(
+            *(self._apply(json.loads(analysis)) for _, analysis in rows), return_exceptions=True
+        )
+        for (seq, _), result in zip(rows, results):
+            if isinstance(result, Exception):
+                log.error("metta", "log_entry_failed", seq=seq, error=str(result))
+        return len(rows)
+
+    def prune(self, before: float) -> int:
+        """
+        Delete entries older than `before` that a replay from the start no longer needs:
+        additions none of whose rows are still in the graph, and removals of rows that no
+        kept addition before them adds. An addition whose rows a query kept alive past
+        the TTL stays, so a restarted worker replaying the log still rebuilds them.
+        Runs on the coordinator, whose graph is the reference.
+        """
+        entries = self._db.execute(
+            "SELECT seq, analysis FROM kg_log WHERE created_at < ? AND seq <= ? ORDER BY seq",
+            (before, self.applied_seq)
+        ).fetchall()
+        kept_rows = set()  # rows added by the entries kept so far
+        stale = []
+        for seq, analysis in entries:
+            entry = json.loads(analysis)
+            if "remove" in entry:
+                rows = {tuple(term_dict.intern(symbol) for symbol in row) for row in entry["remove"]}
+                if kept_rows.isdisjoint(rows):
+                    stale.append((seq,))
+                continue
+            rows = analysis_rows(entry)
+            if any(kg_index.has_concept(*row) if len(row) == 2 else kg_index.has_relation(*row) for row in rows):
+                kept_rows.update(rows)
+            else:
+                stale.append((seq,))
+        self._db.execute("BEGIN")
+        self._db.executemany("DELETE FROM kg_log WHERE seq = ?", stale)
+        self._db.execute("COMMIT")
+        return len(stale)
+
+
+kg_log = KnowledgeGraphLog(KG_LOG_PATH) if KG_LOG_PATH else None
+
+
+async def ingest_analysis(analysis: dict):
+    """Add an extraction result to the knowledge graph (through the shared log when replicated)."""
+    if kg_log is None:
+        await add_to_metta_kg(analysis)
+    else:
+        kg_log.append(analysis)
+        await kg_log.apply_pending()
+    if AGENT_ROLE != "worker" and kg_index.size() > kg_atom_budget():
+        await run_kg_retention("high_watermark")
+
+
+# ======= BACKGROUND TASKS =======
+# Max TextContent items of chat messages processed at the same time
+CHAT_ITEM_CONCURRENCY = int(os.environ.get("CHAT_ITEM_CONCURRENCY", "4"))
+
+_chat_item_semaphore = asyncio.Semaphore(CHAT_ITEM_CONCURRENCY)
+_background_tasks: set = set()
+
+
+def _on_background_task_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        log.error("tasks", "background_task_failed", task=task.get_name(), error=str(task.exception()))
+
+
+def spawn_background_task(coro, name: str) -> asyncio.Task:
+    """Run `coro` off the response path, keeping a reference until it finishes."""
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+async def drain_background_tasks(timeout: float = 10.0):
+    """Wait for in-flight background tasks (used on shutdown)."""
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=timeout)
+
+
+async def update_kg_in_background(analysis: dict):
+    await ingest_analysis(analysis)
+
+
+# ======= JOB QUEUE =======
+JOB_QUEUE_PATH = os.environ.get("JOB_QUEUE_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    f"job_queue.worker{AGENT_WORKER_INDEX}.db" if AGENT_ROLE == "worker" else "job_queue.db"
+)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "6"))
+JOB_BASE_BACKOFF = float(os.environ.get("JOB_BASE_BACKOFF", "2.0"))  # seconds, doubled per attempt
+# Dead jobs are kept for inspection, then purged: after this many seconds, or beyond this many rows
+JOB_DEAD_RETENTION = float(os.environ.get("JOB_DEAD_RETENTION", str(7 * 24 * 3600)))
+JOB_DEAD_MAX = int(os.environ.get("JOB_DEAD_MAX", "1000"))
+
+
+class JobQueue:
+    """
+    In-process job queue for post-response side effects, spooled to SQLite so
+    queued work survives a crash. Jobs are retried with exponential backoff and
+    moved to the `dead` state after JOB_MAX_ATTEMPTS failures; dead jobs are purged
+    after JOB_DEAD_RETENTION seconds or once more than JOB_DEAD_MAX pile up.
+    Handlers are async functions taking the JSON payload; raising means retry.
+    """
+
+    def __init__(self, path: str, workers: int = JOB_WORKERS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._handlers = {}
+        self._tasks = []
+        self._wakeup = None
+        self._running = False
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+        self.purged = 0
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL,
+                run_after REAL NOT NULL,
+                last_error TEXT
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(status, run_after)")
+
+    def handler(self, kind: str):
+        """Decorator registering the async handler for a job kind."""
+        def register(func):
+            self._handlers[kind] = func
+            return func
+        return register
+
+    def enqueue(self, kind: str, payload: dict) -> int:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO jobs (kind, payload, enqueued_at, run_after) VALUES (?, ?, ?, ?)",
+            (kind, json.dumps(payload), now, now)
+        )
+        if self._wakeup:
+            self._wakeup.set()
+        return cursor.lastrowid
+
+    async def start(self):
+        # Jobs left 'running' by a crashed process are picked up again
+        self._db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        self.purge_dead()
+        self._wakeup = asyncio.Event()
+        self._running = True
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"job-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def stop(self):
+        # wait_for() on 3.11 can swallow a cancel that races the wakeup event, so workers
+        # also check the flag
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def purge_dead(self) -> int:
+        """Drop dead jobs past the retention window or beyond the newest JOB_DEAD_MAX."""
+        # A dead job's run_after is the time it died
+        cursor = self._db.execute(
+            "DELETE FROM jobs WHERE status = 'dead' AND (run_after < ? OR id NOT IN "
+            "(SELECT id FROM jobs WHERE status = 'dead' ORDER BY id DESC LIMIT ?))",
+            (time.time() - JOB_DEAD_RETENTION, JOB_DEAD_MAX)
+        )
+        self.purged += cursor.rowcount
+        return cursor.rowcount
+
+    def _claim(self):
+        # Runs without awaiting, so claims are atomic on the event loop
+        row = self._db.execute(
+            "SELECT id, kind, payload, attempts FROM jobs "
+            "WHERE status = 'pending' AND run_after <= ? ORDER BY id LIMIT 1",
+            (time.time(),)
+        ).fetchone()
+        if row:
+            self._db.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (row[0],))
+        return row
+
+    def _next_run_after(self):
+        row = self._db.execute("SELECT MIN(run_after) FROM jobs WHERE status = 'pending'").fetchone()
+        return row[0] if row else None
+
+    async def _worker(self):
+        while self._running:
+            job = self._claim()
+            if job is None:
+                next_at = self._next_run_after()
+                delay = 5.0 if next_at is None else min(max(next_at - time.time(), 0.05), 5.0)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, kind, payload, attempts = job
+            token = request_id_var.set(f"job-{job_id}")
+            try:
+                handler = self._handlers[kind]
+                await handler(json.loads(payload))
+            except asyncio.CancelledError:
+                self._db.execute("UPDATE jobs SET status = 'pending' WHERE id = ?", (job_id,))
+                raise
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    self.dead += 1
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'dead', attempts = ?, last_error = ?, run_after = ? WHERE id = ?",
+                        (attempts, str(e), time.time(), job_id)
+                    )
+                    log.error("jobs", "job_dead", kind=kind, job_id=job_id, attempts=attempts, error=str(e))
+                    self.purge_dead()
+                else:
+                    self.retried += 1
+                    backoff = JOB_BASE_BACKOFF * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                    self._db.execute(
+                        "UPDATE jobs SET status = 'pending', attempts = ?, last_error = ?, run_after = ? WHERE id = ?",
+                        (attempts, str(e), time.time() + backoff, job_id)
+                    )
+                    log.warning("jobs", "job_retry", kind=kind, job_id=job_id, attempts=attempts,
+                                backoff=round(backoff, 1), error=str(e))
+            else:
+                self.completed += 1
+                self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            finally:
+                request_id_var.reset(token)
+
+    def metrics(self) -> dict:
+        counts = dict(self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        oldest = self._db.execute(
+            "SELECT MIN(enqueued_at) FROM jobs WHERE status IN ('pending', 'running')"
+        ).fetchone()[0]
+        return {
+            "depth": counts.get("pending", 0) + counts.get("running", 0),
+            "running": counts.get("running", 0),
+            "dead": counts.get("dead", 0),
+            "oldest_age_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.dead,
+            "purged": self.purged,
+            "workers": len(self._tasks),
+        }
+
+
+job_queue = JobQueue(JOB_QUEUE_PATH)
+
+
+@job_queue.handler("ingest_metta")
+async def job_ingest_metta(payload: dict):
+    await ingest_analysis(payload["analysis"])
+
+
+@job_queue.handler("store_sentence")
+async def job_store_sentence(payload: dict):
+    if not supabase_client:
+        return
+    if not await store_to_supabase(
+        payload["sentence"], payload["url"], payload["user_id"], payload["analysis"], row_id=payload["row_id"]
+    ):
+        raise RuntimeError("captured_sentences upsert failed")
+    # Keep the user's cluster aggregates warm so gap detection stays O(clusters),
+    # and start quiz pools for clusters that are weak
+    try:
+        clusters = await cluster_aggregates.refresh(payload["user_id"])
+        weak_clusters = await detect_weak_clusters(clusters)
+        quiz_pools.prefetch(payload["user_id"], [c["cluster"] for c in weak_clusters])
+    except Exception as e:
+        log.warning("supabase", "cluster_refresh_failed", error=str(e))
+
+
+@job_queue.handler("store_insight")
+async def job_store_insight(payload: dict):
+    if not supabase_client:
+        return
+    recent_key = f"{payload['user_id']}:{payload.get('dedupe_key')}"
+    try:
+        if not await store_insight_to_supabase(
+            payload["user_id"], payload["insight_type"], payload["content"], payload["metadata"],
+            row_id=payload["row_id"], dedupe_key=payload.get("dedupe_key")
+        ):
+            raise RuntimeError("insights upsert failed")
+        remember_insight(recent_key)
+    finally:
+        _queued_insight_keys.discard(recent_key)
+
+
+_definition_jobs = set()  # terms with a learn_definition job queued
+
+
+def queue_definition(term: str, context: str):
+    """Learn a cache definition for a term the LLM had to explain, once per term."""
+    symbol = term_dict.canonical(term)
+    if symbol in _definition_jobs or explanation_cache.get(term, context) is not None:
+        return
+    _definition_jobs.add(symbol)
+    job_queue.enqueue("learn_definition", {"term": term, "context": context})
+
+
+@job_queue.handler("learn_definition")
+async def job_learn_definition(payload: dict):
+    term, context = payload["term"], payload["context"]
+    try:
+        if explanation_cache.get(term, context) is not None:
+            return
+        definition = await asyncio.to_thread(define_term_with_asi, term, context)
+        if not definition:
+            raise RuntimeError(f"empty definition for {term}")
+        explanation_cache.learn(term, context, term, definition)
+    finally:
+        _definition_jobs.discard(term_dict.canonical(term))
+
+
+# Recently written insight keys, so repeated polls skip the queue and the database
+RECENT_INSIGHT_KEYS_SIZE = int(os.environ.get("RECENT_INSIGHT_KEYS_SIZE", "10000"))
+_recent_insight_keys: OrderedDict = OrderedDict()
+_queued_insight_keys = set()  # keys with a store_insight attempt pending
+
+
+def remember_insight(recent_key: str):
+    """Record a key once its insight is stored (a failed or dead job leaves it unrecorded)."""
+    _recent_insight_keys[recent_key] = None
+    _recent_insight_keys.move_to_end(recent_key)
+    if len(_recent_insight_keys) > RECENT_INSIGHT_KEYS_SIZE:
+        _recent_insight_keys.popitem(last=False)
+
+
+def insight_dedupe_key(insight_type: str, cluster: str, content: str) -> str:
+    """Per-user dedupe key (the user is the other half of the unique index)."""
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+    return f"{insight_type}:{(cluster or '').lower()}:{content_hash}"
+
+
+def enqueue_insight(user_id: str, insight_type: str, content: str, metadata: dict) -> bool:
+    """
+    Queue an idempotent insight write keyed by (user, type, cluster, content hash).
+    Returns False if there is nowhere to store it, it was written recently or a write
+    for it is already queued.
+    """
+    if not supabase_client or not user_id:
+        return False
+
+    dedupe_key = insight_dedupe_key(insight_type, metadata.get("cluster"), content)
+    recent_key = f"{user_id}:{dedupe_key}"
+    if recent_key in _recent_insight_keys:
+        _recent_insight_keys.move_to_end(recent_key)
+        return False
+    if recent_key in _queued_insight_keys:
+        return False
+    _queued_insight_keys.add(recent_key)
+
+    job_queue.enqueue("store_insight", {
+        # Deterministic id, so a retried job targets the same row
+        "row_id": str(uuid5(NAMESPACE_URL, f"fluent:insight:{recent_key}")),
+        "dedupe_key": dedupe_key,
+        "user_id": user_id,
+        "insight_type": insight_type,
+        "content": content,
+        "metadata": metadata,
+    })
+    return True
+
+
+# ======= QUIZ POOLS =======
+QUIZ_POOL_TARGET = int(os.environ.get("QUIZ_POOL_TARGET", "12"))  # questions kept ready per cluster and difficulty
+QUIZ_POOL_LOW_WATERMARK = int(os.environ.get("QUIZ_POOL_LOW_WATERMARK", "6"))  # refill below this
+QUIZ_QUESTIONS_PER_QUIZ = 3
+QUIZ_REFILL_BATCH = 5        # questions asked for per LLM call
+QUIZ_REFILL_MAX_CALLS = 4    # per refill job, so a model repeating itself cannot loop forever
+QUIZ_SEEN_SIZE = 200         # question keys remembered per user and cluster for dedupe
+QUIZ_DIFFICULTIES = (1, 2, 3)
+QUIZ_PREFETCH_DIFFICULTY = 2  # what the quiz modal asks for
+QUIZ_SAVE_RETRIES = 5        # attempts at a pool update when other workers keep writing the same row
+
+
+def quiz_question_key(question: dict) -> str:
+    """Dedupe key: the question text with case, punctuation and spacing folded away."""
+    text = re.sub(r"[^a-z0-9]+", " ", str(question.get("question", "")).lower()).strip()
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def glossary_quiz_questions(glossary: list) -> dict:
+    """Quiz entries from the glossary as QuizQuestion dicts, grouped by folded cluster name."""
+    by_cluster = defaultdict(list)
+    for entry in glossary:
+        quiz = entry.get("quiz") or {}
+        answers = quiz.get("answers") or []
+        correct = quiz.get("correct")
+        if not quiz.get("question") or not isinstance(correct, int) or not 0 <= correct < min(len(answers), 4):
+            continue
+        question = {
+            "question": quiz["question"],
+            "options": answers[:4],
+            "correct": "abcd"[correct],
+            "explanation": glossary_definitions(entry).get("General") or quiz.get("hint", ""),
+        }
+        category = entry.get("category", "General")
+        for cluster in {category, GLOSSARY_CATEGORY_CONTEXTS.get(category, category)}:
+            by_cluster[TermDictionary.fold(cluster)].append(question)
+    return dict(by_cluster)
+
+
+class QuizPools:
+    """
+    Ready-made quiz questions per (user, cluster, difficulty), persisted as one
+    quiz_questions_cache row per user and cluster. Requests are served from the pool;
+    a pool that drops below QUIZ_POOL_LOW_WATERMARK is topped up to QUIZ_POOL_TARGET
+    by a background job, and weak clusters are filled before anyone asks.
+
+    The row is shared by every worker process, so each change re-reads it, applies
+    just that change (take these questions, add those) and writes it back only if its
+    version is unchanged, retrying otherwise. The in-memory copy is only a hint.
+    """
+
+    def __init__(self, glossary: list):
+        self._pools = {}         # (user_id, cluster) -> last state seen: {"pools": {difficulty: [question]}, "seen": [key], ...}
+        self._refilling = set()  # (user_id, cluster, difficulty) with a refill job queued
+        self._glossary = glossary_quiz_questions(glossary)
+        self.stats = {"served": 0, "pool_hits": 0, "glossary": 0, "fallback": 0,
+                      "generated": 0, "duplicates": 0, "refills": 0, "conflicts": 0}
+
+    @staticmethod
+    def _empty() -> dict:
+        # version None: no row yet; "legacy": a row written before versioning
+        return {"pools": {}, "seen": [], "generated_at": None, "version": None}
+
+    @classmethod
+    def _load_row(cls, user_id: str, cluster: str) -> dict:
+        """Read the shared row; raises on Supabase errors so a failed read never overwrites it."""
+        state = cls._empty()
+        rows = supabase_client.table("quiz_questions_cache")\
+            .select("questions_json, generated_at")\
+            .eq("user_id", user_id)\
+            .eq("domain", cluster)\
+            .limit(1)\
+            .execute().data
+        if not rows:
+            return state
+        saved = rows[0].get("questions_json")
+        state["version"] = "legacy"
+        if isinstance(saved, dict):
+            state["pools"] = {int(level): list(pool) for level, pool in (saved.get("pools") or {}).items()}
+            state["seen"] = list(saved.get("seen") or [])
+            state["version"] = saved.get("version", "legacy")
+        state["generated_at"] = rows[0].get("generated_at")
+        return state
+
+    @staticmethod
+    def _write(user_id: str, cluster: str, state: dict) -> bool:
+        """Write the row if nobody changed it since it was read; False on a conflict."""
+        read_version = state["version"]
+        version = read_version + 1 if isinstance(read_version, int) else 1
+        pools = {str(level): list(pool) for level, pool in state["pools"].items()}
+        row = {
+            "questions_json": {"pools": pools, "seen": state["seen"][-QUIZ_SEEN_SIZE:], "version": version},
+            "generated_at": state["generated_at"] or datetime.utcnow().isoformat(),
+            "used": not any(pools.values()),
+        }
+        table = supabase_client.table("quiz_questions_cache")
+        if read_version is None:
+            try:
+                table.insert({"user_id": user_id, "domain": cluster, **row}).execute()
+            except Exception:
+                return False  # another worker created the row first (unique user_id, domain)
+        else:
+            query = table.update(row).eq("user_id", user_id).eq("domain", cluster)
+            if read_version == "legacy":
+                query = query.is_("questions_json->>version", "null")
+            else:
+                query = query.eq("questions_json->>version", str(read_version))
+            if not query.execute().data:
+                return False
+        state["version"] = version
+        return True
+
+    async def _mutate(self, user_id: str, cluster: str, change):
+        """
+        Run change(state) -> (result, changed) on a fresh copy of the pool row and save
+        it with a version check, re-reading and re-applying on conflict.
+        """
+        if not supabase_client or not user_id:
+            return change(self._pools.setdefault((user_id, cluster), self._empty()))[0]
+        for attempt in range(QUIZ_SAVE_RETRIES):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, 0.05 * attempt))  # let the other writer finish
+            state = await asyncio.to_thread(self._load_row, user_id, cluster)
+            result, changed = change(state)
+            if not changed or await asyncio.to_thread(self._write, user_id, cluster, state):
+                self._pools[(user_id, cluster)] = state
+                return result
+            self.stats["conflicts"] += 1
+        raise RuntimeError(f"quiz pool for {cluster} kept changing under us")
+
+    def request_refill(self, user_id: str, cluster: str, difficulty: int) -> bool:
+        """Queue a refill unless the pool is known to be above the low watermark or one is queued."""
+        state = self._pools.get((user_id, cluster))
+        if state is not None and len(state["pools"].get(difficulty, [])) >= QUIZ_POOL_LOW_WATERMARK:
+            return False
+        key = (user_id, cluster, difficulty)
+        if key in self._refilling:
+            return False
+        self._refilling.add(key)
+        job_queue.enqueue("refill_quiz_pool", {"user_id": user_id, "cluster": cluster, "difficulty": difficulty})
+        return True
+
+    def prefetch(self, user_id: str, clusters: list) -> int:
+        """Start filling pools for clusters the user is weak in; returns how many refills were queued."""
+        return sum(self.request_refill(user_id, cluster, QUIZ_PREFETCH_DIFFICULTY) for cluster in clusters)
+
+    def _add(self, state: dict, pool: list, questions: list) -> int:
+        seen = set(state["seen"])
+        added = 0
+        for question in questions:
+            key = quiz_question_key(question)
+            if key in seen:
+                self.stats["duplicates"] += 1
+                continue
+            seen.add(key)
+            state["seen"].append(key)
+            pool.append(question)
+            added += 1
+        del state["seen"][:-QUIZ_SEEN_SIZE]
+        return added
+
+    async def refill(self, user_id: str, cluster: str, difficulty: int) -> int:
+        """Top a pool up to QUIZ_POOL_TARGET with new, deduplicated LLM questions."""
+        try:
+            if supabase_client and user_id:
+                state = await asyncio.to_thread(self._load_row, user_id, cluster)
+            else:
+                state = self._pools.setdefault((user_id, cluster), self._empty())
+            ready = len(state["pools"].get(difficulty, []))
+            if ready >= QUIZ_POOL_TARGET:
+                return 0
+            sentences = await fetch_sentences_for_cluster(user_id, cluster) or [
+                {"sentence": f"This is about {cluster} concepts in Web3."}
+            ]
+            # Generate against a scratch copy, then add to whatever the row holds by then
+            scratch = {"seen": list(state["seen"])}
+            batch = []
+            for _ in range(QUIZ_REFILL_MAX_CALLS):
+                if ready + len(batch) >= QUIZ_POOL_TARGET:
+                    break
+                # A different handful of the user's sentences each call, for variety
+                context = random.sample(sentences, min(5, len(sentences)))
+                questions = await asyncio.to_thread(
+                    generate_quiz_with_asi, cluster, context, difficulty, QUIZ_REFILL_BATCH
+                )
+                if not questions:
+                    break
+                self._add(scratch, batch, questions)
+
+            def add(state: dict):
+                added = self._add(state, state["pools"].setdefault(difficulty, []), batch)
+                if added:
+                    state["generated_at"] = datetime.utcnow().isoformat()
+                return added, bool(added)
+
+            added = await self._mutate(user_id, cluster, add) if batch else 0
+            self.stats["refills"] += 1
+            self.stats["generated"] += added
+            if not added and ready < QUIZ_POOL_LOW_WATERMARK:
+                raise RuntimeError(f"no new quiz questions generated for {cluster}")
+            return added
+        finally:
+            self._refilling.discard((user_id, cluster, difficulty))
+
+    async def take(self, user_id: str, cluster: str, difficulty: int,
+                   count: int = QUIZ_QUESTIONS_PER_QUIZ) -> tuple:
+        """
+        Pop up to `count` ready questions -> (questions, source) without calling the LLM.
+        Falls back to the nearest difficulty, then glossary questions, then a generic one.
+        """
+        def pop(state: dict):
+            questions = []
+            for level in sorted(QUIZ_DIFFICULTIES, key=lambda d: (abs(d - difficulty), d)):
+                pool = state["pools"].get(level, [])
+                while pool and len(questions) < count:
+                    questions.append(pool.pop(0))
+            return questions, bool(questions)
+
+        try:
+            questions = await self._mutate(user_id, cluster, pop)
+        except Exception as e:
+            log.warning("quiz", "pool_take_failed", cluster=cluster, error=str(e))
+            questions = []
+        self.request_refill(user_id, cluster, difficulty)
+
+        source = "pool"
+        if questions:
+            self.stats["pool_hits"] += 1
+        if len(questions) < count:
+            asked = {quiz_question_key(q) for q in questions}
+            extra = [q for q in self._glossary.get(TermDictionary.fold(cluster), [])
+                     if quiz_question_key(q) not in asked]
+            extra = random.sample(extra, min(count - len(questions), len(extra)))
+            if extra and not questions:
+                source = "glossary"
+                self.stats["glossary"] += 1
+            questions.extend(extra)
+        if not questions:
+            source = "fallback"
+            self.stats["fallback"] += 1
+            questions = [{
+                "question": f"What is a key concept in {cluster}?",
+                "options": [
+                    "Decentralization",
+                    "Centralization",
+                    "Traditional banking",
+                    "None of the above"
+                ],
+                "correct": "a",
+                "explanation": f"{cluster} emphasizes decentralized systems."
+            }]
+        self.stats["served"] += 1
+        return questions, source
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats,
+            "pools": len(self._pools),
+            "ready": sum(len(pool) for state in self._pools.values() for pool in state["pools"].values()),
+            "refilling": len(self._refilling),
+        }
+
+
+quiz_pools = QuizPools(glossary_entries)
+
+
+@job_queue.handler("refill_quiz_pool")
+async def job_refill_quiz_pool(payload: dict):
+    await quiz_pools.refill(payload["user_id"], payload["cluster"], payload["difficulty"])
+
+
 # ======= CHAT PROTOCOL =======
 chat_proto = Protocol(name="chat", version="1.0.0", spec=chat_protocol_spec)
 
 
+async def build_chat_response(user_text: str) -> str:
+    """Route one chat text item to a command and build the reply text."""
+    # ===== COMMAND ROUTING =====
+    
+    # 1. MeTTa direct query
+    if user_text.lower().startswith("metta:"):
+        metta_query = user_text[len("metta:"):].strip()
+        result = await metta_reasoning(metta_query)
+        return f"🔗 **[MeTTa Query]**\n`{metta_query}`\n\n**Result:**\n{result}"
+    
+    # 2. Show unexplored concepts
+    if user_text.lower() == "show unexplored":
+        concepts = await get_unexplored_concepts()
+        return f"📚 **All Concepts in Knowledge Graph:**\n{concepts}"
+    
+    # 3. Graph analysis using ASI:One asi1-graph
+    if user_text.lower() == "graph analysis":
+        graph_data = export_metta_graph()
+        analysis_result = await asyncio.to_thread(asi_one_graph_reasoning, graph_data, "overview")
+        return (
+            f"📊 **[Graph Analysis - ASI:One asi1-graph]**\n\n"
+            f"{analysis_result['analysis']}\n\n"
+            f"**Key Insights:**\n"
+            f"{chr(10).join('• ' + insight for insight in analysis_result['insights'][:3])}"
+        )
+    
+    # 4. Normal chat: LLM + Auto-add to MeTTa
+    # Extract concepts using LLM
+    analysis = await asyncio.to_thread(extract_concepts_llm, user_text)
+    
+    # Auto-add to MeTTa knowledge graph after the reply has gone out
+    spawn_background_task(update_kg_in_background(analysis), name="chat-kg-update")
+    
+    # Format response
+    return (
+        f"🔍 **Web3 Concept Analysis**\n\n"
+        f"**Extracted Terms:** {', '.join(analysis.get('terms', []))}\n"
+        f"**Context:** {analysis.get('context', 'General')}\n"
+        f"**Relations Found:** {len(analysis.get('relations', []))}\n\n"
+        f"🕒 **New concepts queued for the knowledge graph.**\n\n"
+        f"💡 In a moment, try: `metta: (match &self (concept $x account_abstraction) $x)` to query the graph."
+    )
+
+
+async def process_text_item(ctx: Context, sender: str, user_text: str):
+    async with _chat_item_semaphore:
+        try:
+            response_text = await build_chat_response(user_text)
+        except Exception as e:
+            ctx.logger.error(f"❌ Error handling chat item: {e}")
+            response_text = f"❌ Error: {str(e)}"
+    
+    # Send response
+    response = ChatMessage(
+        msg_id=uuid4(),
+        timestamp=datetime.utcnow(),
+        content=[TextContent(type="text", text=response_text)]
+    )
+    await ctx.send(sender, response)
+
+
 @chat_proto.on_message(ChatMessage)
 async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
     """Handle incoming chat messages with LLM, MeTTa, and auto-learning."""
@@ -657,64 +3441,18 @@ async def handle_message(ctx: Context, sender: str, msg: ChatMessage):
         acknowledged_msg_id=msg.msg_id
     ))
     
+    # Text items are processed concurrently (bounded by CHAT_ITEM_CONCURRENCY)
+    pending = []
     for item in msg.content:
         if isinstance(item, TextContent):
-            user_text = item.text
-            
-            # ===== COMMAND ROUTING =====
-            
-            # 1. MeTTa direct query
-            if user_text.lower().startswith("metta:"):
-                metta_query = user_text[len("metta:"):].strip()
-                result = metta_reasoning(metta_query)
-                response_text = f"🔗 **[MeTTa Query]**\n`{metta_query}`\n\n**Result:**\n{result}"
-            
-            # 2. Show unexplored concepts
-            elif user_text.lower() == "show unexplored":
-                concepts = get_unexplored_concepts()
-                response_text = f"📚 **All Concepts in Knowledge Graph:**\n{concepts}"
-            
-            # 3. Graph analysis using ASI:One asi1-graph
-            elif user_text.lower() == "graph analysis":
-                graph_data = export_metta_graph()
-                analysis_result = asi_one_graph_reasoning(graph_data, query_type="overview")
-                response_text = (
-                    f"📊 **[Graph Analysis - ASI:One asi1-graph]**\n\n"
-                    f"{analysis_result['analysis']}\n\n"
-                    f"**Key Insights:**\n"
-                    f"{chr(10).join('• ' + insight for insight in analysis_result['insights'][:3])}"
-                )
-            
-            # 4. Normal chat: LLM + Auto-add to MeTTa
-            else:
-                # Extract concepts using LLM
-                analysis = extract_concepts_llm(user_text)
-                
-                # Auto-add to MeTTa knowledge graph
-                add_to_metta_kg(analysis)
-                
-                # Format response
-                response_text = (
-                    f"🔍 **Web3 Concept Analysis**\n\n"
-                    f"**Extracted Terms:** {', '.join(analysis.get('terms', []))}\n"
-                    f"**Context:** {analysis.get('context', 'General')}\n"
-                    f"**Relations Found:** {len(analysis.get('relations', []))}\n\n"
-                    f"✅ **Knowledge graph updated with new concepts!**\n\n"
-                    f"💡 Try: `metta: (match &self (concept $x account_abstraction) $x)` to query the graph."
-                )
-            
-            # Send response
-            response = ChatMessage(
-                msg_id=uuid4(),
-                timestamp=datetime.utcnow(),
-                content=[TextContent(type="text", text=response_text)]
-            )
-            await ctx.send(sender, response)
-            
+            pending.append(process_text_item(ctx, sender, item.text))
         elif isinstance(item, StartSessionContent):
             ctx.logger.info(f"Session started with {sender}")
         elif isinstance(item, EndSessionContent):
             ctx.logger.info(f"Session ended with {sender}")
+    
+    if pending:
+        await asyncio.gather(*pending)
 
 
 @chat_proto.on_message(ChatAcknowledgement)
@@ -723,49 +3461,574 @@ async def handle_acknowledgement(ctx: Context, sender: str, msg: ChatAcknowledge
 
 
 # ======= AGENT SETUP =======
-agent = Agent(
-    name="FluentAgent",
-    port=8010,
-    endpoint=["http://localhost:8010/submit"],
-    mailbox=True,
-    publish_agent_details=True,
-    readme_path="README.md"
-)
+if AGENT_ROLE == "worker":
+    # REST-only worker: no mailbox, no chat protocol
+    agent = Agent(
+        name=f"FluentAgentWorker{AGENT_WORKER_INDEX}",
+        port=WORKER_PORTS[AGENT_WORKER_INDEX],
+        endpoint=[f"http://localhost:{WORKER_PORTS[AGENT_WORKER_INDEX]}/submit"],
+    )
+else:
+    agent = Agent(
+        name="FluentAgent",
+        port=COORDINATOR_PORT if AGENT_ROLE == "coordinator" else AGENT_PORT,
+        endpoint=[f"http://localhost:{AGENT_PORT}/submit"],
+        mailbox=True,
+        publish_agent_details=True,
+        readme_path="README.md"
+    )
+    agent.include(chat_proto, publish_manifest=True)
+
+# Paths of the REST endpoints; the coordinator's front proxy sends these to workers
+rest_routes = set()
+
+
+# path -> (handler, request model or None); replay_traffic.py calls handlers through this
+rest_handlers = {}
+
+
+def with_request_id(endpoint: str, handler):
+    """Tag a REST call (and the tasks it spawns) with a request id, and log its latency."""
+
+    @functools.wraps(handler)
+    async def tagged(ctx, *args):
+        token = request_id_var.set(uuid4().hex[:16])
+        start = time.perf_counter()
+        try:
+            return await handler(ctx, *args)
+        finally:
+            log.info("rest", "request", endpoint=endpoint, ms=round((time.perf_counter() - start) * 1000, 2))
+            request_id_var.reset(token)
+
+    return tagged
+
+
+def rest_post(path: str, request_model, response_model):
+    rest_routes.add(path)
+
+    def register(handler):
+        rest_handlers[path] = (handler, request_model)
+        agent.on_rest_post(path, request_model, response_model)(
+            with_request_id(path, record_traffic(path, handler))
+        )
+        return handler
+
+    return register
+
+
+def rest_get(path: str, response_model):
+    rest_routes.add(path)
+
+    def register(handler):
+        rest_handlers[path] = (handler, None)
+        agent.on_rest_get(path, response_model)(with_request_id(path, record_traffic(path, handler)))
+        return handler
+
+    return register
+
+
+# ======= STREAMING EXPORT =======
+# uagents REST handlers return one Model, so streamed responses get their own small HTTP server
+STREAM_PORT = int(os.environ.get("STREAM_PORT", str(AGENT_PORT + 100)))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+EXPORT_ENCODERS = {
+    "ndjson": ("application/x-ndjson", lambda record: json.dumps(record, separators=(",", ":")).encode() + b"\n"),
+}
+if MSGPACK_AVAILABLE:
+    EXPORT_ENCODERS["msgpack"] = ("application/x-msgpack", lambda record: msgpack.packb(record))
+
+
+def _http_response(status: str, body: str = "", content_type: str = "text/plain") -> bytes:
+    data = body.encode()
+    return (
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n"
+    ).encode() + data
+
+
+async def _write_chunk(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(f"{len(data):x}\r\n".encode() + bytes(data) + b"\r\n")
+    await writer.drain()
+
+
+async def stream_graph_export(writer: asyncio.StreamWriter, params: dict):
+    """
+    GET /export-graph?format=ndjson|msgpack&cursor=...&limit=...&context=...
+    Streams records with chunked encoding in constant memory. The last record is
+    {"type": "end", "count": n, "next_cursor": <cursor or null>, "version": v}.
+    """
+    export_format = params.get("format", "ndjson")
+    if export_format not in EXPORT_ENCODERS:
+        writer.write(_http_response("400 Bad Request", f"Unsupported format: {export_format}"))
+        return
+    try:
+        limit = int(params.get("limit") or 0)
+        parse_export_cursor(params.get("cursor"))
+    except ValueError as e:
+        writer.write(_http_response("410 Gone" if "expired" in str(e) else "400 Bad Request", str(e)))
+        return
+
+    content_type, encode = EXPORT_ENCODERS[export_format]
+    writer.write(
+        f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\n"
+        f"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n".encode()
+    )
+
+    buffer, count, next_cursor = bytearray(), 0, None
+    for cursor, record in iter_graph_records(params.get("cursor"), params.get("context")):
+        buffer += encode(record)
+        count += 1
+        if limit and count >= limit:
+            next_cursor = cursor
+            break
+        if len(buffer) >= STREAM_CHUNK_SIZE:
+            await _write_chunk(writer, buffer)
+            buffer.clear()
+
+    buffer += encode({"type": "end", "count": count, "next_cursor": next_cursor, "version": kg_index.version})
+    await _write_chunk(writer, buffer)
+    writer.write(b"0\r\n\r\n")
+
+
+async def stream_badge_blob(writer: asyncio.StreamWriter, digest: str, params: dict, headers: dict):
+    """
+    GET /badge/<sha256>.png[?format=base64]
+    Sends a stored badge with sendfile (no copy through Python), or as base64 text
+    encoded chunk by chunk. Blobs never change, so they are cacheable forever.
+    """
+    path = badge_blobs.path(digest)
+    if path is None or not os.path.exists(path):
+        writer.write(_http_response("404 Not Found", "Unknown badge image"))
+        return
+    etag = f'"{digest}"'
+    cache_headers = f"ETag: {etag}\r\nCache-Control: public, max-age=31536000, immutable\r\n"
+    if headers.get("if-none-match") == etag:
+        writer.write(f"HTTP/1.1 304 Not Modified\r\n{cache_headers}Connection: close\r\n\r\n".encode())
+        return
+
+    if params.get("format") == "base64":
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n{cache_headers}"
+            f"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n".encode()
+        )
+        for chunk in badge_blobs.iter_base64(digest):
+            await _write_chunk(writer, chunk)
+        writer.write(b"0\r\n\r\n")
+        return
+
+    with open(path, "rb") as fh:
+        size = os.fstat(fh.fileno()).st_size
+        writer.write(
+            f"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\nContent-Length: {size}\r\n"
+            f"{cache_headers}Connection: close\r\n\r\n".encode()
+        )
+        await asyncio.get_running_loop().sendfile(writer.transport, fh)
+
+
+async def stream_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        request_line, _, header_block = head.decode("latin-1").partition("\r\n")
+        method, target, _ = request_line.split(" ", 2)
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        headers = {}
+        for line in header_block.split("\r\n"):
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        if method == "GET" and url.path == "/export-graph":
+            await stream_graph_export(writer, params)
+        elif method == "GET" and url.path.startswith("/badge/") and url.path.endswith(".png"):
+            await stream_badge_blob(writer, url.path[len("/badge/"):-len(".png")], params, headers)
+        else:
+            writer.write(_http_response("404 Not Found", "Not found"))
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError) as e:
+        log.error("stream", "request_failed", error=str(e))
+    finally:
+        writer.close()
+
+
+# ======= ADMISSION CONTROL =======
+# path: (max concurrent, max queued, max queue wait in seconds, priority class)
+ADMISSION_LIMITS = {
+    "/explain-sentence": (32, 64, 5.0, "interactive"),
+    "/detect-gaps": (8, 16, 3.0, "batch"),
+    "/generate-quiz": (8, 16, 3.0, "batch"),
+    "/graph-changes": (16, 32, 3.0, "batch"),
+    "/graph-analysis": (4, 8, 2.0, "expensive"),
+    "/generate-badge-image": (2, 4, 1.0, "expensive"),
+}
+# Requests of a class are shed outright once overall load (in flight + queued,
+# relative to total capacity) reaches this level, so expensive work goes first
+SHED_PRESSURE = {"expensive": 0.75, "batch": 1.0, "interactive": 1.5}
+# Max share of an endpoint's concurrency one user may hold
+USER_FAIR_SHARE = float(os.environ.get("USER_FAIR_SHARE", "0.25"))
+
+
+class EndpointGate:
+    """Concurrency cap and FIFO wait queue for one endpoint."""
+
+    def __init__(self, limit: int, queue: int, max_wait: float, priority: str):
+        self.limit = limit
+        self.queue = queue
+        self.max_wait = max_wait
+        self.priority = priority
+        self.user_limit = max(1, int(limit * USER_FAIR_SHARE))
+        self.in_flight = 0
+        self.waiters = deque()  # (enqueued_at, future)
+        self.per_user = defaultdict(int)
+        self.latency = 1.0      # EWMA of service time, seconds
+        self.admitted = self.shed = self.throttled = 0
+
+    def retry_after(self) -> int:
+        """Rough time until a slot frees up for a request arriving now."""
+        backlog = (len(self.waiters) + 1) / self.limit
+        return min(max(math.ceil(self.latency * backlog), 1), 30)
+
+
+class AdmissionController:
+    """
+    Admission control for the front proxy: per-endpoint concurrency caps, shedding
+    on queue depth, queue age and overall pressure (by priority class), and
+    per-user fair-share limits. Unlisted paths (e.g. /health) are never gated.
+    """
+
+    def __init__(self, limits: dict):
+        self.gates = {path: EndpointGate(*config) for path, config in limits.items()}
+        self.capacity = sum(gate.limit for gate in self.gates.values())
+
+    def pressure(self) -> float:
+        return sum(g.in_flight + len(g.waiters) for g in self.gates.values()) / self.capacity
+
+    async def acquire(self, path: str, user_id: str = ""):
+        """Returns None when admitted (or ungated), else (status line, retry_after seconds)."""
+        gate = self.gates.get(path)
+        if gate is None:
+            return None
+
+        if self.pressure() >= SHED_PRESSURE[gate.priority]:
+            gate.shed += 1
+            return "503 Service Unavailable", gate.retry_after()
+        # per_user counts a user's queued requests as well as admitted ones, so a user
+        # cannot fill the queue and then exceed the limit as slots are handed over
+        if user_id and gate.per_user[user_id] >= gate.user_limit:
+            gate.throttled += 1
+            return "429 Too Many Requests", 1
+        if user_id:
+            gate.per_user[user_id] += 1
+
+        if gate.in_flight < gate.limit and not gate.waiters:
+            gate.in_flight += 1
+        else:
+            now = time.monotonic()
+            if len(gate.waiters) >= gate.queue or (gate.waiters and now - gate.waiters[0][0] > gate.max_wait):
+                self._forget_user(gate, user_id)
+                gate.shed += 1
+                return "503 Service Unavailable", gate.retry_after()
+
+            entry = (now, asyncio.get_running_loop().create_future())
+            gate.waiters.append(entry)
+            await asyncio.wait({entry[1]}, timeout=gate.max_wait)
+            if not entry[1].done():
+                # Timed out; a released slot is handed over by setting the future
+                gate.waiters.remove(entry)
+                entry[1].cancel()
+                self._forget_user(gate, user_id)
+                gate.shed += 1
+                return "503 Service Unavailable", gate.retry_after()
+
+        gate.admitted += 1
+        return None
+
+    @staticmethod
+    def _forget_user(gate, user_id: str):
+        if user_id:
+            gate.per_user[user_id] -= 1
+            if gate.per_user[user_id] <= 0:
+                del gate.per_user[user_id]
+
+    def release(self, path: str, user_id: str, elapsed: float):
+        gate = self.gates.get(path)
+        if gate is None:
+            return
+        gate.latency = 0.8 * gate.latency + 0.2 * elapsed
+        self._forget_user(gate, user_id)
+        if gate.waiters:
+            # Hand the slot straight to the oldest waiter
+            gate.waiters.popleft()[1].set_result(True)
+        else:
+            gate.in_flight -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "pressure": round(self.pressure(), 3),
+            "endpoints": {
+                path: {
+                    "in_flight": gate.in_flight,
+                    "queued": len(gate.waiters),
+                    "admitted": gate.admitted,
+                    "shed": gate.shed,
+                    "throttled": gate.throttled,
+                    "latency_ewma": round(gate.latency, 3),
+                }
+                for path, gate in self.gates.items()
+            },
+        }
+
+
+admission = AdmissionController(ADMISSION_LIMITS) if ADMISSION_CONTROL else None
+
+
+def _request_user_id(body: bytes) -> str:
+    """Best-effort user_id from a small JSON request body, for fair-share accounting."""
+    if not body or len(body) > 64 * 1024:
+        return ""
+    try:
+        payload = _json_loads(body)
+    except ValueError:
+        return ""
+    return str(payload.get("user_id") or "") if isinstance(payload, dict) else ""
+
+
+# ======= MULTI-WORKER MODE =======
+worker_processes = {}
+_worker_rotation = itertools.count()
+
+_BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+_LENGTH_REQUIRED = b"HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+def spawn_worker(index: int):
+    env = {**os.environ, "AGENT_ROLE": "worker", "AGENT_WORKER_INDEX": str(index)}
+    worker_processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    log.info("workers", "worker_started", index=index, port=WORKER_PORTS[index], pid=worker_processes[index].pid)
+
+
+def stop_workers():
+    for proc in worker_processes.values():
+        if proc.poll() is None:
+            proc.terminate()
+    for proc in worker_processes.values():
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+async def supervise_workers(ctx: Context):
+    """Restart workers that exited."""
+    for index, proc in list(worker_processes.items()):
+        if proc.poll() is not None:
+            ctx.logger.warning(f"Worker {index} exited with {proc.returncode}, restarting")
+            spawn_worker(index)
+
+
+async def proxy_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """
+    Minimal HTTP/1.1 reverse proxy for the front port: REST endpoint paths are
+    spread round-robin over the workers, everything else (e.g. /submit envelopes)
+    goes to the coordinator agent. One request per connection.
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+        request_line, _, header_block = head[:-4].partition(b"\r\n")
+        method, target, version = request_line.decode("latin-1").split(" ", 2)
 
-agent.include(chat_proto, publish_manifest=True)
+        headers, length, chunked = [], 0, False
+        for line in header_block.decode("latin-1").split("\r\n"):
+            name, _, value = line.partition(":")
+            name_lower = name.strip().lower()
+            if name_lower == "content-length":
+                length = int(value.strip())
+            elif name_lower == "transfer-encoding":
+                chunked = True
+            if name_lower in ("connection", "keep-alive", "proxy-connection"):
+                continue
+            headers.append(line)
+        body = b"" if chunked and not length else (await reader.readexactly(length) if length else b"")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+        writer.close()
+        return
+
+    if chunked and not length:
+        writer.write(_LENGTH_REQUIRED)
+        await _close_writer(writer)
+        return
+
+    path = target.split("?", 1)[0]
+    if admission and path == "/metrics/admission":
+        writer.write(_http_response("200 OK", json.dumps(admission.metrics()), "application/json"))
+        await _close_writer(writer)
+        return
+
+    user_id = ""
+    if admission and path in admission.gates:
+        user_id = _request_user_id(body)
+        rejected = await admission.acquire(path, user_id)
+        if rejected:
+            status, retry_after = rejected
+            writer.write(
+                f"HTTP/1.1 {status}\r\nRetry-After: {retry_after}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: 2\r\nConnection: close\r\n\r\n{{}}".encode()
+            )
+            await _close_writer(writer)
+            return
+
+    upstream_request = (
+        f"{method} {target} {version}\r\n" + "\r\n".join(headers + ["Connection: close"]) + "\r\n\r\n"
+    ).encode("latin-1") + body
+
+    if path in rest_routes and WORKER_PORTS:
+        start = next(_worker_rotation) % len(WORKER_PORTS)
+        ports = WORKER_PORTS[start:] + WORKER_PORTS[:start]
+    else:
+        ports = [COORDINATOR_PORT]
+
+    started = time.monotonic()
+    try:
+        for port in ports:
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", port)
+            except OSError:
+                continue
+            upstream_writer.write(upstream_request)
+            await upstream_writer.drain()
+            while chunk := await upstream_reader.read(65536):
+                writer.write(chunk)
+                await writer.drain()
+            upstream_writer.close()
+            break
+        else:
+            writer.write(_BAD_GATEWAY)
+        await writer.drain()
+    except (ConnectionError, OSError) as e:
+        log.error("proxy", "upstream_failed", target=target, error=str(e))
+    finally:
+        if admission:
+            admission.release(path, user_id, time.monotonic() - started)
+        writer.close()
+
+
+async def _close_writer(writer: asyncio.StreamWriter):
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+
+async def sync_kg_replica(ctx: Context):
+    applied = await kg_log.apply_pending()
+    if applied:
+        ctx.logger.debug(f"Applied {applied} knowledge-graph log entries")
+        # Workers ingest; the coordinator sees their writes here and evicts for everyone
+        if AGENT_ROLE == "coordinator" and kg_index.size() > kg_atom_budget():
+            await run_kg_retention("high_watermark")
+
+
+if kg_log is not None:
+    agent.on_interval(period=KG_SYNC_INTERVAL)(sync_kg_replica)
+
+
+async def kg_retention(ctx: Context):
+    removed = await run_kg_retention()
+    if any(removed.values()):
+        ctx.logger.info(
+            f"🧹 Knowledge-graph retention: {removed['expired']} expired, {removed['compacted']} compacted, "
+            f"{removed['evicted']} evicted ({kg_index.size()} atoms left)"
+        )
+
+
+agent.on_interval(period=KG_RETENTION_INTERVAL)(kg_retention)
+
+if AGENT_ROLE == "coordinator":
+    agent.on_interval(period=5.0)(supervise_workers)
+
+
+@agent.on_event("startup")
+async def handle_startup(ctx: Context):
+    if kg_log is not None:
+        replayed = await kg_log.apply_pending(limit=1_000_000)
+        ctx.logger.info(f"🧠 Replayed {replayed} entries from knowledge-graph log {kg_log.path}")
+    await job_queue.start()
+    ctx.logger.info(f"📦 Job queue started ({job_queue.workers} workers, spool: {job_queue.path})")
+    if AGENT_ROLE != "worker":
+        await asyncio.start_server(stream_connection, "0.0.0.0", STREAM_PORT)
+        ctx.logger.info(f"📤 Streaming server on port {STREAM_PORT} (/export-graph, /badge/<id>.png)")
+    if AGENT_ROLE == "coordinator":
+        for index in range(AGENT_WORKERS):
+            spawn_worker(index)
+        await asyncio.start_server(proxy_connection, "0.0.0.0", AGENT_PORT)
+        ctx.logger.info(f"🔀 Front proxy on port {AGENT_PORT} -> workers {WORKER_PORTS}")
+
+
+@agent.on_event("shutdown")
+async def handle_shutdown(ctx: Context):
+    """Let deferred knowledge-graph updates finish before the agent exits."""
+    await drain_background_tasks()
+    await job_queue.stop()
+    await kg_writer.stop()
+    if traffic_recorder is not None:
+        traffic_recorder.flush()
+    if AGENT_ROLE == "coordinator":
+        stop_workers()
+    log.close()
 
 # ======= REST ENDPOINTS =======
-@agent.on_rest_post("/explain-sentence", SentenceRequest, SentenceResponse)
+@rest_post("/explain-sentence", SentenceRequest, SentenceResponse)
 async def handle_explain_sentence(ctx: Context, req: SentenceRequest) -> SentenceResponse:
     """
     REST endpoint for extension to send sentences for explanation.
     Processes with LLM, stores in MeTTa + Supabase, returns simple explanation.
     """
-    ctx.logger.info(f"📥 Received sentence: {req.sentence[:60]}...")
+    log.debug("rest", "sentence_received", sentence=req.sentence[:60])
     
     try:
-        # Extract concepts using LLM
-        analysis = extract_concepts_llm(req.sentence)
-        
-        # Generate personalized explanation using ASI:One
-        known_concepts = analysis.get("terms", [])
-        explanation = asi_one_explain(req.sentence, known_concepts)
+        # Sentences dominated by known concepts are answered without the LLM
+        local = explanation_cache.explain_locally(req.sentence)
+        if local is not None:
+            analysis, explanation = local
+        else:
+            # Extract concepts using LLM (blocking HTTP runs in a thread, off the event loop)
+            analysis = await asyncio.to_thread(extract_concepts_llm, req.sentence)
+            
+            # Generate personalized explanation using ASI:One
+            known_concepts = analysis.get("terms", [])
+            explanation = await asyncio.to_thread(
+                asi_one_explain, req.sentence, known_concepts, analysis.get("context", "General")
+            )
+            if known_concepts:
+                # Cache a term-level definition for next time (the answer above is sentence-specific)
+                queue_definition(known_concepts[0], analysis.get("context", "General"))
         
         # Add explanation to analysis for storage
         analysis["explanation"] = explanation
         
-        # Add to MeTTa knowledge graph
-        add_to_metta_kg(analysis)
+        # Add to MeTTa knowledge graph (queued, off the response path)
+        job_queue.enqueue("ingest_metta", {"analysis": analysis})
         
-        # Store in Supabase (if configured and user authenticated)
+        # Store in Supabase (if configured and user authenticated).
+        # `captured` means the write is durably queued.
         captured = False
-        if req.user_id:
-            captured = await store_to_supabase(
-                req.sentence, 
-                req.url, 
-                req.user_id, 
-                analysis
-            )
+        if req.user_id and supabase_client:
+            job_queue.enqueue("store_sentence", {
+                "row_id": str(uuid4()),
+                "sentence": req.sentence,
+                "url": req.url,
+                "user_id": req.user_id,
+                "analysis": analysis,
+            })
+            captured = True
         
         return SentenceResponse(
             explanation=explanation,
@@ -776,7 +4039,7 @@ async def handle_explain_sentence(ctx: Context, req: SentenceRequest) -> Sentenc
             timestamp=int(time.time())
         )
     except Exception as e:
-        ctx.logger.error(f"❌ Error processing sentence: {e}")
+        log.error("rest", "explain_failed", error=str(e))
         return SentenceResponse(
             explanation=f"Error: {str(e)}",
             concepts=[],
@@ -786,7 +4049,7 @@ async def handle_explain_sentence(ctx: Context, req: SentenceRequest) -> Sentenc
             timestamp=int(time.time())
         )
 
-@agent.on_rest_get("/health", HealthResponse)
+@rest_get("/health", HealthResponse)
 async def health_check(ctx: Context) -> HealthResponse:
     """Health check endpoint."""
     return HealthResponse(
@@ -797,13 +4060,34 @@ async def health_check(ctx: Context) -> HealthResponse:
         supabase_connected=supabase_client is not None
     )
 
-@agent.on_rest_post("/graph-analysis", GraphAnalysisRequest, GraphAnalysisResponse)
+@rest_get("/metrics/jobs", JobQueueMetricsResponse)
+async def job_queue_metrics(ctx: Context) -> JobQueueMetricsResponse:
+    """Queue depth, oldest pending job age and retry counters for the job queue."""
+    return JobQueueMetricsResponse(**job_queue.metrics(), timestamp=int(time.time()))
+
+@rest_get("/metrics/kg", KgMetricsResponse)
+async def kg_metrics(ctx: Context) -> KgMetricsResponse:
+    """Knowledge-graph size, memory watermarks and retention counters."""
+    return KgMetricsResponse(**kg_retention_metrics())
+
+@rest_get("/metrics/llm", LlmMetricsResponse)
+async def llm_metrics(ctx: Context) -> LlmMetricsResponse:
+    """Structured-output, cache, quiz pool and model routing counters."""
+    return LlmMetricsResponse(
+        structured_output=structured_output_metrics(),
+        explanation_cache=explanation_cache.metrics(),
+        quiz_pools=quiz_pools.metrics(),
+        routing=model_router.metrics(),
+        timestamp=int(time.time())
+    )
+
+@rest_post("/graph-analysis", GraphAnalysisRequest, GraphAnalysisResponse)
 async def handle_graph_analysis(ctx: Context, req: GraphAnalysisRequest) -> GraphAnalysisResponse:
     """
     REST endpoint for advanced graph analysis using ASI:One asi1-graph.
     Analyzes the MeTTa knowledge graph and provides insights.
     """
-    ctx.logger.info(f"📊 Graph analysis requested: {req.query_type}")
+    log.debug("rest", "graph_analysis_requested", query_type=req.query_type)
     
     try:
         # Export current MeTTa knowledge graph
@@ -816,7 +4100,7 @@ async def handle_graph_analysis(ctx: Context, req: GraphAnalysisRequest) -> Grap
             graph_data_with_context = graph_data
         
         # Perform graph reasoning with ASI:One asi1-graph
-        result = asi_one_graph_reasoning(graph_data_with_context, req.query_type)
+        result = await asyncio.to_thread(asi_one_graph_reasoning, graph_data_with_context, req.query_type)
         
         return GraphAnalysisResponse(
             analysis=result["analysis"],
@@ -825,7 +4109,7 @@ async def handle_graph_analysis(ctx: Context, req: GraphAnalysisRequest) -> Grap
             timestamp=int(time.time())
         )
     except Exception as e:
-        ctx.logger.error(f"❌ Error in graph analysis: {e}")
+        log.error("rest", "graph_analysis_failed", error=str(e))
         return GraphAnalysisResponse(
             analysis=f"Error analyzing graph: {str(e)}",
             insights=[],
@@ -833,19 +4117,47 @@ async def handle_graph_analysis(ctx: Context, req: GraphAnalysisRequest) -> Grap
             timestamp=int(time.time())
         )
 
-@agent.on_rest_post("/detect-gaps", GapDetectionRequest, GapDetectionResponse)
+@rest_post("/graph-changes", GraphChangesRequest, GraphChangesResponse)
+async def handle_graph_changes(ctx: Context, req: GraphChangesRequest) -> GraphChangesResponse:
+    """
+    REST endpoint for delta sync: nodes, edges and insights changed since the
+    client's last `version`, with deleted ids as tombstones.
+    """
+    empty = {"nodes": [], "edges": [], "insights": []}
+    if not supabase_client or not req.user_id:
+        return GraphChangesResponse(
+            version=req.since, deleted=dict(empty), error="Supabase is not configured", **empty
+        )
+
+    try:
+        limit = min(max(req.limit, 1), GRAPH_CHANGES_MAX_LIMIT)
+        delta = await asyncio.to_thread(fetch_graph_changes, req.user_id, max(req.since, 0), limit)
+        changed = sum(len(delta[key]) for key in empty)
+        if changed or delta["reset"]:
+            log.info(
+                "rest", "graph_changes", user=req.user_id[:8], since=req.since, version=delta["version"],
+                changed=changed, deleted=sum(map(len, delta["deleted"].values())), reset=delta["reset"]
+            )
+        return GraphChangesResponse(**delta)
+    except Exception as e:
+        log.error("rest", "graph_changes_failed", error=str(e))
+        return GraphChangesResponse(version=req.since, deleted=dict(empty), error=str(e), **empty)
+
+@rest_post("/detect-gaps", GapDetectionRequest, GapDetectionResponse)
 async def handle_detect_gaps(ctx: Context, req: GapDetectionRequest) -> GapDetectionResponse:
     """
     REST endpoint for proactive gap detection in user's knowledge graph.
     Identifies weak clusters and suggests areas to improve.
     """
-    ctx.logger.info(f"🔍 Gap detection requested for user: {req.user_id[:8]}...")
+    log.debug("rest", "gap_detection_requested", user=req.user_id[:8])
     
     try:
-        # Fetch user's graph from Supabase
-        user_graph = await fetch_user_graph_from_supabase(req.user_id)
+        # Bring the user's per-cluster aggregates up to date (delta since last call)
+        clusters = await cluster_aggregates.refresh(req.user_id)
+        nodes_count = sum(c["node_count"] for c in clusters.values())
+        edges_count = sum(c["edge_count"] for c in clusters.values())
         
-        if not user_graph.get("nodes"):
+        if not nodes_count:
             return GapDetectionResponse(
                 gaps=[],
                 suggestions=["Start capturing more sentences to build your knowledge graph!"],
@@ -853,12 +4165,14 @@ async def handle_detect_gaps(ctx: Context, req: GapDetectionRequest) -> GapDetec
             )
         
         # Detect weak clusters (edges with weight < 0.5)
-        weak_clusters = await detect_weak_clusters(user_graph)
+        weak_clusters = await detect_weak_clusters(clusters)
+        # Have quizzes ready for the weak clusters before the user opens one
+        quiz_pools.prefetch(req.user_id, [c["cluster"] for c in weak_clusters])
         
-        # Use ASI:One asi1-graph to analyze gaps
+        # Use ASI:One to analyze gaps
         graph_json = json.dumps({
-            "nodes_count": len(user_graph.get("nodes", [])),
-            "edges_count": len(user_graph.get("edges", [])),
+            "nodes_count": nodes_count,
+            "edges_count": edges_count,
             "weak_clusters": weak_clusters,
             "user_xp": req.user_xp
         })
@@ -881,53 +4195,45 @@ Respond with ONLY this JSON (no markdown):
 
 Focus on actionable gaps that would strengthen the weakest clusters."""
         
-        response = requests.post(
-            ASI_ONE_API_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {ASI_ONE_API_KEY}"
-            },
-            json={
-                "model": "asi1-graph",
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a knowledge graph analyst specializing in identifying learning gaps. Respond with valid JSON only."
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.7,
-                "max_tokens": 500
-            },
-            timeout=30
+        # A handful of weak clusters is a small summary; the fast model handles it
+        route = model_router.route("gaps", len(weak_clusters))
+        result = await asyncio.to_thread(
+            model_router.post,
+            route,
+            [
+                {
+                    "role": "system",
+                    "content": "You are a knowledge graph analyst specializing in identifying learning gaps. Respond with valid JSON only."
+                },
+                {"role": "user", "content": prompt}
+            ],
+            timeout=30,
+            response_format={"type": "json_object"},
+            temperature=0.7
         )
-        
-        response.raise_for_status()
-        result = response.json()
         content = result['choices'][0]['message']['content']
         
-        parsed = validate_and_parse_json(content, {"gaps": [], "suggestions": []})
-        gaps = parsed.get("gaps", [])
-        suggestions = parsed.get("suggestions", [])
+        parsed = decode_structured(content, GAPS_SCHEMA, model=route["model"])
+        gaps = parsed["gaps"]
+        suggestions = parsed["suggestions"]
         
         # Store insights to Supabase for each gap
         for gap in gaps:
-            cluster = gap.get("cluster", "Unknown")
-            missing = ", ".join(gap.get("missing_concepts", [])[:3])
-            await store_insight_to_supabase(
+            cluster = gap["cluster"]
+            missing = ", ".join(gap["missing_concepts"][:3])
+            enqueue_insight(
                 user_id=req.user_id,
                 insight_type="gap_detected",
                 content=f"Weak cluster: {cluster}. Missing concepts: {missing}",
                 metadata={
                     "cluster": cluster,
-                    "missing_concepts": gap.get("missing_concepts", []),
-                    "confidence": gap.get("confidence", 0),
+                    "missing_concepts": gap["missing_concepts"],
+                    "confidence": gap["confidence"],
                     "suggestions": suggestions
                 }
             )
         
-        ctx.logger.info(f"✅ Detected {len(gaps)} gaps for user {req.user_id[:8]}")
+        log.info("rest", "gaps_detected", user=req.user_id[:8], gaps=len(gaps))
         
         return GapDetectionResponse(
             gaps=gaps,
@@ -935,55 +4241,26 @@ Focus on actionable gaps that would strengthen the weakest clusters."""
             timestamp=int(time.time())
         )
     except Exception as e:
-        ctx.logger.error(f"❌ Error in gap detection: {e}")
+        log.error("rest", "gap_detection_failed", error=str(e))
         return GapDetectionResponse(
             gaps=[],
             suggestions=[f"Error detecting gaps: {str(e)}"],
             timestamp=int(time.time())
         )
 
-@agent.on_rest_post("/generate-quiz", QuizGenerationRequest, QuizGenerationResponse)
+@rest_post("/generate-quiz", QuizGenerationRequest, QuizGenerationResponse)
 async def handle_generate_quiz(ctx: Context, req: QuizGenerationRequest) -> QuizGenerationResponse:
     """
-    REST endpoint for generating adaptive quizzes based on knowledge gaps.
-    Uses ASI:One to create personalized questions.
+    REST endpoint for adaptive quizzes based on knowledge gaps.
+    Served from the pre-generated quiz pool; ASI:One only refills pools in the background.
     """
-    ctx.logger.info(f"📝 Quiz generation requested: {req.gap_cluster} (difficulty {req.difficulty})")
+    log.debug("rest", "quiz_requested", cluster=req.gap_cluster, difficulty=req.difficulty)
     
     try:
-        # Fetch sentences for this cluster
-        sentences = await fetch_sentences_for_cluster(req.user_id, req.gap_cluster)
-        
-        if not sentences:
-            # Fallback: generate generic questions
-            ctx.logger.warning(f"No sentences found for cluster {req.gap_cluster}, generating generic quiz")
-            sentences = [{"sentence": f"This is about {req.gap_cluster} concepts in Web3."}]
-        
-        # Generate quiz using ASI:One
-        questions_raw = generate_quiz_with_asi(req.gap_cluster, sentences, req.difficulty)
-        
-        # Convert to QuizQuestion models
-        questions = []
-        for q in questions_raw:
-            if isinstance(q, dict) and "question" in q:
-                questions.append(q)
-        
-        if not questions:
-            # Fallback quiz
-            questions = [{
-                "question": f"What is a key concept in {req.gap_cluster}?",
-                "options": [
-                    "Decentralization",
-                    "Centralization",
-                    "Traditional banking",
-                    "None of the above"
-                ],
-                "correct": "a",
-                "explanation": f"{req.gap_cluster} emphasizes decentralized systems."
-            }]
+        questions, source = await quiz_pools.take(req.user_id, req.gap_cluster, req.difficulty)
         
         # Store quiz suggestion as insight
-        await store_insight_to_supabase(
+        enqueue_insight(
             user_id=req.user_id,
             insight_type="quiz_suggested",
             content=f"Quiz generated for {req.gap_cluster} cluster",
@@ -994,16 +4271,17 @@ async def handle_generate_quiz(ctx: Context, req: QuizGenerationRequest) -> Quiz
             }
         )
         
-        ctx.logger.info(f"✅ Generated {len(questions)} questions for {req.gap_cluster}")
+        log.info("rest", "quiz_served", cluster=req.gap_cluster, questions=len(questions), source=source)
         
         return QuizGenerationResponse(
             questions=questions,
             cluster=req.gap_cluster,
             difficulty=req.difficulty,
-            timestamp=int(time.time())
+            timestamp=int(time.time()),
+            source=source
         )
     except Exception as e:
-        ctx.logger.error(f"❌ Error generating quiz: {e}")
+        log.error("rest", "quiz_failed", error=str(e))
         return QuizGenerationResponse(
             questions=[],
             cluster=req.gap_cluster,
@@ -1012,7 +4290,10 @@ async def handle_generate_quiz(ctx: Context, req: QuizGenerationRequest) -> Quiz
         )
 
 def generate_badge_image_with_asi(domain: str, score: int, node_count: int, concepts: list, format: str) -> tuple[str, float]:
-    """Use ASI:One image generation API to create badge images."""
+    """
+    Use ASI:One image generation API to create badge images. The image is streamed
+    into the badge blob store; returns its digest (or "Error: ...") and the time taken.
+    """
     import time
     start_time = time.time()
     
@@ -1031,82 +4312,267 @@ def generate_badge_image_with_asi(domain: str, score: int, node_count: int, conc
         # Call ASI:One image generation API
         ASI_IMAGE_API_URL = "https://api.asi1.ai/v1/image/generate"
         
-        response = requests.post(
+        result = asi_one_post(
             ASI_IMAGE_API_URL,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {ASI_ONE_API_KEY}"
-            },
-            json={
+            payload={
                 "prompt": prompt,
-                "size": "1024x1024",  # Will be adjusted based on format requirements
+                "size": "{}x{}".format(*BADGE_FORMATS.get(format, BADGE_FORMATS["square"])),
                 "model": "asi1-mini"
             },
             timeout=60
         )
         
-        response.raise_for_status()
-        result = response.json()
-        
         # Extract image data
         if "images" in result and len(result["images"]) > 0:
             image_url = result["images"][0]["url"]
             
             # If image_url starts with data:image, it's already base64
             if image_url.startswith("data:image"):
-                # Extract base64 data
-                image_data = image_url.split(",", 1)[1]
+                digest = badge_blobs.put_base64(image_url.split(",", 1)[1])
             else:
-                # If it's a URL, fetch the image and convert to base64
-                img_response = requests.get(image_url, timeout=30)
-                import base64
-                image_data = base64.b64encode(img_response.content).decode('utf-8')
+                # If it's a URL, stream the download straight to disk
+                digest = badge_blobs.put_stream(fetch_url_chunks(image_url, timeout=30, chunk_size=BADGE_BLOB_CHUNK))
             
             generation_time = time.time() - start_time
-            return image_data, generation_time
+            return digest, generation_time
         else:
             raise ValueError("No images returned from ASI:One API")
             
     except Exception as e:
-        print(f"[ASI:One Image Generation Error]: {e}")
+        log.error("llm", "image_generation_failed", error=str(e))
         # Return error but don't fail - frontend will use fallback
         return f"Error: {str(e)}", time.time() - start_time
 
 
-@agent.on_rest_post("/generate-badge-image", BadgeImageRequest, BadgeImageResponse)
+# ======= BADGE RENDERING =======
+BADGE_CACHE_SIZE = int(os.environ.get("BADGE_CACHE_SIZE", "256"))
+# Content-addressed PNG files, shared by every process; the streaming server serves them
+BADGE_BLOB_DIR = os.environ.get("BADGE_BLOB_DIR") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "badge_blobs"
+)
+BADGE_BLOB_MAX_BYTES = int(float(os.environ.get("BADGE_BLOB_MAX_MB", "512")) * 1024 * 1024)
+BADGE_BLOB_CHUNK = 48 * 1024  # a multiple of 3, so base64 chunks concatenate cleanly
+# Base URL of the streaming server as clients reach it; unset, badges are returned inline
+BADGE_PUBLIC_URL = os.environ.get("BADGE_PUBLIC_URL", "").rstrip("/")
+
+_BLOB_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BadgeBlobStore:
+    """
+    PNG files named by their sha256 (<dir>/<2 hex>/<digest>.png). Writes go to a temp
+    file that is hashed as it is written and renamed into place, so a download never
+    sits in memory whole and readers never see a partial file. Least recently used
+    files are removed once the store grows past `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._files())
+
+    def path(self, digest: str):
+        """Path of a blob, or None if `digest` is not a well-formed sha256."""
+        if not _BLOB_DIGEST_RE.match(digest or ""):
+            return None
+        return os.path.join(self.root, digest[:2], f"{digest}.png")
+
+    def exists(self, digest: str) -> bool:
+        path = self.path(digest)
+        if path is None or not os.path.exists(path):
+            return False
+        os.utime(path)  # keeps it off the eviction list
+        return True
+
+    def put_stream(self, chunks) -> str:
+        """Store an iterable of byte chunks; returns the digest."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        digest, size = hashlib.sha256(), 0
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    fh.write(chunk)
+                    size += len(chunk)
+            if not size:
+                raise ValueError("empty image")
+            return self._commit(tmp_path, digest.hexdigest(), size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put_bytes(self, data: bytes) -> str:
+        return self.put_stream((data,))
+
+    def put_base64(self, text: str) -> str:
+        """Store base64 text, decoding it a chunk at a time."""
+        step = BADGE_BLOB_CHUNK // 3 * 4
+        text = "".join(text.split())
+        return self.put_stream(base64.b64decode(text[i:i + step]) for i in range(0, len(text), step))
+
+    def _commit(self, tmp_path: str, digest: str, size: int) -> str:
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                os.utime(path)
+                return digest
+            os.replace(tmp_path, path)
+            self.total_bytes += size
+            over = self.total_bytes > self.max_bytes
+        if over:
+            self.evict(keep=digest)
+        return digest
+
+    def _files(self):
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".png"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self, keep: str = None):
+        """Remove least recently used blobs until the store is back under 90% of its budget."""
+        evicted = 0
+        with self._lock:
+            target = self.max_bytes * 0.9
+            for path, size, _ in sorted(self._files(), key=lambda f: f[2]):
+                if self.total_bytes <= target:
+                    break
+                if keep and path.endswith(f"{keep}.png"):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                self.total_bytes -= size
+                evicted += 1
+        log.info("badges", "blobs_evicted", count=evicted, total_bytes=self.total_bytes)
+
+    def iter_base64(self, digest: str):
+        """Base64 of a blob, one encoded chunk at a time."""
+        with open(self.path(digest), "rb") as fh:
+            while chunk := fh.read(BADGE_BLOB_CHUNK):
+                yield base64.b64encode(chunk)
+
+    def read_base64(self, digest: str) -> str:
+        return b"".join(self.iter_base64(digest)).decode("ascii")
+
+    def url(self, digest: str) -> str:
+        return f"{BADGE_PUBLIC_URL}/badge/{digest}.png" if BADGE_PUBLIC_URL else ""
+
+    def size(self, digest: str) -> int:
+        return os.path.getsize(self.path(digest))
+
+
+badge_blobs = BadgeBlobStore(BADGE_BLOB_DIR, BADGE_BLOB_MAX_BYTES)
+
+# cache key -> (blob digest, prompt/template used); local renders and AI images share the LRU
+_badge_cache: OrderedDict = OrderedDict()
+_badge_upgrades = set()  # AI cache keys being generated
+
+
+def badge_input_hash(req: BadgeImageRequest) -> str:
+    payload = [req.domain, req.score, req.node_count, list(req.concepts or []), req.format]
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+def _badge_cache_put(key: str, value: tuple):
+    _badge_cache[key] = value
+    _badge_cache.move_to_end(key)
+    if len(_badge_cache) > BADGE_CACHE_SIZE:
+        _badge_cache.popitem(last=False)
+
+
+def _badge_cache_get(key: str):
+    value = _badge_cache.get(key)
+    if value is not None:
+        if not badge_blobs.exists(value[0]):
+            # The blob was evicted from disk; render or generate it again
+            del _badge_cache[key]
+            return None
+        _badge_cache.move_to_end(key)
+    return value
+
+
+async def upgrade_badge_with_ai(key: str, req: BadgeImageRequest):
+    """Generate the AI version of a badge in the background and cache it for the next request."""
+    try:
+        digest, gen_time = await asyncio.to_thread(
+            generate_badge_image_with_asi,
+            req.domain, req.score, req.node_count, req.concepts, req.format
+        )
+        if not digest.startswith("Error:"):
+            _badge_cache_put(key, (digest, f"ai:{req.format}"))
+            log.info("badges", "ai_upgrade_ready", domain=req.domain, format=req.format, seconds=round(gen_time, 2))
+    finally:
+        _badge_upgrades.discard(key)
+
+
+@rest_post("/generate-badge-image", BadgeImageRequest, BadgeImageResponse)
 async def handle_generate_badge_image(ctx: Context, req: BadgeImageRequest) -> BadgeImageResponse:
     """
-    REST endpoint for generating badge images using ASI:One image generation.
-    Creates unique AI-generated images based on domain, score, and user's captured concepts.
+    REST endpoint for badge images. Renders the badge locally from a template
+    (cached by input hash); with ai_upgrade, an ASI:One image is generated in the
+    background and returned by later requests for the same badge. Images live in the
+    blob store and are returned by URL; base64 only with `inline`.
     """
-    ctx.logger.info(f"🎨 Badge image generation requested: {req.domain} ({req.format})")
+    log.debug("rest", "badge_requested", domain=req.domain, format=req.format)
     
     try:
         start_time = time.time()
+        input_hash = badge_input_hash(req)
+        ai_key = f"ai:{input_hash}"
         
-        # Generate image using ASI:One
-        image_data, gen_time = generate_badge_image_with_asi(
-            domain=req.domain,
-            score=req.score,
-            node_count=req.node_count,
-            concepts=req.concepts,
-            format=req.format
-        )
+        cached = _badge_cache_get(ai_key)
+        source = "ai"
+        if cached is None:
+            source = "local"
+            local_key = f"local:{RENDERER_VERSION}:{input_hash}"
+            cached = _badge_cache_get(local_key)
+            if cached is None:
+                digest = await asyncio.to_thread(
+                    lambda: badge_blobs.put_bytes(
+                        render_badge(req.domain, req.score, req.node_count, req.concepts, req.format)
+                    )
+                )
+                cached = (digest, f"template:{req.format}")
+                _badge_cache_put(local_key, cached)
         
-        # Construct prompt used (same logic as in generate_badge_image_with_asi)
-        concepts_str = ', '.join(req.concepts[:3]) if req.concepts else 'knowledge symbols'
-        prompt_used = f"Professional achievement badge for {req.domain} mastery, featuring {concepts_str}, modern minimalist design, gradient background, {req.score}% score display, high quality digital art"
+        upgrade_pending = ai_key in _badge_upgrades
+        if source == "local" and req.ai_upgrade and not upgrade_pending:
+            _badge_upgrades.add(ai_key)
+            spawn_background_task(upgrade_badge_with_ai(ai_key, req), name="badge-ai-upgrade")
+            upgrade_pending = True
         
-        ctx.logger.info(f"✅ Generated {req.format} badge image in {gen_time:.2f}s")
+        # Base64 only when asked for or when there is no URL clients can reach;
+        # otherwise the client fetches image_url from the streaming port
+        digest = cached[0]
+        inline = req.inline or not BADGE_PUBLIC_URL
+        image_data = await asyncio.to_thread(badge_blobs.read_base64, digest) if inline else ""
+        
+        gen_time = time.time() - start_time
+        log.info("rest", "badge_served", source=source, format=req.format, inline=inline, ms=round(gen_time * 1000, 1))
         
         return BadgeImageResponse(
             image_data=image_data,
-            prompt_used=prompt_used,
+            prompt_used=cached[1],
             generation_time=gen_time,
-            timestamp=int(time.time())
+            timestamp=int(time.time()),
+            source=source,
+            upgrade_pending=upgrade_pending,
+            image_id=digest,
+            image_url=badge_blobs.url(digest),
+            size=badge_blobs.size(digest)
         )
     except Exception as e:
-        ctx.logger.error(f"❌ Error generating badge image: {e}")
+        log.error("rest", "badge_failed", error=str(e))
         return BadgeImageResponse(
             image_data=f"Error: {str(e)}",
             prompt_used=f"Error: {str(e)}",
@@ -1130,13 +4596,15 @@ async def handle_generate_badge_image(ctx: Context, req: BadgeImageRequest) -> B
 
 print(f"🚀 Fluent Advanced Agent Starting...")
 print(f"📧 Agent address: {agent.address}")
-print(f"🌐 Available at: http://0.0.0.0:8010")
+print(f"🌐 Available at: http://0.0.0.0:{AGENT_PORT}")
+if AGENT_ROLE != "standalone":
+    print(f"🧩 Mode: {AGENT_ROLE} ({AGENT_WORKERS} REST workers on ports {WORKER_PORTS})")
 print(f"🔑 ASI:One API: {'✅ Set' if ASI_ONE_API_KEY else '❌ Not set'}")
 print(f"🧠 MeTTa Knowledge Graph: Initialized")
 print(f"📊 ASI:One Models: asi1-mini (extraction), asi1-graph (reasoning)")
-print(f"🎯 REST Endpoints: /explain-sentence, /graph-analysis, /detect-gaps, /generate-quiz, /generate-badge-image")
+print(f"🎯 REST Endpoints: /explain-sentence, /graph-analysis, /graph-changes, /detect-gaps, /generate-quiz, /generate-badge-image, /metrics/jobs, /metrics/kg, /metrics/llm")
 print(f"💡 Proactive Nudges: Enabled (gap detection + quiz generation)")
-print(f"🎨 AI Image Generation: Enabled (ASI:One integration)")
+print(f"🎨 Badge Images: local template renderer (ASI:One image upgrade on request)")
 
 if __name__ == "__main__":
     try:
@@ -1145,3 +4613,5 @@ if __name__ == "__main__":
         print("\n🛑 Agent stopped")
     except Exception as e:
         print(f"❌ Error: {e}")
+    finally:
+        stop_workers()
@@ -0,0 +1,287 @@
+"""
+Offline replay of traffic recorded with TRAFFIC_RECORD_PATH.
+
+Runs the recorded REST calls against a build of mailbox_agent.py with every ASI:One
+call answered from the recording (no network, Supabase disabled), then reports
+per-endpoint latency and overall throughput. Run it once per build and compare:
+
+    python replay_traffic.py run traffic.ndjson.gz --agent-dir ../old/agent --out old.json
+    python replay_traffic.py run traffic.ndjson.gz --agent-dir . --out new.json
+    python replay_traffic.py compare old.json new.json
+
+Background jobs that call ASI:One (learning term definitions, refilling quiz pools)
+run on the job queue's workers, outside any recorded request, so their upstream calls
+are not in the recording. The replay skips those jobs and counts them in the report;
+their cost is not part of the replayed latencies.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import contextlib
+import contextvars
+
+
+# Recorded call whose upstream responses the current replayed request may consume
+_replay_call = contextvars.ContextVar("replay_call", default=None)
+
+# Job kinds whose handlers call ASI:One; nothing answers them during replay
+UPSTREAM_JOBS = ("learn_definition", "refill_quiz_pool")
+
+
+def load_records(paths: list, endpoints: set = None) -> list:
+    """Read one or more recordings (e.g. one per worker) merged in arrival order."""
+    records = []
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if endpoints and record["endpoint"] not in endpoints:
+                    continue
+                records.append(record)
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+class ReplayCall:
+    """Upstream responses recorded for one request, handed out as the replayed build asks."""
+
+    def __init__(self, record: dict):
+        self.record = record
+        self.pending = list(record.get("upstream", []))
+        self.misses = 0
+
+    def take(self, key: str = None):
+        """Next recorded response for an API call (by request hash) or a download (key=None)."""
+        download = key is None
+        # Exact request match first, so builds that skip or reorder calls still line up;
+        # changed prompts fall back to the next recorded response of the same kind
+        for i, entry in enumerate(self.pending):
+            if not download and entry.get("key") == key:
+                return self.pending.pop(i)
+        for i, entry in enumerate(self.pending):
+            if (entry.get("url") == "download") == download:
+                return self.pending.pop(i)
+        self.misses += 1
+        return None
+
+
+class RecordedUpstream:
+    """Installed as mailbox_agent.traffic_replay; answers upstream calls from the recording."""
+
+    def __init__(self, agent_module, recorded_latency: bool = True):
+        self.agent = agent_module
+        self.recorded_latency = recorded_latency
+
+    def _take(self, key: str = None) -> dict:
+        call = _replay_call.get()
+        entry = call.take(key) if call is not None else None
+        if entry is None:
+            raise RuntimeError("no recorded upstream response for this call")
+        if self.recorded_latency:
+            time.sleep(entry.get("latency", 0))
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+        return entry
+
+    def upstream(self, url: str, payload: dict) -> dict:
+        return self._take(self.agent.upstream_key(payload))["response"]
+
+    def download(self, url: str) -> bytes:
+        return b"\0" * self._take()["bytes"]
+
+
+class ReplayContext:
+    """The slice of uagents' Context that REST handlers use."""
+
+    def __init__(self):
+        self.logger = logging.getLogger("replay")
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+def import_agent(agent_dir: str, workdir: str):
+    """Import a build's mailbox_agent.py in offline, single-process mode."""
+    os.environ.update({
+        "SUPABASE_URL": "",
+        "SUPABASE_ANON_KEY": "",
+        "ASI_ONE_API_KEY": os.environ.get("ASI_ONE_API_KEY") or "replay",
+        "TRAFFIC_RECORD_PATH": "",
+        "AGENT_ROLE": "standalone",
+        "AGENT_WORKERS": "0",
+        "ADMISSION_CONTROL": "0",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        "JOB_QUEUE_PATH": os.path.join(workdir, "job_queue.db"),
+        "CLUSTER_AGGREGATES_PATH": os.path.join(workdir, "cluster_aggregates.db"),
+        "EXPLANATION_CACHE_PATH": os.path.join(workdir, "explanation_cache.db"),
+        "BADGE_BLOB_DIR": os.path.join(workdir, "badge_blobs"),
+    })
+    os.environ.pop("KG_LOG_PATH", None)
+    sys.path.insert(0, os.path.abspath(agent_dir))
+    import mailbox_agent
+    return mailbox_agent
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list) -> dict:
+    return {
+        "count": len(latencies),
+        "mean": round(sum(latencies) / len(latencies), 6) if latencies else 0.0,
+        "p50": round(percentile(latencies, 50), 6),
+        "p95": round(percentile(latencies, 95), 6),
+        "p99": round(percentile(latencies, 99), 6),
+        "max": round(max(latencies), 6) if latencies else 0.0,
+    }
+
+
+async def replay(agent, records: list, speed: float) -> dict:
+    ctx = ReplayContext()
+    latencies, recorded, errors, misses = {}, {}, {}, {}
+
+    async def replay_one(record: dict):
+        endpoint = record["endpoint"]
+        handler, request_model = agent.rest_handlers[endpoint]
+        call = ReplayCall(record)
+        _replay_call.set(call)
+        args = (request_model(**record["payload"]),) if request_model else ()
+        start = time.perf_counter()
+        try:
+            response = await handler(ctx, *args)
+            failed = bool(getattr(response, "error", None))
+        except Exception as e:
+            ctx.logger.warning(f"{endpoint} raised: {e}")
+            failed = True
+        latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        recorded.setdefault(endpoint, []).append(record["latency"])
+        errors[endpoint] = errors.get(endpoint, 0) + failed
+        misses[endpoint] = misses.get(endpoint, 0) + call.misses
+
+    skipped = {}
+
+    def skip_job(kind: str):
+        async def skip(payload: dict):
+            skipped[kind] = skipped.get(kind, 0) + 1
+        return skip
+
+    # Builds that predate a job kind simply don't register it
+    handlers = agent.job_queue._handlers
+    for kind in UPSTREAM_JOBS:
+        if kind in handlers:
+            handlers[kind] = skip_job(kind)
+
+    await agent.job_queue.start()
+    origin = records[0]["ts"] if records else 0.0
+    started = time.perf_counter()
+    tasks = []
+    for record in records:
+        if record["endpoint"] not in agent.rest_handlers:
+            continue
+        if speed > 0:
+            # Keep the recorded inter-arrival gaps, compressed or stretched by the speed factor
+            delay = (record["ts"] - origin) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(replay_one(record)))
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - started
+    await agent.drain_background_tasks()
+    await agent.job_queue.stop()
+    # Builds that predate the single graph writer have nothing to stop
+    if getattr(agent, "kg_writer", None) is not None:
+        await agent.kg_writer.stop()
+
+    return {
+        "requests": len(tasks),
+        "wall_seconds": round(wall, 6),
+        "throughput": round(len(tasks) / wall, 3) if wall > 0 else 0.0,
+        "speed": speed,
+        "skipped_jobs": skipped,
+        "endpoints": {
+            endpoint: {
+                "replayed": summarize(values),
+                "recorded": summarize(recorded[endpoint]),
+                "errors": errors[endpoint],
+                "upstream_misses": misses[endpoint],
+            }
+            for endpoint, values in sorted(latencies.items())
+        },
+    }
+
+
+def _delta(old: float, new: float) -> str:
+    change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+    return f"{old * 1000:9.1f} -> {new * 1000:9.1f} ms ({change})"
+
+
+def compare(old: dict, new: dict):
+    print(f"throughput: {old['throughput']:.2f} -> {new['throughput']:.2f} req/s")
+    for endpoint in sorted(set(old["endpoints"]) | set(new["endpoints"])):
+        if endpoint not in old["endpoints"] or endpoint not in new["endpoints"]:
+            print(f"{endpoint}: only in {'new' if endpoint in new['endpoints'] else 'old'} run")
+            continue
+        a = old["endpoints"][endpoint]
+        b = new["endpoints"][endpoint]
+        print(f"{endpoint} ({a['replayed']['count']} -> {b['replayed']['count']} requests, "
+              f"errors {a['errors']} -> {b['errors']}, upstream misses {a['upstream_misses']} -> {b['upstream_misses']})")
+        for stat in ("p50", "p95", "p99", "mean"):
+            print(f"  {stat:>4}: {_delta(a['replayed'][stat], b['replayed'][stat])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded agent traffic offline")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="replay a recording against one build")
+    run.add_argument("logs", nargs="+", help="recording files (.ndjson.gz), e.g. one per worker")
+    run.add_argument("--agent-dir", default=os.path.dirname(os.path.abspath(__file__)),
+                     help="directory containing the build's mailbox_agent.py")
+    run.add_argument("--speed", type=float, default=1.0,
+                     help="arrival-rate multiplier (2 = twice as fast, 0 = as fast as possible)")
+    run.add_argument("--no-upstream-latency", action="store_true",
+                     help="answer upstream calls immediately instead of with their recorded latency")
+    run.add_argument("--endpoint", action="append", help="only replay these endpoints")
+    run.add_argument("--out", help="write the report as JSON to this file")
+
+    diff = commands.add_parser("compare", help="compare two replay reports")
+    diff.add_argument("old")
+    diff.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        with open(args.old) as a, open(args.new) as b:
+            compare(json.load(a), json.load(b))
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    records = load_records(args.logs, set(args.endpoint or ()))
+    # The agent prints its banner and JSON log lines to stdout; keep them on stderr so
+    # stdout carries only the report
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(sys.stderr):
+        agent = import_agent(args.agent_dir, workdir)
+        agent.traffic_replay = RecordedUpstream(agent, recorded_latency=not args.no_upstream_latency)
+        report = asyncio.run(replay(agent, records, args.speed))
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
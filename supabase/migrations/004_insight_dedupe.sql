@@ -0,0 +1,27 @@
+-- Fluent Insight Deduplication Migration
+-- Created: 2026-10-19
+-- Purpose: Make agent insight writes idempotent via a deterministic dedupe key
+
+-- ============================================
+-- MODIFY EXISTING TABLES
+-- ============================================
+
+-- Dedupe key computed by the agent from (user, insight type, cluster, content hash).
+-- Rows written before this migration keep NULL and are not affected.
+ALTER TABLE insights
+ADD COLUMN IF NOT EXISTS dedupe_key TEXT;
+
+-- ============================================
+-- INDEXES
+-- ============================================
+
+-- Upsert target for the agent (ON CONFLICT (user_id, dedupe_key) DO NOTHING)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_insights_user_dedupe_key ON insights(user_id, dedupe_key);
+
+-- ============================================
+-- NOTES
+-- ============================================
+
+-- 1. Polling /detect-gaps or /generate-quiz no longer creates identical rows;
+--    a repeated insight is skipped instead of re-inserted
+-- 2. Existing read/dismissed state is preserved because duplicates are ignored, not updated
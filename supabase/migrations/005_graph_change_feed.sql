@@ -0,0 +1,187 @@
+-- Fluent Graph Change Feed Migration
+-- Created: 2026-10-19
+-- Purpose: Per-user version counters and a change log so clients can sync graph deltas
+
+-- ============================================
+-- TABLES
+-- ============================================
+
+-- One counter per user, bumped by every write to graph_nodes, graph_edges or insights.
+-- No foreign key to profiles: deleting a profile cascades into the graph tables, and
+-- their triggers must still be able to write here while that delete runs.
+CREATE TABLE IF NOT EXISTS graph_versions (
+    user_id UUID PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    -- Tombstones at or below this version were pruned; clients behind it must resync
+    pruned_version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Latest change per entity: the version it last changed at, and whether it is now deleted
+CREATE TABLE IF NOT EXISTS graph_changes (
+    user_id UUID NOT NULL,
+    entity TEXT NOT NULL CHECK (entity IN ('node', 'edge', 'insight')),
+    entity_id TEXT NOT NULL,
+    version BIGINT NOT NULL,
+    deleted BOOLEAN NOT NULL DEFAULT FALSE,
+    changed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (user_id, entity, entity_id)
+);
+
+-- ============================================
+-- INDEXES
+-- ============================================
+
+-- Delta reads: WHERE user_id = ? AND version > ? ORDER BY version
+CREATE INDEX IF NOT EXISTS idx_graph_changes_user_version ON graph_changes(user_id, version);
+CREATE INDEX IF NOT EXISTS idx_graph_changes_tombstones ON graph_changes(changed_at) WHERE deleted;
+
+-- ============================================
+-- ROW LEVEL SECURITY (RLS)
+-- ============================================
+
+ALTER TABLE graph_versions ENABLE ROW LEVEL SECURITY;
+ALTER TABLE graph_changes ENABLE ROW LEVEL SECURITY;
+
+-- Users can read their own counters and changes (writes only happen through the triggers)
+CREATE POLICY "Users can view their own graph version"
+ON graph_versions
+FOR SELECT
+TO authenticated
+USING (auth.uid() = user_id);
+
+CREATE POLICY "Users can view their own graph changes"
+ON graph_changes
+FOR SELECT
+TO authenticated
+USING (auth.uid() = user_id);
+
+-- ============================================
+-- FUNCTIONS & TRIGGERS
+-- ============================================
+
+-- Bump the user's counter and record the change. TG_ARGV[0] is the entity name.
+-- The counter row is locked until commit, so changes commit in version order.
+CREATE OR REPLACE FUNCTION record_graph_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    change_user UUID;
+    change_id TEXT;
+    next_version BIGINT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        change_user := OLD.user_id;
+        change_id := OLD.id::TEXT;
+    ELSE
+        change_user := NEW.user_id;
+        change_id := NEW.id::TEXT;
+    END IF;
+
+    INSERT INTO graph_versions (user_id, version)
+    VALUES (change_user, 1)
+    ON CONFLICT (user_id) DO UPDATE
+    SET version = graph_versions.version + 1, updated_at = NOW()
+    RETURNING version INTO next_version;
+
+    INSERT INTO graph_changes (user_id, entity, entity_id, version, deleted, changed_at)
+    VALUES (change_user, TG_ARGV[0], change_id, next_version, TG_OP = 'DELETE', NOW())
+    ON CONFLICT (user_id, entity, entity_id) DO UPDATE
+    SET version = EXCLUDED.version, deleted = EXCLUDED.deleted, changed_at = EXCLUDED.changed_at;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+CREATE TRIGGER graph_nodes_change_feed
+    AFTER INSERT OR DELETE ON graph_nodes
+    FOR EACH ROW
+    EXECUTE FUNCTION record_graph_change('node');
+
+CREATE TRIGGER graph_nodes_change_feed_update
+    AFTER UPDATE ON graph_nodes
+    FOR EACH ROW
+    WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION record_graph_change('node');
+
+CREATE TRIGGER graph_edges_change_feed
+    AFTER INSERT OR DELETE ON graph_edges
+    FOR EACH ROW
+    EXECUTE FUNCTION record_graph_change('edge');
+
+CREATE TRIGGER graph_edges_change_feed_update
+    AFTER UPDATE ON graph_edges
+    FOR EACH ROW
+    WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION record_graph_change('edge');
+
+CREATE TRIGGER insights_change_feed
+    AFTER INSERT OR DELETE ON insights
+    FOR EACH ROW
+    EXECUTE FUNCTION record_graph_change('insight');
+
+CREATE TRIGGER insights_change_feed_update
+    AFTER UPDATE ON insights
+    FOR EACH ROW
+    WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION record_graph_change('insight');
+
+-- Drop tombstones older than `older_than` and raise each affected user's pruned_version,
+-- so a client whose cursor is older than a dropped tombstone is told to resync.
+-- Returns the number of users whose floor moved. Run it periodically (e.g. pg_cron).
+CREATE OR REPLACE FUNCTION prune_graph_tombstones(older_than INTERVAL DEFAULT INTERVAL '30 days')
+RETURNS INTEGER AS $$
+DECLARE
+    users_pruned INTEGER;
+BEGIN
+    WITH gone AS (
+        DELETE FROM graph_changes
+        WHERE deleted AND changed_at < NOW() - older_than
+        RETURNING user_id, version
+    ), floors AS (
+        SELECT user_id, MAX(version) AS version FROM gone GROUP BY user_id
+    )
+    UPDATE graph_versions v
+    SET pruned_version = GREATEST(v.pruned_version, floors.version)
+    FROM floors
+    WHERE v.user_id = floors.user_id;
+
+    GET DIAGNOSTICS users_pruned = ROW_COUNT;
+    RETURN users_pruned;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- ============================================
+-- BACKFILL
+-- ============================================
+
+-- Existing rows get distinct versions 1..n per user (oldest first), so a first sync
+-- (since = 0) returns everything and pages of it can be resumed by version
+WITH existing AS (
+    SELECT user_id, 'node' AS entity, id::TEXT AS entity_id, created_at FROM graph_nodes
+    UNION ALL
+    SELECT user_id, 'edge', id::TEXT, created_at FROM graph_edges
+    UNION ALL
+    SELECT user_id, 'insight', id::TEXT, created_at FROM insights
+)
+INSERT INTO graph_changes (user_id, entity, entity_id, version)
+SELECT user_id, entity, entity_id,
+       ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY created_at, entity, entity_id)
+FROM existing
+ON CONFLICT DO NOTHING;
+
+-- Counters continue after the backfilled versions
+INSERT INTO graph_versions (user_id, version)
+SELECT user_id, MAX(version) FROM graph_changes GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE
+SET version = GREATEST(graph_versions.version, EXCLUDED.version);
+
+-- ============================================
+-- NOTES
+-- ============================================
+
+-- 1. Clients keep the `version` from their last sync and ask the agent's /graph-changes
+--    for everything after it; an unchanged graph costs one counter lookup
+-- 2. graph_changes holds one row per entity, so repeated edits of a row do not grow it;
+--    only tombstones accumulate until prune_graph_tombstones() drops them
+-- 3. Saving a graph by delete-and-reinsert still reports every row as changed;
+--    upserting rows keeps deltas small
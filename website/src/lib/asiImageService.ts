@@ -16,10 +16,12 @@ interface BadgeImageOptions {
 }
 
 interface BadgeImageResponse {
-  image_data: string; // base64 encoded
+  image_data: string; // base64 encoded, when requested with `inline` or when image_url is empty
   prompt_used: string;
   generation_time: number;
   timestamp: number;
+  image_id?: string; // sha256 of the PNG
+  image_url?: string; // PNG served by the agent's streaming port (empty without BADGE_PUBLIC_URL)
 }
 
 const AGENT_URL = process.env.NEXT_PUBLIC_AGENT_URL || 'http://localhost:8010';
@@ -65,12 +67,12 @@ export async function generateBadgeWithASI(
       throw new Error(data.image_data);
     }
 
-    // Convert base64 to data URL
-    const dataUrl = `data:image/png;base64,${data.image_data}`;
+    // Prefer the image URL; older agents, and agents without BADGE_PUBLIC_URL, send base64
+    const imageSrc = data.image_url || `data:image/png;base64,${data.image_data}`;
     
     console.log(`[ASI Image] Generated ${format} badge for ${domain} in ${data.generation_time.toFixed(2)}s`);
     
-    return dataUrl;
+    return imageSrc;
   } catch (error: any) {
     if (error.name === 'AbortError') {
       console.warn('[ASI Image] Generation timeout, using fallback');